@@ -1,4 +1,4 @@
-from flask import Flask, request, jsonify, session, send_from_directory, redirect
+from flask import Flask, request, jsonify, session, send_from_directory, redirect, Response
 from flask_cors import CORS
 from werkzeug.security import generate_password_hash, check_password_hash
 import psycopg2
@@ -597,7 +597,168 @@ def get_user():
         cur.close()
         conn.close()
 
+#JSONレスポンスの圧縮とETag（地図の再読み込みで同じデータを再送しない）
+########################################################################################################
+########################################################################################################
+import gzip
+import hashlib
+import threading
+from collections import OrderedDict
+
+try:
+    import brotli  # あればgzipより優先（pip install brotli）
+except ImportError:
+    brotli = None
+
+try:
+    import msgpack  # スポット一覧の format=msgpack 用（pip install msgpack）
+except ImportError:
+    msgpack = None
+
+RESPONSE_COMPRESS_MIN_BYTES = int(os.getenv('RESPONSE_COMPRESS_MIN_BYTES', 1024))   # これより小さい場合は圧縮しない
+_compressed_bodies = OrderedDict()   # (ETag, 符号化) → 圧縮済みの本文（同じ内容を何度も圧縮しない）
+_COMPRESSED_BODIES_MAX = 64
+_compressed_bodies_lock = threading.Lock()   # 開発サーバーはスレッドで並行処理するため
+_body_sizes = OrderedDict()   # ビューが付けたETag → 本文のバイト数（本文を作らずに304を返す時の符号化の判定用）
+
+
+def accepted_encodings() -> Dict[str, float]:
+    """Accept-Encodingを {符号化: q値} にする"""
+    encodings = {}
+    for part in request.headers.get('Accept-Encoding', '').split(','):
+        name, _, params = part.strip().partition(';')
+        if not name:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        encodings[name.strip().lower()] = q
+    return encodings
+
+
+def choose_encoding():
+    """使える符号化（br → gzip の順）。圧縮しない場合はNone"""
+    encodings = accepted_encodings()
+    if brotli is not None and encodings.get('br', 0) > 0:
+        return 'br'
+    if encodings.get('gzip', encodings.get('*', 0)) > 0:
+        return 'gzip'
+    return None
+
+
+def response_encoding(size: int):
+    """本文のバイト数とAccept-Encodingから符号化を決める（200と304で同じ判定にする）"""
+    return choose_encoding() if size >= RESPONSE_COMPRESS_MIN_BYTES else None
+
+
+def etag_matches(etag: str) -> bool:
+    """If-None-Matchが本文のETag（圧縮版を含む）と一致するか"""
+    header = request.headers.get('If-None-Match', '')
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    base = etag.strip('"')
+    candidates = {base, f'{base}-gzip', f'{base}-br'}
+    return any(tag.strip().removeprefix('W/').strip('"') in candidates for tag in header.split(','))
+
+
+def representation_etag(etag: str, encoding: str = None) -> str:
+    """圧縮版は別の表現なので別のETagにする"""
+    return f'"{etag.strip(chr(34))}-{encoding}"' if encoding else etag
+
+
+def not_modified_response(etag: str, encoding: str = None):
+    response = app.make_response(('', 304))
+    response.headers['ETag'] = representation_etag(etag, encoding)
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+
+def early_not_modified(etag: str):
+    """
+    ビューが本文を作る前に返せる304（conditional_jsonと同じ符号化のETagにする）
+
+    同じETagの本文を返したことがなく、サイズ（＝圧縮するか）が分からない場合はNone
+    → 本文を作ればconditional_jsonが304を返す
+    """
+    if not etag_matches(etag):
+        return None
+    with _compressed_bodies_lock:
+        size = _body_sizes.get(etag)
+    if size is None:
+        return None
+    return not_modified_response(etag, response_encoding(size))
+
+
+def _remember_body_size(etag: str, size: int):
+    with _compressed_bodies_lock:
+        _body_sizes[etag] = size
+        _body_sizes.move_to_end(etag)
+        while len(_body_sizes) > _COMPRESSED_BODIES_MAX:
+            _body_sizes.popitem(last=False)
+
+
+def _compress(body: bytes, encoding: str, etag: str) -> bytes:
+    key = (etag, encoding)
+    with _compressed_bodies_lock:
+        cached = _compressed_bodies.get(key)
+        if cached is not None:
+            _compressed_bodies.move_to_end(key)
+            return cached
+    # 圧縮はロックの外で行う（同時に同じ本文を圧縮しても結果は同じ）
+    if encoding == 'br':
+        compressed = brotli.compress(body, quality=5)
+    else:
+        compressed = gzip.compress(body, compresslevel=6, mtime=0)
+    with _compressed_bodies_lock:
+        _compressed_bodies[key] = compressed
+        _compressed_bodies.move_to_end(key)
+        while len(_compressed_bodies) > _COMPRESSED_BODIES_MAX:
+            _compressed_bodies.popitem(last=False)
+    return compressed
+
+
+def conditional_json(f):
+    """
+    JSONを返すGETエンドポイント用デコレータ
+
+    - 本文のハッシュから強いETagを付ける（ビューがETagを設定済みならそれを使う）
+    - If-None-Matchが一致すれば304を返す
+    - Accept-Encodingに応じてbrotli/gzipで圧縮する
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        response = app.make_response(f(*args, **kwargs))
+        if (response.status_code != 200 or response.direct_passthrough
+                or response.mimetype not in ('application/json', 'application/x-msgpack')):
+            return response
+
+        body = response.get_data()
+        etag = response.headers.get('ETag')
+        if etag:
+            _remember_body_size(etag, len(body))
+        else:
+            etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+        encoding = response_encoding(len(body))
+        if etag_matches(etag):
+            return not_modified_response(etag, encoding)
+
+        response.headers['Vary'] = 'Accept-Encoding'
+        if encoding:
+            response.set_data(_compress(body, encoding, etag))
+            response.headers['Content-Encoding'] = encoding
+        response.headers['ETag'] = representation_etag(etag, encoding)
+        return response
+    return decorated_function
+
+
 @app.route('/api/spots', methods=['GET'])
+@conditional_json
 def get_spots():
     """スポットデータを取得"""
     import json
@@ -608,14 +769,23 @@ def get_spots():
         
         if not os.path.exists(spots_file):
             return jsonify({'success': False, 'message': 'スポットデータが見つかりません'}), 404
+
+        # ファイルの更新日時とサイズをETagにする（変わっていなければ読み込まずに304）
+        stat = os.stat(spots_file)
+        etag = f'"spots-{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+        not_modified = early_not_modified(etag)
+        if not_modified is not None:
+            return not_modified
         
         with open(spots_file, 'r', encoding='utf-8') as f:
             spots_data = json.load(f)
         
-        return jsonify({
+        response = jsonify({
             'success': True,
             'data': spots_data
-        }), 200
+        })
+        response.headers['ETag'] = etag
+        return response, 200
         
     except Exception as e:
         print(f"スポットデータ読み込みエラー: {e}")
@@ -789,17 +959,1467 @@ def send_password_reset_email(to_email, reset_url, user_name=None):
     
 import re
 import requests
+import requests.adapters
 from flask import jsonify, request
+import sqlite3
+import hashlib
+import threading
+import time
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor, wait
+import click
+from xml.etree import ElementTree
+import base64
+import hmac
+import unicodedata
+import heapq
+import itertools
+from bisect import bisect_left, insort
+from collections import OrderedDict, deque
+
+try:
+    import ijson  # 大きなレスポンスの逐次パース用（なければ通常のjsonで処理）
+except ImportError:
+    ijson = None
+
+#Overpass APIレスポンスキャッシュ
+########################################################################################################
+########################################################################################################
+
+OVERPASS_URL = os.getenv('OVERPASS_URL', 'http://overpass-api.de/api/interpreter')
+
+# 使用するOverpassエンドポイント（カンマ区切り。ローカルのOverpassや代替サーバーも指定可）
+# 例: OVERPASS_URLS=http://localhost:12345/api/interpreter,https://overpass.kumi.systems/api/interpreter
+OVERPASS_URLS = [u.strip() for u in os.getenv('OVERPASS_URLS', OVERPASS_URL).split(',') if u.strip()]
+
+# キャッシュ設定（城・寺社・博物館はほとんど変わらないので長めに保持）
+OVERPASS_CACHE_ENABLED = os.getenv('OVERPASS_CACHE_ENABLED', 'True') == 'True'
+OVERPASS_CACHE_PATH = os.getenv('OVERPASS_CACHE_PATH', os.path.join(BASE_DIR, 'data', 'cache', 'overpass_cache.sqlite3'))
+OVERPASS_CACHE_TTL = int(os.getenv('OVERPASS_CACHE_TTL', 24 * 60 * 60))                # 新鮮とみなす秒数
+OVERPASS_CACHE_STALE_TTL = int(os.getenv('OVERPASS_CACHE_STALE_TTL', 7 * 24 * 60 * 60))  # 期限切れ後も古いデータを返す秒数
+OVERPASS_CACHE_MAX_BYTES = int(os.getenv('OVERPASS_CACHE_MAX_BYTES', 200 * 1024 * 1024))
+
+# カテゴリー別取得の並列数と全体の締め切り（秒）
+OVERPASS_MAX_CONCURRENCY = int(os.getenv('OVERPASS_MAX_CONCURRENCY', 4))
+OVERPASS_FETCH_DEADLINE = float(os.getenv('OVERPASS_FETCH_DEADLINE', 25))
+
+# 文字列リテラル（"..."）はそのまま、それ以外の空白の連続は1つにまとめる
+_QL_TOKEN_RE = re.compile(r'"(?:[^"\\]|\\.)*"|\s+')
+
+
+def normalize_overpass_query(query: str) -> str:
+    """Overpass QLの空白・改行の違いを吸収した正規化クエリを返す"""
+    return _QL_TOKEN_RE.sub(lambda m: m.group(0) if m.group(0).startswith('"') else ' ', query).strip()
+
+
+def overpass_cache_key(query: str, element_filter=None) -> str:
+    """正規化クエリ（bboxを含む）と要素フィルタ名からキャッシュキーを生成"""
+    key_source = normalize_overpass_query(query)
+    if element_filter is not None:
+        key_source += f'|{element_filter.__name__}'
+    return hashlib.sha256(key_source.encode('utf-8')).hexdigest()
+
+
+def iter_overpass_elements_stream(raw, meta: Dict):
+    """
+    レスポンスを逐次パースし、elements配列の要素を1つずつ返す
+
+    ドキュメント全体をメモリに載せずに済む。remarkはmetaに格納する。
+    """
+    builder = None
+    for prefix, event, value in ijson.parse(raw, use_float=True):
+        if builder is not None:
+            builder.event(event, value)
+            if prefix == 'elements.item' and event == 'end_map':
+                yield builder.value
+                builder = None
+        elif prefix == 'elements.item' and event == 'start_map':
+            builder = ijson.ObjectBuilder()
+            builder.event(event, value)
+        elif prefix == 'remark' and event == 'string':
+            meta['remark'] = value
+
+
+def compact_overpass_elements(elements, element_filter) -> List[Dict]:
+    """
+    タグ付き要素をフィルタしながら受け取り、必要なノード座標だけを残す
+
+    「out body; >; out skel qt;」では本体の後に再帰取得したノードが並ぶため、
+    残したwayが参照するノードだけを座標のみで保持できる。
+    """
+    kept = []
+    referenced = set()
+    for element in elements:
+        if element.get('tags'):
+            if not element_filter(element):
+                continue
+            referenced.update(element.get('nodes', []))
+            kept.append(element)
+        elif element.get('type') == 'node' and element.get('id') in referenced:
+            kept.append({'type': 'node', 'id': element['id'],
+                         'lat': element.get('lat'), 'lon': element.get('lon')})
+    return kept
+
+
+class OverpassCache:
+    """Overpass APIレスポンスのディスクキャッシュ（SQLite、TTL＋LRU削除）"""
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.execute('''CREATE TABLE IF NOT EXISTS overpass_cache (
+                               key TEXT PRIMARY KEY,
+                               query TEXT NOT NULL,
+                               payload TEXT NOT NULL,
+                               size INTEGER NOT NULL,
+                               created_at REAL NOT NULL,
+                               expires_at REAL NOT NULL,
+                               stale_until REAL NOT NULL,
+                               last_access REAL NOT NULL)''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_overpass_cache_access ON overpass_cache (last_access)')
+            conn.execute('''CREATE TABLE IF NOT EXISTS element_centroids (
+                               osm_type TEXT NOT NULL,
+                               osm_id INTEGER NOT NULL,
+                               lat REAL NOT NULL,
+                               lon REAL NOT NULL,
+                               updated_at REAL NOT NULL,
+                               PRIMARY KEY (osm_type, osm_id))''')
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+
+    def get(self, key: str):
+        """
+        キャッシュを取得
+
+        Returns:
+            (data, state): stateは 'fresh'（有効期限内）/ 'stale'（期限切れだが返却可）/ None（なし）
+        """
+        now = time.time()
+        with self._lock, closing(self._connect()) as conn, conn:
+            row = conn.execute(
+                'SELECT payload, expires_at, stale_until FROM overpass_cache WHERE key = ?', (key,)
+            ).fetchone()
+            if not row:
+                return None, None
+            payload, expires_at, stale_until = row
+            if now > stale_until:
+                conn.execute('DELETE FROM overpass_cache WHERE key = ?', (key,))
+                return None, None
+            conn.execute('UPDATE overpass_cache SET last_access = ? WHERE key = ?', (now, key))
+        state = 'fresh' if now <= expires_at else 'stale'
+        return json.loads(payload), state
+
+    def put(self, key: str, query: str, data: Dict, ttl: int, stale_ttl: int):
+        """キャッシュを保存し、上限サイズを超えた分を古い順に削除"""
+        payload = json.dumps(data, ensure_ascii=False)
+        size = len(payload.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        now = time.time()
+        with self._lock, closing(self._connect()) as conn, conn:
+            conn.execute(
+                '''INSERT OR REPLACE INTO overpass_cache
+                   (key, query, payload, size, created_at, expires_at, stale_until, last_access)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                (key, normalize_overpass_query(query), payload, size,
+                 now, now + ttl, now + ttl + stale_ttl, now)
+            )
+            self._evict(conn)
+
+    def _evict(self, conn):
+        """LRU: 最終アクセスが古いものから削除して上限サイズに収める"""
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM overpass_cache').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        victims = []
+        for key, size in conn.execute('SELECT key, size FROM overpass_cache ORDER BY last_access'):
+            if total <= self.max_bytes:
+                break
+            victims.append((key,))
+            total -= size
+        conn.executemany('DELETE FROM overpass_cache WHERE key = ?', victims)
+        print(f"🧹 Overpassキャッシュ: {len(victims)}件を削除（LRU）")
+
+    def clear(self):
+        with self._lock, closing(self._connect()) as conn, conn:
+            conn.execute('DELETE FROM overpass_cache')
+
+    def expires_in(self, key: str):
+        """有効期限までの秒数（期限切れは負の値、キャッシュがなければNone）"""
+        with closing(self._connect()) as conn:
+            row = conn.execute('SELECT expires_at FROM overpass_cache WHERE key = ?', (key,)).fetchone()
+        return row[0] - time.time() if row else None
+
+    def iter_payloads(self):
+        """保存済みのレスポンスを (キー, 有効期限, レスポンス) で順に返す（最終アクセス日時は更新しない）"""
+        now = time.time()
+        with closing(self._connect()) as conn:
+            keys = [row[0] for row in conn.execute(
+                'SELECT key FROM overpass_cache WHERE stale_until >= ?', (now,))]
+            for key in keys:
+                row = conn.execute('SELECT payload, expires_at FROM overpass_cache WHERE key = ?',
+                                   (key,)).fetchone()
+                if row:
+                    yield key, row[1], json.loads(row[0])
+
+    def get_centroids(self, keys) -> Dict:
+        """解決済みのway/relation中心座標を取得 {(osm_type, osm_id): (lat, lon)}"""
+        result = {}
+        keys = list(keys)
+        with closing(self._connect()) as conn:
+            for i in range(0, len(keys), 400):
+                chunk = keys[i:i + 400]
+                where = ' OR '.join(['(osm_type = ? AND osm_id = ?)'] * len(chunk))
+                params = [v for key in chunk for v in key]
+                for osm_type, osm_id, lat, lon in conn.execute(
+                        f'SELECT osm_type, osm_id, lat, lon FROM element_centroids WHERE {where}', params):
+                    result[(osm_type, osm_id)] = (lat, lon)
+        return result
+
+    def put_centroids(self, centroids: Dict):
+        """way/relationの中心座標を保存"""
+        now = time.time()
+        with self._lock, closing(self._connect()) as conn, conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO element_centroids VALUES (?, ?, ?, ?, ?)',
+                [(osm_type, osm_id, lat, lon, now) for (osm_type, osm_id), (lat, lon) in centroids.items()]
+            )
+
+
+overpass_cache = None
+if OVERPASS_CACHE_ENABLED:
+    try:
+        overpass_cache = OverpassCache(OVERPASS_CACHE_PATH, OVERPASS_CACHE_MAX_BYTES)
+    except Exception as e:
+        print(f"⚠️ Overpassキャッシュを初期化できません（キャッシュなしで動作）: {e}")
+
+_refreshing_keys = set()
+_refreshing_lock = threading.Lock()
+
+
+# HTTPクライアント設定
+OVERPASS_CONNECT_TIMEOUT = float(os.getenv('OVERPASS_CONNECT_TIMEOUT', 5))
+OVERPASS_READ_TIMEOUT = float(os.getenv('OVERPASS_READ_TIMEOUT', 30))
+OVERPASS_MAX_RETRIES = int(os.getenv('OVERPASS_MAX_RETRIES', 3))
+OVERPASS_BACKOFF_BASE = float(os.getenv('OVERPASS_BACKOFF_BASE', 1.0))   # 初回待機秒数（以降2倍ずつ）
+OVERPASS_BACKOFF_MAX = float(os.getenv('OVERPASS_BACKOFF_MAX', 30.0))
+
+# エンドポイント選択（応答時間の指数移動平均＋サーキットブレーカー）
+OVERPASS_EWMA_ALPHA = float(os.getenv('OVERPASS_EWMA_ALPHA', 0.3))              # 新しい応答時間の重み
+OVERPASS_EXPLORE_RATE = float(os.getenv('OVERPASS_EXPLORE_RATE', 0.05))         # 最速以外を試す割合
+OVERPASS_CIRCUIT_FAILURES = int(os.getenv('OVERPASS_CIRCUIT_FAILURES', 3))      # 連続失敗でこの回数に達したら遮断
+OVERPASS_CIRCUIT_COOLDOWN = float(os.getenv('OVERPASS_CIRCUIT_COOLDOWN', 60))   # 遮断する秒数
+
+# 同時に送信するクエリ数の上限（Overpassは接続元IPごとにスロット数が決まっている）
+OVERPASS_SLOT_CEILING = int(os.getenv('OVERPASS_SLOT_CEILING', 2 * len(OVERPASS_URLS)))
+OVERPASS_SLOT_RECOVERY = int(os.getenv('OVERPASS_SLOT_RECOVERY', 20))   # この回数成功したら上限を1つ戻す
+OVERPASS_SLOT_MAX_WAIT = float(os.getenv('OVERPASS_SLOT_MAX_WAIT', 60))   # 429で止まっている時に待てる秒数
+
+# 送信の優先度（小さいほど先）
+OVERPASS_PRIORITY_INTERACTIVE = 0   # ユーザーの検索
+OVERPASS_PRIORITY_BACKGROUND = 1    # キャッシュの再取得・先読み
+
+
+class OverpassEndpoint:
+    """1つのOverpassエンドポイントの状態と統計"""
+
+    def __init__(self, url: str):
+        self.url = url
+        self.ewma_latency = None      # 秒（未計測ならNone）
+        self.consecutive_failures = 0
+        self.open_until = 0.0         # この時刻まで遮断（0なら通常）
+        self.requests = 0
+        self.successes = 0
+        self.failures = 0
+        self.last_error = None
+
+    def is_open(self, now: float) -> bool:
+        return now < self.open_until
+
+    def to_dict(self, now: float) -> Dict:
+        return {
+            'url': self.url,
+            'state': 'open' if self.is_open(now) else 'closed',
+            'ewma_latency_ms': round(self.ewma_latency * 1000, 1) if self.ewma_latency is not None else None,
+            'consecutive_failures': self.consecutive_failures,
+            'retry_in': round(max(0.0, self.open_until - now), 1),
+            'requests': self.requests,
+            'successes': self.successes,
+            'failures': self.failures,
+            'last_error': self.last_error,
+        }
+
+
+class OverpassEndpointPool:
+    """
+    複数のOverpassエンドポイントから応答の速いものを選ぶ
+
+    - 応答時間の指数移動平均（EWMA）が最小のエンドポイントを使い、
+      OVERPASS_EXPLORE_RATEの割合で他も試して平均を更新する
+    - 連続して失敗したエンドポイントは一定時間使わない（サーキットブレーカー）。
+      遮断時間が過ぎたら1件だけ試し、成功すれば復帰する
+    """
+
+    def __init__(self, urls: List[str], alpha: float, explore_rate: float,
+                 failure_threshold: int, cooldown: float):
+        self.endpoints = [OverpassEndpoint(url) for url in urls]
+        self.alpha = alpha
+        self.explore_rate = explore_rate
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.recent = deque(maxlen=100)   # 直近のリクエストをどのエンドポイントが処理したか
+        self._lock = threading.Lock()
+
+    def select(self, exclude=()) -> OverpassEndpoint:
+        """次に使うエンドポイント（すべて遮断中なら最も早く復帰するもの）"""
+        now = time.time()
+        with self._lock:
+            candidates = [e for e in self.endpoints if e not in exclude] or list(self.endpoints)
+            available = [e for e in candidates if not e.is_open(now)]
+            if not available:
+                return min(candidates, key=lambda e: e.open_until)
+            # 未計測のエンドポイントを優先して試す
+            unmeasured = [e for e in available if e.ewma_latency is None]
+            if unmeasured:
+                chosen = unmeasured[0]
+            elif len(available) > 1 and random.random() < self.explore_rate:
+                chosen = random.choice(available)
+            else:
+                chosen = min(available, key=lambda e: e.ewma_latency)
+            # 遮断明けは結果が出るまで他のリクエストを送らない（試行は1件だけ）
+            if chosen.open_until:
+                chosen.open_until = now + self.cooldown
+            return chosen
+
+    def record_success(self, endpoint: OverpassEndpoint, latency: float, status: int):
+        with self._lock:
+            endpoint.requests += 1
+            endpoint.successes += 1
+            endpoint.consecutive_failures = 0
+            endpoint.open_until = 0.0
+            if endpoint.ewma_latency is None:
+                endpoint.ewma_latency = latency
+            else:
+                endpoint.ewma_latency = self.alpha * latency + (1 - self.alpha) * endpoint.ewma_latency
+            self.recent.append({'time': time.time(), 'url': endpoint.url, 'status': status,
+                                'latency_ms': round(latency * 1000, 1)})
+
+    def record_failure(self, endpoint: OverpassEndpoint, error: str, latency: float = None):
+        with self._lock:
+            endpoint.requests += 1
+            endpoint.failures += 1
+            endpoint.consecutive_failures += 1
+            endpoint.last_error = error
+            # 遅い失敗（タイムアウト等）も平均に反映して選ばれにくくする
+            if latency is not None and endpoint.ewma_latency is not None:
+                endpoint.ewma_latency = self.alpha * latency + (1 - self.alpha) * endpoint.ewma_latency
+            if endpoint.consecutive_failures >= self.failure_threshold or endpoint.open_until:
+                endpoint.open_until = time.time() + self.cooldown
+                print(f"🚧 Overpassエンドポイントを{self.cooldown:.0f}秒間停止: {endpoint.url}（{error}）")
+            self.recent.append({'time': time.time(), 'url': endpoint.url, 'status': error,
+                                'latency_ms': round(latency * 1000, 1) if latency is not None else None})
+
+    def status(self) -> Dict:
+        now = time.time()
+        with self._lock:
+            return {
+                'endpoints': [e.to_dict(now) for e in self.endpoints],
+                'recent': list(self.recent)[-20:],
+            }
+
+
+class OverpassBusyError(Exception):
+    """Overpass APIの空きスロットを待てない（retry_after秒後に再試行してもらう）"""
+
+    def __init__(self, retry_after: float):
+        self.retry_after = max(1, math.ceil(retry_after))
+        super().__init__(f'Overpass APIが混雑しています（{self.retry_after}秒後に再試行してください）')
+
+
+class OverpassSlotScheduler:
+    """
+    Overpass APIへの送信を一元管理する（優先度付きの待ち行列＋同時実行数の上限）
+
+    - 空きスロットがなければ優先度順（同じ優先度は到着順）に待たせる
+    - 429を受けたら /api/status で上限と空き時刻を確認し、分からなければ上限を半分にする
+    - 成功が続いたら上限をOVERPASS_SLOT_CEILINGまで1つずつ戻す
+    """
+
+    def __init__(self, ceiling: int, recovery: int):
+        self.ceiling = max(1, ceiling)
+        self.limit = self.ceiling
+        self.recovery = recovery
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.rate_limited = 0
+        self._successes = 0
+        self._waiters = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+
+    def acquire(self, priority: int = OVERPASS_PRIORITY_INTERACTIVE, timeout: float = None):
+        """
+        スロットを確保する
+
+        429で送信を止めている間は、/api/status で知らされた空き時刻まで待ってから
+        さらにtimeout秒待つ。空き時刻がOVERPASS_SLOT_MAX_WAIT秒より先の場合や
+        期限までに確保できない場合はOverpassBusyError（再試行までの秒数つき）
+        """
+        entry = (priority, next(self._seq))
+        started = time.time()
+        with self._cond:
+            heapq.heappush(self._waiters, entry)
+            while True:
+                now = time.time()
+                if (self._waiters[0] == entry and self.in_flight < self.limit
+                        and now >= self.paused_until):
+                    heapq.heappop(self._waiters)
+                    self.in_flight += 1
+                    # 次の待ち行列の先頭にも空きがあれば確保させる
+                    self._cond.notify_all()
+                    return
+                paused_for = self.paused_until - now
+                deadline = max(started, self.paused_until) + timeout if timeout else None
+                if paused_for > OVERPASS_SLOT_MAX_WAIT or (deadline and now >= deadline):
+                    self._waiters.remove(entry)
+                    heapq.heapify(self._waiters)
+                    self._cond.notify_all()
+                    # 止まっていなければ（スロットが埋まっているだけなら）少し置いて再試行してもらう
+                    raise OverpassBusyError(paused_for if paused_for > 0 else OVERPASS_BACKOFF_BASE * 5)
+                waits = [w for w in (paused_for if paused_for > 0 else None,
+                                     deadline - now if deadline else None) if w is not None]
+                self._cond.wait(min(waits) if waits else None)
+
+    def release(self, status=None):
+        """スロットを返す（statusは応答のHTTPステータス）"""
+        with self._cond:
+            self.in_flight -= 1
+            if status == 200:
+                self._successes += 1
+                if self.limit < self.ceiling and self._successes >= self.recovery:
+                    self.limit += 1
+                    self._successes = 0
+            self._cond.notify_all()
+
+    def rate_limited_by(self, status_url: str = None, retry_after: float = None) -> float:
+        """
+        429を受けたときに呼ぶ。上限と送信再開時刻を更新し、待つ秒数を返す
+        """
+        slot_limit, wait_seconds = fetch_overpass_slot_status(status_url) if status_url else (None, None)
+        if wait_seconds is None:
+            wait_seconds = retry_after
+        with self._cond:
+            self.rate_limited += 1
+            self._successes = 0
+            if slot_limit:
+                self.limit = max(1, min(self.ceiling, slot_limit))
+            else:
+                self.limit = max(1, self.limit // 2)
+            if wait_seconds:
+                self.paused_until = max(self.paused_until, time.time() + wait_seconds)
+            self._cond.notify_all()
+        print(f"🚦 Overpass API 429: 同時実行数の上限を{self.limit}に変更"
+              + (f"、{wait_seconds:.0f}秒間送信を停止" if wait_seconds else ''))
+        return wait_seconds or 0
+
+    def status(self) -> Dict:
+        with self._cond:
+            return {
+                'limit': self.limit,
+                'ceiling': self.ceiling,
+                'in_flight': self.in_flight,
+                'queued': len(self._waiters),
+                'queued_background': sum(1 for p, _ in self._waiters if p >= OVERPASS_PRIORITY_BACKGROUND),
+                'paused_for': round(max(0.0, self.paused_until - time.time()), 1),
+                'rate_limited': self.rate_limited,
+            }
+
+
+_SLOT_LIMIT_RE = re.compile(r'Rate limit:\s*(\d+)')
+_SLOT_AVAILABLE_RE = re.compile(r'(\d+)\s+slots? available now')
+_SLOT_WAIT_RE = re.compile(r'in\s+(-?\d+)\s+seconds')
+
+
+def overpass_status_url(url: str):
+    """エンドポイントURLから /api/status のURLを作る（作れない場合はNone）"""
+    if url.endswith('/interpreter'):
+        return url[:-len('/interpreter')] + '/status'
+    return None
+
+
+def fetch_overpass_slot_status(status_url: str):
+    """
+    Overpassの /api/status からスロット数と空くまでの秒数を取得
+
+    Returns:
+        (slot_limit, wait_seconds): 取得できなかった値はNone。空きがあればwait_secondsは0
+    """
+    try:
+        response = requests.get(status_url, timeout=(OVERPASS_CONNECT_TIMEOUT, 5))
+        if response.status_code != 200:
+            return None, None
+        text = response.text
+    except requests.exceptions.RequestException:
+        return None, None
+
+    limit_match = _SLOT_LIMIT_RE.search(text)
+    slot_limit = int(limit_match.group(1)) if limit_match and int(limit_match.group(1)) > 0 else None
+    available = _SLOT_AVAILABLE_RE.search(text)
+    if available and int(available.group(1)) > 0:
+        return slot_limit, 0
+    waits = [max(0, int(w)) for w in _SLOT_WAIT_RE.findall(text)]
+    return slot_limit, (min(waits) if waits else None)
+
+
+class OverpassClient:
+    """
+    Overpass API用の共有HTTPクライアント
+
+    - requests.Sessionでコネクションを使い回す（keep-alive）
+    - エンドポイントはOverpassEndpointPoolで選択し、失敗したら別のエンドポイントで再試行
+    - 429/504は指数バックオフ＋ジッターで再試行（別のエンドポイントがあれば待たずに切り替え）
+    - 送信はOverpassSlotSchedulerで優先度順に並べ、同時実行数を抑える
+    - 接続タイムアウトと読み込みタイムアウトを別々に指定
+    """
+
+    RETRY_STATUSES = (429, 504)
+
+    def __init__(self, pool: OverpassEndpointPool, scheduler: OverpassSlotScheduler,
+                 connect_timeout: float, read_timeout: float,
+                 max_retries: int, backoff_base: float, backoff_max: float, pool_size: int):
+        self.pool = pool
+        self.scheduler = scheduler
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=len(pool.endpoints), pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def _backoff(self, attempt: int, response=None) -> float:
+        """待機秒数（Retry-Afterがあれば優先、なければfull jitter）"""
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), self.backoff_max)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def post(self, query: str, timeout: float = None, element_filter=None,
+             priority: int = OVERPASS_PRIORITY_INTERACTIVE):
+        """
+        クエリを送信してJSONを返す
+
+        Args:
+            query: Overpass QL
+            timeout: 読み込みタイムアウト（秒）。省略時はOVERPASS_READ_TIMEOUT
+            element_filter: 指定するとelementsを逐次パースしながら絞り込む
+                            （compact_overpass_elements参照）
+            priority: 送信の優先度（OVERPASS_PRIORITY_INTERACTIVE / OVERPASS_PRIORITY_BACKGROUND）
+
+        Returns:
+            dict: レスポンスJSON（ステータス200以外はNone）
+        """
+        stream = element_filter is not None and ijson is not None
+
+        def reader(response):
+            if element_filter is None:
+                return response.json()
+            return self._read_compact(response, element_filter, stream)
+
+        return self._request(query, timeout or self.read_timeout, stream, priority, reader)
+
+    def post_raw(self, query: str, timeout: float = None,
+                 priority: int = OVERPASS_PRIORITY_BACKGROUND) -> bytes:
+        """クエリを送信してレスポンス本文をそのまま返す（[out:xml]の差分取得用。200以外はNone）"""
+        return self._request(query, timeout or self.read_timeout, False, priority, lambda r: r.content)
+
+    def _request(self, query: str, read_timeout: float, stream: bool, priority: int, reader):
+        """送信・再試行の本体（readerはスロットを確保したままレスポンス本文を読む）"""
+        tried = []
+
+        for attempt in range(self.max_retries + 1):
+            self.scheduler.acquire(priority, timeout=read_timeout)
+            status = None
+            try:
+                endpoint = self.pool.select(exclude=tried)
+                tried.append(endpoint)
+                started = time.time()
+                try:
+                    response = self.session.post(
+                        endpoint.url,
+                        data={'data': query},
+                        timeout=(self.connect_timeout, read_timeout),
+                        stream=stream
+                    )
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                    self.pool.record_failure(endpoint, type(e).__name__, time.time() - started)
+                    if attempt < self.max_retries and len(self.pool.endpoints) > 1:
+                        print(f"🔁 Overpass API 接続失敗（{endpoint.url}）、別のエンドポイントで再試行")
+                        continue
+                    raise
+                latency = time.time() - started
+                status = response.status_code
+
+                if response.status_code == 200:
+                    print(f"🌐 Overpass API 応答: {endpoint.url}（{latency * 1000:.0f}ms）")
+                    # 受信し終わるまでスロットを使っているのでここで読み切る
+                    try:
+                        result = reader(response)
+                    except Exception as e:
+                        # 途中で切れた・壊れた本文は成功として数えない
+                        status = None
+                        self.pool.record_failure(endpoint, type(e).__name__, time.time() - started)
+                        raise
+                    self.pool.record_success(endpoint, latency, response.status_code)
+                    return result
+
+                response.close()
+            finally:
+                self.scheduler.release(status)
+
+            if response.status_code in self.RETRY_STATUSES or response.status_code >= 500:
+                self.pool.record_failure(endpoint, str(response.status_code), latency)
+            else:
+                # クエリ自体の誤り（400等）はエンドポイントの問題ではない
+                self.pool.record_success(endpoint, latency, response.status_code)
+
+            if response.status_code in self.RETRY_STATUSES and attempt < self.max_retries:
+                if any(e not in tried for e in self.pool.endpoints):
+                    print(f"🔁 Overpass API ステータス {response.status_code}（{endpoint.url}）、別のエンドポイントで再試行")
+                    continue
+                if response.status_code == 429:
+                    # 送信再開までは他のクエリも待たせる（スケジューラーの待ち行列で待機）
+                    self.scheduler.rate_limited_by(overpass_status_url(endpoint.url),
+                                                   self._backoff(attempt, response))
+                else:
+                    wait_seconds = self._backoff(attempt, response)
+                    print(f"🔁 Overpass API ステータス {response.status_code}、{wait_seconds:.1f}秒後に再試行（{attempt + 1}/{self.max_retries}）")
+                    time.sleep(wait_seconds)
+                tried = []
+                continue
+
+            print(f"❌ Overpass API ステータス {response.status_code}（{endpoint.url}）")
+            return None
+
+    @staticmethod
+    def _read_compact(response, element_filter, stream: bool) -> Dict:
+        """フィルタ済みの要素だけを保持したレスポンスを作る"""
+        if not stream:
+            data = response.json()
+            data['elements'] = compact_overpass_elements(data.get('elements', []), element_filter)
+            return data
+
+        meta = {}
+        with response:
+            response.raw.decode_content = True
+            elements = compact_overpass_elements(
+                iter_overpass_elements_stream(response.raw, meta), element_filter
+            )
+        result = {'elements': elements}
+        result.update(meta)
+        return result
+
+
+overpass_pool = OverpassEndpointPool(
+    OVERPASS_URLS,
+    alpha=OVERPASS_EWMA_ALPHA,
+    explore_rate=OVERPASS_EXPLORE_RATE,
+    failure_threshold=OVERPASS_CIRCUIT_FAILURES,
+    cooldown=OVERPASS_CIRCUIT_COOLDOWN,
+)
+
+overpass_scheduler = OverpassSlotScheduler(OVERPASS_SLOT_CEILING, OVERPASS_SLOT_RECOVERY)
+
+overpass_client = OverpassClient(
+    overpass_pool,
+    overpass_scheduler,
+    connect_timeout=OVERPASS_CONNECT_TIMEOUT,
+    read_timeout=OVERPASS_READ_TIMEOUT,
+    max_retries=OVERPASS_MAX_RETRIES,
+    backoff_base=OVERPASS_BACKOFF_BASE,
+    backoff_max=OVERPASS_BACKOFF_MAX,
+    pool_size=max(OVERPASS_MAX_CONCURRENCY * 2, 10),
+)
+
+
+def _fetch_overpass_json(query: str, timeout: int, element_filter=None,
+                         priority: int = OVERPASS_PRIORITY_INTERACTIVE):
+    """共有クライアントでOverpass APIにクエリを送信（ステータス200以外はNone）"""
+    return overpass_client.post(query, timeout=timeout, element_filter=element_filter, priority=priority)
+
+
+class SingleFlight:
+    """同じキーの処理が同時に来たら1回だけ実行し、結果を全員で共有する"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.coalesced = 0  # 相乗りしたリクエスト数
+
+    def do(self, key: str, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = {'done': threading.Event(), 'result': None, 'error': None}
+                self._calls[key] = call
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call['done'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return call['result']
+
+        try:
+            call['result'] = fn()
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call['done'].set()
+        return call['result']
+
+
+overpass_singleflight = SingleFlight()
+
+
+@app.route('/api/overpass-status', methods=['GET'])
+def overpass_status():
+    """Overpassエンドポイントごとの状態・応答時間・直近の処理状況"""
+    status = overpass_pool.status()
+    status['coalesced'] = overpass_singleflight.coalesced
+    status['scheduler'] = overpass_scheduler.status()
+    status['warmer'] = overpass_warmer.status()
+    status['category_stats'] = category_query_stats.status()
+    if os.path.exists(POI_STORE_PATH):
+        try:
+            status['poi_sync'] = LocalPoiStore(POI_STORE_PATH).sync_state()
+        except sqlite3.Error as e:
+            status['poi_sync'] = {'error': str(e)}
+    return jsonify({'success': True, **status}), 200
+
+
+def _fetch_and_store(key: str, query: str, timeout: int, ttl: int, element_filter=None,
+                     priority: int = OVERPASS_PRIORITY_INTERACTIVE):
+    """実行中の同一クエリがあれば相乗りし、なければ取得してキャッシュに保存"""
+    def fetch():
+        data = _fetch_overpass_json(query, timeout, element_filter, priority)
+        _store_overpass_result(key, query, data, ttl)
+        return data
+    return overpass_singleflight.do(key, fetch)
+
+
+def _store_overpass_result(key: str, query: str, data, ttl: int):
+    # タイムアウト等でremarkが付いた不完全な結果はキャッシュしない
+    if overpass_cache is None or data is None or 'remark' in data:
+        return
+    try:
+        overpass_cache.put(key, query, data, ttl, OVERPASS_CACHE_STALE_TTL)
+        store_element_centroids(data.get('elements', []))
+    except Exception as e:
+        print(f"⚠️ Overpassキャッシュ保存エラー: {e}")
+    # 取得した要素はスポット名の索引にも追加（入力候補に使う）
+    try:
+        spot_name_index.add_elements(data.get('elements', []))
+        spot_name_index.mark_covered(key, time.time() + ttl)
+    except Exception as e:
+        print(f"⚠️ スポット名索引の更新エラー: {e}")
+
+
+def _refresh_in_background(key: str, query: str, timeout: int, ttl: int, element_filter=None):
+    """stale-while-revalidate: 古いデータを返しつつ裏で再取得"""
+    with _refreshing_lock:
+        if key in _refreshing_keys:
+            return
+        _refreshing_keys.add(key)
+
+    def worker():
+        try:
+            _fetch_and_store(key, query, timeout, ttl, element_filter, OVERPASS_PRIORITY_BACKGROUND)
+        except Exception as e:
+            print(f"⚠️ Overpassキャッシュ再取得エラー: {e}")
+        finally:
+            with _refreshing_lock:
+                _refreshing_keys.discard(key)
+
+    threading.Thread(target=worker, daemon=True).start()
+
+
+def run_overpass_query(query: str, timeout: int = 30, ttl: int = None, element_filter=None,
+                       priority: int = OVERPASS_PRIORITY_INTERACTIVE):
+    """
+    キャッシュ経由でOverpass APIを呼び出す
+
+    Args:
+        query: Overpass QL
+        timeout: HTTPタイムアウト（秒）
+        ttl: キャッシュ有効期間（秒）。省略時はOVERPASS_CACHE_TTL
+        element_filter: タグ付き要素を残すか判定する関数（指定時は逐次パースで絞り込む）
+        priority: 送信の優先度（先読みなどはOVERPASS_PRIORITY_BACKGROUND）
+
+    Returns:
+        dict: レスポンスJSON（取得失敗時はNone）
+    """
+    ttl = OVERPASS_CACHE_TTL if ttl is None else ttl
+    key = overpass_cache_key(query, element_filter)
+
+    if overpass_cache is not None:
+        try:
+            data, state = overpass_cache.get(key)
+        except Exception as e:
+            print(f"⚠️ Overpassキャッシュ読み込みエラー: {e}")
+            data, state = None, None
+        if state == 'fresh':
+            print(f"⚡ Overpassキャッシュヒット: {key[:12]}")
+            return data
+        if state == 'stale':
+            print(f"⏳ Overpassキャッシュ期限切れ（古いデータを返して再取得）: {key[:12]}")
+            _refresh_in_background(key, query, timeout, ttl, element_filter)
+            return data
+
+    return _fetch_and_store(key, query, timeout, ttl, element_filter, priority)
+
+
+# way/relationの座標の求め方
+#   center : Overpass側で中心座標を計算（out center）。既定
+#   geom   : ジオメトリを受け取り手元で中心を計算（out geom）
+#   recurse: 構成ノードを再帰取得して平均（out body; >; out skel qt;）
+OVERPASS_GEOMETRY_MODE = os.getenv('OVERPASS_GEOMETRY_MODE', 'center')
+
+
+def overpass_output_clause(limit: int = None, input_set: str = None) -> str:
+    """OVERPASS_GEOMETRY_MODEに応じたout文を返す（input_set指定時はその名前付きセットを出力）"""
+    count = f' {limit}' if limit else ''
+    prefix = f'.{input_set} ' if input_set else ''
+    if OVERPASS_GEOMETRY_MODE == 'geom':
+        return f'{prefix}out geom{count};'
+    if OVERPASS_GEOMETRY_MODE == 'recurse':
+        return f'{prefix}out body{count};\n{prefix}>;\nout skel qt;'
+    return f'{prefix}out center{count};'
+
+
+def _geometry_points(element: Dict) -> List[Tuple[float, float]]:
+    """out geom のジオメトリ（relationはメンバー全体）から座標一覧を取り出す"""
+    points = [(g['lat'], g['lon']) for g in element.get('geometry') or [] if g]
+    for member in element.get('members') or []:
+        if member.get('lat') is not None:
+            points.append((member['lat'], member['lon']))
+        points.extend((g['lat'], g['lon']) for g in member.get('geometry') or [] if g)
+    return points
+
+
+def element_center(element: Dict, node_coords: Dict = None):
+    """要素の代表座標 (lat, lon) を返す（求められない場合は (None, None)）"""
+    if element.get('lat') is not None and element.get('lon') is not None:
+        return element['lat'], element['lon']
+    center = element.get('center')
+    if center:
+        return center.get('lat'), center.get('lon')
+    points = _geometry_points(element)
+    if not points and node_coords:
+        points = [node_coords[n] for n in element.get('nodes', []) if n in node_coords]
+    if not points:
+        return None, None
+    return sum(p[0] for p in points) / len(points), sum(p[1] for p in points) / len(points)
+
+
+def resolve_element_centers(elements: List[Dict]) -> Dict:
+    """
+    タグ付き要素の座標をまとめて解決する
+
+    way/relationの中心座標はIDごとにキャッシュし（store_element_centroids）、座標を
+    含まないレスポンス（out body のみ等）でもキャッシュ済みなら再計算・ノード再帰取得なしで使える。
+
+    Returns:
+        dict: {(type, id): (lat, lon)}
+    """
+    node_coords = {e.get('id'): (e.get('lat'), e.get('lon'))
+                   for e in elements if e.get('type') == 'node' and e.get('lat') is not None}
+
+    centers = {}
+    unresolved = []
+    for element in elements:
+        if not element.get('tags'):
+            continue
+        key = (element.get('type'), element.get('id'))
+        lat, lon = element_center(element, node_coords)
+        if lat is None or lon is None:
+            unresolved.append(key)
+            continue
+        centers[key] = (lat, lon)
+
+    if overpass_cache is not None and unresolved:
+        try:
+            centers.update(overpass_cache.get_centroids(unresolved))
+        except Exception as e:
+            print(f"⚠️ 中心座標キャッシュエラー: {e}")
+
+    return centers
+
+
+def store_element_centroids(elements: List[Dict]):
+    """
+    way/relationの中心座標をキャッシュに保存
+
+    Overpass APIから取得した時だけ呼ぶ（キャッシュヒットのたびに同じ値を書き込まない。
+    取得し直した時は編集後の座標で上書きされる）
+    """
+    node_coords = {e.get('id'): (e.get('lat'), e.get('lon'))
+                   for e in elements if e.get('type') == 'node' and e.get('lat') is not None}
+    resolved_areas = {}
+    for element in elements:
+        if not element.get('tags') or element.get('type') == 'node':
+            continue
+        lat, lon = element_center(element, node_coords)
+        if lat is not None and lon is not None:
+            resolved_areas[(element.get('type'), element.get('id'))] = (lat, lon)
+    if resolved_areas:
+        overpass_cache.put_centroids(resolved_areas)
+
+
+# グリッドタイル設定（bbox検索をタイルに分けて個別にキャッシュ）
+OVERPASS_TILE_SIZE = float(os.getenv('OVERPASS_TILE_SIZE', 0.25))   # 度
+OVERPASS_MAX_TILES = int(os.getenv('OVERPASS_MAX_TILES', 48))       # これを超える場合は分割せず1回で問い合わせる
+
+
+def overpass_bbox_tiles(bbox, tile_size: float = None) -> List[Tuple[float, float, float, float]]:
+    """bboxを覆う固定グリッドのタイル一覧（南, 西, 北, 東）を返す"""
+    tile_size = tile_size or OVERPASS_TILE_SIZE
+    min_lat, min_lon, max_lat, max_lon = bbox
+    lat_start, lat_end = math.floor(min_lat / tile_size), math.ceil(max_lat / tile_size)
+    lon_start, lon_end = math.floor(min_lon / tile_size), math.ceil(max_lon / tile_size)
+    return [
+        (round(i * tile_size, 6), round(j * tile_size, 6),
+         round((i + 1) * tile_size, 6), round((j + 1) * tile_size, 6))
+        for i in range(lat_start, max(lat_end, lat_start + 1))
+        for j in range(lon_start, max(lon_end, lon_start + 1))
+    ]
+
+
+def overpass_tile_queries(query: str, bbox):
+    """クエリ中のbboxをタイルごとに置き換えたクエリ一覧（分割できない場合はNone）"""
+    bbox_str = ','.join(str(v) for v in bbox)
+    tiles = overpass_bbox_tiles(bbox)
+    if bbox_str not in query or len(tiles) > OVERPASS_MAX_TILES:
+        return None
+    return [query.replace(bbox_str, ','.join(str(v) for v in tile)) for tile in tiles]
+
+
+def run_tiled_overpass_query(query: str, bbox, timeout: int = 30, ttl: int = None, element_filter=None,
+                             priority: int = OVERPASS_PRIORITY_INTERACTIVE):
+    """
+    bbox検索をグリッドタイルごとに実行して結合する
+
+    タイルごとにキャッシュされるため、重なる地域（京都と滋賀など）の検索では
+    キャッシュ済みのタイルが再利用され、未取得のタイルだけを問い合わせる。
+    クエリ中のbbox文字列をタイルのbboxに置き換えるので、結果にはbbox外の要素も含まれる。
+    OVERPASS_MAX_TILESを超える広い範囲（近畿地方全体など）は分割せず1回で問い合わせる。
+
+    Args:
+        query: bbox（"南,西,北,東"）を含むOverpass QL
+        bbox: (南, 西, 北, 東)
+
+    Returns:
+        dict: 結合したレスポンスJSON（全タイル失敗時はNone）
+    """
+    tile_queries = overpass_tile_queries(query, bbox)
+    if tile_queries is None:
+        return run_overpass_query(query, timeout=timeout, ttl=ttl, element_filter=element_filter,
+                                  priority=priority)
+
+    print(f"🧩 タイル分割検索: {len(tile_queries)}タイル")
+    busy = []
+
+    with ThreadPoolExecutor(max_workers=min(OVERPASS_MAX_CONCURRENCY, len(tile_queries))) as executor:
+        results = list(executor.map(
+            lambda q: _run_tile_query(q, timeout, ttl, element_filter, priority, busy), tile_queries
+        ))
+
+    failed = sum(1 for r in results if r is None)
+    if failed == len(results):
+        if busy:
+            raise max(busy, key=lambda e: e.retry_after)
+        return None
+    if failed:
+        print(f"⚠️ {failed}/{len(results)}タイルの取得に失敗（取得できたタイルのみ使用）")
+
+    # タイル境界をまたぐ要素は複数タイルに含まれるので重複をまとめる
+    # （再帰取得のタグなしのコピーより、タグ付きのコピーを優先して足りない項目を補う）
+    merged = {}
+    for data in results:
+        for element in (data or {}).get('elements', []):
+            element_key = (element.get('type'), element.get('id'))
+            existing = merged.get(element_key)
+            if existing is None:
+                merged[element_key] = element
+            elif element.get('tags') and not existing.get('tags'):
+                merged[element_key] = {**existing, **element}
+            else:
+                merged[element_key] = {**element, **existing}
+    return {'elements': list(merged.values())}
+
+
+def _run_tile_query(query: str, timeout: int, ttl: int, element_filter=None,
+                    priority: int = OVERPASS_PRIORITY_INTERACTIVE, busy: List = None):
+    try:
+        return run_overpass_query(query, timeout=timeout, ttl=ttl, element_filter=element_filter,
+                                  priority=priority)
+    except OverpassBusyError as e:
+        print(f"  ⏳ タイル取得を見送り: {e}")
+        if busy is not None:
+            busy.append(e)
+        return None
+    except Exception as e:
+        print(f"  ❌ タイル取得エラー: {e}")
+        return None
 
 #API連携、スポット検索
 ########################################################################################################
 ########################################################################################################
 
+# 観光スポットとして不適切な名前・タグに含まれるキーワード（data/bad_keywords.json で変更可能）
+BAD_KEYWORDS_PATH = os.getenv('BAD_KEYWORDS_PATH', os.path.join(BASE_DIR, 'data', 'bad_keywords.json'))
+DEFAULT_BAD_KEYWORDS = ['詰所', '案内', '地図', '乗り場', '駐車場', 'トイレ',
+                        '入口', '出口', '受付', '売店', 'ゲート', '記念碑']
+
+
+def load_bad_keywords(path: str) -> List[str]:
+    """除外キーワードをデータファイルから読み込む（なければ既定値）"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f).get('exclude_keywords', DEFAULT_BAD_KEYWORDS)
+    except FileNotFoundError:
+        return DEFAULT_BAD_KEYWORDS
+    except Exception as e:
+        print(f"⚠️ 除外キーワード読み込みエラー（既定値を使用）: {e}")
+        return DEFAULT_BAD_KEYWORDS
+
+
+class KeywordMatcher:
+    """
+    複数キーワードを1つの正規表現にまとめた照合器
+
+    要素ごとに「キーワード数 × 値の数」回の部分文字列検索をする代わりに、
+    名前とタグ値を連結した文字列を1回だけ走査する。
+    """
+
+    SEPARATOR = '\x1f'  # 値の境界をまたいだ一致を防ぐ
+
+    def __init__(self, keywords: List[str]):
+        self.keywords = sorted({k for k in keywords if k}, key=len, reverse=True)
+        self._pattern = re.compile('|'.join(map(re.escape, self.keywords))) if self.keywords else None
+
+    def search(self, text: str) -> bool:
+        return bool(self._pattern and text and self._pattern.search(text))
+
+    def matches_element(self, name: str, tags: Dict = None) -> bool:
+        """名前（tags指定時はタグ値も）にキーワードが含まれるか"""
+        if self._pattern is None:
+            return False
+        if not tags:
+            return self.search(name)
+        text = self.SEPARATOR.join([name or '', *(str(v) for v in tags.values())])
+        return bool(self._pattern.search(text))
+
+
+bad_keyword_matcher = KeywordMatcher(load_bad_keywords(BAD_KEYWORDS_PATH))
+
+# search_combined のカテゴリー条件（ローカルPOIストア用。Overpassクエリと同じ条件）
+# 値: 文字列=一致 / None=タグが存在 / タプル=いずれかに一致 / 正規表現=部分一致
+SEARCH_LOCAL_FILTERS = {
+    'castle': [{'historic': 'castle'}],
+    'buddhist': [{'amenity': 'place_of_worship', 'religion': 'buddhist', 'wikidata': None}],
+    'shinto': [{'amenity': 'place_of_worship', 'religion': 'shinto', 'wikidata': None}],
+    'museum': [{'tourism': 'museum'}],
+    'gallery': [{'tourism': 'gallery'}],
+    'theme_park': [{'tourism': 'theme_park'}],
+    'heritage': [{'heritage': '1'}],
+    'park': [{'leisure': 'park'}],
+    'theatre': [{'amenity': 'theatre'}],
+    'restaurant': [{'amenity': ('restaurant', 'cafe', 'fast_food', 'food_court', 'bar', 'pub')}],
+    'library': [{'amenity': 'library'}],
+    'cinema': [{'amenity': 'cinema'}],
+    'water_park': [{'leisure': 'water_park'}],
+    'zoo': [{'tourism': 'zoo'}],
+    'aquarium': [{'tourism': 'aquarium'}],
+    'viewpoint': [{'tourism': 'viewpoint'}],
+}
+
+# 都道府県のみの検索（主要な観光スポットのみ）
+SEARCH_LOCAL_MAJOR_FILTERS = (
+    SEARCH_LOCAL_FILTERS['castle'] + SEARCH_LOCAL_FILTERS['buddhist'] + SEARCH_LOCAL_FILTERS['shinto'] +
+    SEARCH_LOCAL_FILTERS['museum'] + SEARCH_LOCAL_FILTERS['theme_park'] + SEARCH_LOCAL_FILTERS['heritage'] +
+    [{'tourism': 'attraction'}] + SEARCH_LOCAL_FILTERS['zoo'] + SEARCH_LOCAL_FILTERS['aquarium'] +
+    SEARCH_LOCAL_FILTERS['water_park']
+)
+
+
+def search_coverage_keys(keyword: str, category: str, bounds):
+    """
+    キーワード検索の結果を包含するカテゴリ検索（タイル単位）のキャッシュキー一覧
+
+    カテゴリのクエリから名前の条件を外すとカテゴリのみのクエリと一致する場合だけ、
+    カテゴリ検索で取得済みの要素を名前で絞り込めばキーワード検索の結果になる
+    （寺社はカテゴリ検索だけwikidata条件があるので対象外）。
+
+    Returns:
+        list: キャッシュキー一覧（包含するカテゴリ検索がない場合はNone）
+    """
+    if not keyword or category not in SEARCH_CATEGORY_TAGS:
+        return None
+    category_query = build_search_query('', category, bounds)
+    keyword_query = build_search_query(keyword, category, bounds)
+    if keyword_query.replace(f'["name"~"{keyword}",i]', '') != category_query:
+        return None
+    tile_queries = overpass_tile_queries(category_query, bounds) or [category_query]
+    return [overpass_cache_key(q, is_search_candidate) for q in tile_queries]
+
+
+def search_local_filters(keyword: str, category: str):
+    """search_combined の検索条件をローカルPOIストア用のタグ条件に変換（Noneは条件なし）"""
+    if keyword:
+        if category in SEARCH_LOCAL_FILTERS:
+            # キーワード検索では寺社のwikidata条件を外す（Overpassクエリと同じ）
+            return [{k: v for k, v in f.items() if k != 'wikidata'} for f in SEARCH_LOCAL_FILTERS[category]]
+        return None
+    if category in SEARCH_LOCAL_FILTERS:
+        return SEARCH_LOCAL_FILTERS[category]
+    return SEARCH_LOCAL_MAJOR_FILTERS
+
+
+def is_search_candidate(element: Dict) -> bool:
+    """search_combined 用: 名前が観光スポットとして妥当な要素か（受信しながらの絞り込みに使用）"""
+    tags = element.get('tags') or {}
+    name = tags.get('name:ja') or tags.get('name') or tags.get('name:en')
+    if not name or name == '名称不明' or len(name) > 40:
+        return False
+    return not bad_keyword_matcher.search(name)
+
+
+# OSMタグ → スポットタイプの判定表（上にあるものほど優先）
+SPOT_TYPE_RULES = [
+    ('historic', 'castle', '城'),
+    ('religion', 'buddhist', '寺院'),
+    ('religion', 'shinto', '神社'),
+    ('tourism', 'museum', '博物館'),
+    ('tourism', 'gallery', '美術館'),
+    ('tourism', 'theme_park', 'テーマパーク'),
+    ('heritage', '1', '世界遺産'),
+    ('leisure', 'park', '公園'),
+    ('amenity', 'theatre', '劇場'),
+    ('amenity', 'library', '図書館'),
+    ('amenity', 'cinema', '映画館'),
+    ('leisure', 'water_park', 'ウォーターパーク'),
+    ('tourism', 'zoo', '動物園'),
+    ('tourism', 'aquarium', '水族館'),
+    ('tourism', 'viewpoint', '展望台'),
+    ('tourism', 'attraction', '観光地'),
+    ('amenity', ('restaurant', 'cafe', 'fast_food', 'food_court', 'bar', 'pub'), '飲食店'),
+    ('leisure', 'spa', '温泉'),
+    ('amenity', 'onsen', '温泉'),
+    ('natural', 'peak', '山'),
+    ('natural', 'beach', 'ビーチ'),
+    ('shop', 'mall', 'ショッピングモール'),
+]
+
+
+class SpotTypeClassifier:
+    """
+    判定表を (key, value) → (優先順位, タイプ) の辞書に展開した分類器
+
+    要素ごとに判定表を上から順に比較する代わりに、判定に使うキー（数個）だけを
+    辞書で引き、最も優先順位の高いタイプを返す。
+    """
+
+    def __init__(self, rules):
+        self._table = {}
+        for priority, (key, values, spot_type) in enumerate(rules):
+            for value in (values if isinstance(values, tuple) else (values,)):
+                self._table.setdefault((key, value), (priority, spot_type))
+        self._keys = tuple(dict.fromkeys(key for key, _, _ in rules))
+
+    def classify(self, tags: Dict, default: str = 'その他') -> str:
+        best = None
+        table = self._table
+        for key in self._keys:
+            value = tags.get(key)
+            if value is None:
+                continue
+            hit = table.get((key, value))
+            if hit is not None and (best is None or hit[0] < best[0]):
+                best = hit
+        return best[1] if best else default
+
+
+spot_type_classifier = SpotTypeClassifier(SPOT_TYPE_RULES)
+
+
+def classify_spot_type(tags: Dict, default: str = 'その他') -> str:
+    """タグからスポットタイプを判定（全パイプライン共通）"""
+    return spot_type_classifier.classify(tags, default)
+
+
+@app.cli.command('bench-classifier')
+@click.option('--count', default=100000, help='要素数')
+def bench_classifier_command(count):
+    """スポットタイプ判定のマイクロベンチマーク（判定表を順に比較する方式と比較）"""
+    rng = random.Random(0)
+    rule_pairs = [(key, value) for key, values, _ in SPOT_TYPE_RULES
+                  for value in (values if isinstance(values, tuple) else (values,))]
+    noise = [('name', '名称'), ('wikidata', 'Q1'), ('building', 'yes'), ('highway', 'bus_stop'),
+             ('addr:city', '京都市'), ('opening_hours', '9:00-17:00'), ('amenity', 'parking')]
+    fixture = []
+    for _ in range(count):
+        tags = dict(rng.sample(noise, rng.randint(1, len(noise))))
+        for key, value in rng.sample(rule_pairs, rng.randint(0, 2)):
+            tags[key] = value
+        fixture.append(tags)
+
+    def classify_linear(tags):
+        for key, values, spot_type in SPOT_TYPE_RULES:
+            value = tags.get(key)
+            if value is not None and (value in values if isinstance(values, tuple) else value == values):
+                return spot_type
+        return 'その他'
+
+    started = time.perf_counter()
+    linear = [classify_linear(tags) for tags in fixture]
+    linear_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    compiled = [classify_spot_type(tags) for tags in fixture]
+    compiled_time = time.perf_counter() - started
+
+    mismatches = sum(1 for a, b in zip(linear, compiled) if a != b)
+    print(f"要素数: {count}")
+    print(f"  判定表を順に比較: {linear_time * 1000:.1f}ms")
+    print(f"  辞書による判定  : {compiled_time * 1000:.1f}ms（{linear_time / compiled_time:.1f}倍）")
+    print(f"  不一致: {mismatches}件")
+
+
+# 検索結果のページング（結果のスナップショットをサーバー側に保持）
+SPOT_SNAPSHOT_TTL = int(os.getenv('SPOT_SNAPSHOT_TTL', 10 * 60))   # スナップショット保持秒数
+SPOT_SNAPSHOT_MAX = int(os.getenv('SPOT_SNAPSHOT_MAX', 200))       # 保持するスナップショット数の上限
+SPOT_PAGE_MAX = int(os.getenv('SPOT_PAGE_MAX', 500))               # 1ページの最大件数
+
+
+class SpotSnapshotStore:
+    """検索条件ごとの絞り込み済み結果を保持する（TTL＋件数上限のLRU）"""
+
+    def __init__(self, ttl: int, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, snapshot_id: str):
+        with self._lock:
+            entry = self._entries.get(snapshot_id)
+            if entry is None:
+                return None
+            created_at, result = entry
+            if time.time() - created_at > self.ttl:
+                del self._entries[snapshot_id]
+                return None
+            self._entries.move_to_end(snapshot_id)
+            return result
+
+    def put(self, snapshot_id: str, result: Dict):
+        with self._lock:
+            self._entries[snapshot_id] = (time.time(), result)
+            self._entries.move_to_end(snapshot_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+spot_snapshots = SpotSnapshotStore(SPOT_SNAPSHOT_TTL, SPOT_SNAPSHOT_MAX)
+
+
+def spot_snapshot_id(endpoint: str, params: Dict) -> str:
+    """エンドポイントと正規化した検索条件からスナップショットIDを生成"""
+    normalized = json.dumps([endpoint, sorted((k, v.strip()) for k, v in params.items())], ensure_ascii=False)
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()[:24]
+
+
+def _cursor_signature(raw: bytes) -> bytes:
+    return hmac.new(app.secret_key.encode('utf-8'), raw, hashlib.sha256).digest()[:12]
+
+
+def encode_spot_cursor(endpoint: str, snapshot_id: str, offset: int) -> str:
+    """エンドポイント名・スナップショットID・位置を署名付きのカーソルにする"""
+    raw = json.dumps({'e': endpoint, 's': snapshot_id, 'o': offset}, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(_cursor_signature(raw) + raw).decode('ascii').rstrip('=')
+
+
+def decode_spot_cursor(cursor: str, endpoint: str):
+    """カーソルを (snapshot_id, offset) に戻す（不正・署名不一致・別のエンドポイントのカーソルはNone）"""
+    try:
+        signed = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        signature, raw = signed[:12], signed[12:]
+        if not hmac.compare_digest(signature, _cursor_signature(raw)):
+            return None
+        data = json.loads(raw)
+        if data['e'] != endpoint:
+            return None
+        return str(data['s']), max(0, int(data['o']))
+    except Exception:
+        return None
+
+
+def parse_page_limit():
+    """
+    limitパラメータを取得
+
+    Returns:
+        (limit, error): ページングしない場合limitはNone。不正な値ならerrorにレスポンス
+    """
+    value = request.args.get('limit', '').strip()
+    if not value:
+        return None, None
+    if not value.isdigit() or not 1 <= int(value) <= SPOT_PAGE_MAX:
+        return None, (jsonify({
+            'success': False,
+            'message': f'limitは1〜{SPOT_PAGE_MAX}の整数で指定してください'
+        }), 400)
+    return int(value), None
+
+
+# スポット一覧の出力形式（format=json / columnar / msgpack、fields=で項目を絞り込み）
+SPOT_LIST_FORMATS = ('json', 'columnar', 'msgpack')
+
+
+def parse_spot_format():
+    """
+    format・fieldsパラメータを取得
+
+    Returns:
+        (format, fields, error): fieldsは指定がなければNone。不正な値ならerrorにレスポンス
+    """
+    fmt = request.args.get('format', 'json').strip().lower() or 'json'
+    if fmt not in SPOT_LIST_FORMATS:
+        return None, None, (jsonify({
+            'success': False,
+            'message': f'formatは {" / ".join(SPOT_LIST_FORMATS)} のいずれかを指定してください'
+        }), 400)
+    if fmt == 'msgpack' and msgpack is None:
+        return None, None, (jsonify({
+            'success': False,
+            'message': 'msgpack形式は利用できません（サーバーに msgpack がインストールされていません）'
+        }), 406)
+    fields = [f.strip() for f in request.args.get('fields', '').split(',') if f.strip()]
+    return fmt, list(dict.fromkeys(fields)) or None, None
+
+
+def spot_list_response(result: Dict, status: int = 200):
+    """
+    スポット一覧のレスポンスを指定の形式で返す
+
+    columnar / msgpack は項目名を1回だけ持ち、値を項目ごとの配列にする
+    （{'fields': [...], 'columns': [[...], ...]}。spotsの代わり）
+    """
+    fmt, fields, error = parse_spot_format()
+    if error:
+        return error
+    spots = result.get('spots', [])
+    if fmt == 'json' and not fields:
+        return jsonify(result), status
+
+    present = list(dict.fromkeys(k for spot in spots for k in spot))
+    fields = present if fields is None else [k for k in fields if k in present]
+    payload = {k: v for k, v in result.items() if k != 'spots'}
+    if fmt == 'json':
+        payload['spots'] = [{k: spot[k] for k in fields if k in spot} for spot in spots]
+        return jsonify(payload), status
+
+    payload['format'] = 'columnar'
+    payload['fields'] = fields
+    payload['columns'] = [[spot.get(k) for spot in spots] for k in fields]
+    if fmt == 'msgpack':
+        return Response(msgpack.packb(payload, use_bin_type=True), status=status,
+                        mimetype='application/x-msgpack')
+    return jsonify(payload), status
+
+
+def spot_page_response(snapshot_id: str, result: Dict, offset: int, limit: int):
+    """スナップショットから1ページ分のレスポンスを作る"""
+    spots = result['spots']
+    page = spots[offset:offset + limit]
+    next_offset = offset + len(page)
+    response = {k: v for k, v in result.items() if k not in ('spots', 'count')}
+    response.update({
+        'count': len(page),
+        'total': len(spots),
+        'spots': page,
+        'next_cursor': (encode_spot_cursor(request.endpoint, snapshot_id, next_offset)
+                        if next_offset < len(spots) else None),
+    })
+    return spot_list_response(response)
+
+
+def spot_page_from_cursor(cursor: str, limit: int):
+    """カーソル指定時: Overpass APIに問い合わせずスナップショットから返す（発行したエンドポイントでのみ有効）"""
+    decoded = decode_spot_cursor(cursor, request.endpoint)
+    if decoded is None:
+        return jsonify({'success': False, 'message': 'カーソルが不正です'}), 400
+    snapshot_id, offset = decoded
+    result = spot_snapshots.get(snapshot_id)
+    if result is None:
+        return jsonify({
+            'success': False,
+            'message': 'カーソルの有効期限が切れました。最初から検索し直してください'
+        }), 410
+    return spot_page_response(snapshot_id, result, offset, limit or SPOT_PAGE_MAX)
+
+
+# get_overpass_spots のタグ条件（ローカルPOIストア用。Overpassクエリと同じ条件）
+OVERPASS_SPOTS_LOCAL_FILTERS = (
+    SEARCH_LOCAL_FILTERS['castle'] + SEARCH_LOCAL_FILTERS['buddhist'] + SEARCH_LOCAL_FILTERS['shinto'] +
+    SEARCH_LOCAL_FILTERS['museum'] + SEARCH_LOCAL_FILTERS['gallery'] + SEARCH_LOCAL_FILTERS['theme_park'] +
+    SEARCH_LOCAL_FILTERS['heritage'] + [{'leisure': 'park', 'operator': re.compile('国')}] +
+    SEARCH_LOCAL_FILTERS['theatre'] + SEARCH_LOCAL_FILTERS['restaurant'] + SEARCH_LOCAL_FILTERS['library'] +
+    SEARCH_LOCAL_FILTERS['cinema'] + SEARCH_LOCAL_FILTERS['water_park'] + SEARCH_LOCAL_FILTERS['zoo'] +
+    SEARCH_LOCAL_FILTERS['aquarium'] + SEARCH_LOCAL_FILTERS['viewpoint']
+)
+
+
 @app.route('/api/overpass-spots', methods=['GET'])
+@conditional_json
 def get_overpass_spots():
-    """Overpass APIから厳選された観光スポットのみを取得"""
+    """
+    Overpass APIから厳選された観光スポットのみを取得
+
+    limitを指定するとページング（next_cursorで続きを取得）
+    """
+    limit, error = parse_page_limit()
+    if error:
+        return error
+    _, _, error = parse_spot_format()
+    if error:
+        return error
+    cursor = request.args.get('cursor', '').strip()
+    if cursor:
+        return spot_page_from_cursor(cursor, limit)
+
+    snapshot_id = spot_snapshot_id('overpass-spots', {})
+    if limit:
+        snapshot = spot_snapshots.get(snapshot_id)
+        if snapshot is not None:
+            return spot_page_response(snapshot_id, snapshot, 0, limit)
 
-    overpass_query = """
+    overpass_query = f"""
     [out:json][timeout:25];
     (
       node["historic"="castle"](33.5,134.5,35.8,136.8);
@@ -832,18 +2452,19 @@ def get_overpass_spots():
       node["tourism"="aquarium"](33.5,134.5,35.8,136.8);
       node["tourism"="viewpoint"](33.5,134.5,35.8,136.8);
     );
-    out body 150;
+    {overpass_output_clause(150)}
     """
 
     try:
-        overpass_url = "http://overpass-api.de/api/interpreter"
-        response = requests.post(overpass_url, data={'data': overpass_query}, timeout=30)
+        data = local_poi_query(KANSAI_BBOX, OVERPASS_SPOTS_LOCAL_FILTERS, limit=150)
+        if data is None:
+            data = run_overpass_query(overpass_query, timeout=30)
 
-        if response.status_code != 200:
+        if data is None:
             return jsonify({'success': False, 'message': 'Overpass APIからのデータ取得に失敗しました'}), 500
 
-        data = response.json()
         spots_dict = {}
+        centers = resolve_element_centers(data.get('elements', []))
 
         for element in data.get('elements', []):
             if 'tags' not in element:
@@ -851,8 +2472,7 @@ def get_overpass_spots():
 
             tags = element['tags']
             element_id = element.get('id')
-            lat = element.get('lat') or element.get('center', {}).get('lat')
-            lon = element.get('lon') or element.get('center', {}).get('lon')
+            lat, lon = centers.get((element.get('type'), element_id), (None, None))
             name = tags.get('name:ja') or tags.get('name') or tags.get('name:en')
 
             if not name or name == '名称不明':
@@ -860,47 +2480,11 @@ def get_overpass_spots():
             if len(name) > 40:
                 continue
 
-            bad_keywords = ['詰所', '案内', '地図', '乗り場', '駐車場', 'トイレ',
-                            '入口', '出口', '受付', '売店', 'ゲート', '記念碑']
-            if any(keyword in name for keyword in bad_keywords):
-                continue
-            if any(keyword in str(value) for value in tags.values() for keyword in bad_keywords):
+            if bad_keyword_matcher.matches_element(name, tags):
                 continue
 
             if lat and lon and element_id not in spots_dict:
-                spot_type = 'その他'
-                if tags.get('historic') == 'castle':
-                    spot_type = '城'
-                elif tags.get('religion') == 'buddhist':
-                    spot_type = '寺院'
-                elif tags.get('religion') == 'shinto':
-                    spot_type = '神社'
-                elif tags.get('tourism') == 'museum':
-                    spot_type = '博物館'
-                elif tags.get('tourism') == 'gallery':
-                    spot_type = '美術館'
-                elif tags.get('tourism') == 'theme_park':
-                    spot_type = 'テーマパーク'
-                elif tags.get('heritage') == '1':
-                    spot_type = '世界遺産'
-                elif tags.get('leisure') == 'park':
-                    spot_type = '公園'
-                elif tags.get('amenity') == 'theatre':
-                    spot_type = '劇場'
-                elif tags.get('amenity') in ['restaurant', 'cafe', 'fast_food', 'food_court', 'bar', 'pub']:
-                    spot_type = '飲食店'
-                elif tags.get('amenity') == 'library':
-                    spot_type = '図書館'
-                elif tags.get('amenity') == 'cinema':
-                    spot_type = '映画館'
-                elif tags.get('leisure') == 'water_park':
-                    spot_type = 'ウォーターパーク'
-                elif tags.get('tourism') == 'zoo':
-                    spot_type = '動物園'
-                elif tags.get('tourism') == 'aquarium':
-                    spot_type = '水族館'
-                elif tags.get('tourism') == 'viewpoint':
-                    spot_type = '展望台'
+                spot_type = classify_spot_type(tags)
                 
                 # ✅ websiteを複数の可能性から取得
                 website = (tags.get('website') or 
@@ -931,66 +2515,102 @@ def get_overpass_spots():
 
 
         spots = list(spots_dict.values())
-        return jsonify({'success': True, 'count': len(spots), 'spots': spots}), 200
-
+        result = {'success': True, 'count': len(spots), 'spots': spots}
+        if limit:
+            spot_snapshots.put(snapshot_id, result)
+            return spot_page_response(snapshot_id, result, 0, limit)
+        return spot_list_response(result)
+
+    except OverpassBusyError as e:
+        return overpass_busy_response(e)
     except requests.exceptions.Timeout:
         return jsonify({'success': False, 'message': 'APIリクエストがタイムアウトしました'}), 504
     except Exception as e:
         return jsonify({'success': False, 'message': f'エラーが発生しました: {str(e)}'}), 500
 
+# search_combined の都道府県ごとの境界ボックス
+SEARCH_PREFECTURE_BOUNDS = {
+    'osaka': ((34.3, 135.2, 34.9, 135.8), '大阪府'),
+    'kyoto': ((34.7, 135.0, 35.8, 136.0), '京都府'),
+    'hyogo': ((34.2, 134.2, 35.7, 135.5), '兵庫県'),
+    'nara': ((33.9, 135.6, 34.8, 136.2), '奈良県'),
+    'shiga': ((34.8, 135.8, 35.6, 136.5), '滋賀県'),
+    'wakayama': ((33.4, 135.0, 34.4, 135.9), '和歌山県'),
+}
+
+# search_combined のカテゴリに応じたタグ条件
+SEARCH_CATEGORY_TAGS = {
+    'castle': ('historic', 'castle', '城'),
+    'buddhist': ('religion', 'buddhist', '寺院'),
+    'shinto': ('religion', 'shinto', '神社'),
+    'museum': ('tourism', 'museum', '博物館'),
+    'gallery': ('tourism', 'gallery', '美術館'),
+    'theme_park': ('tourism', 'theme_park', 'テーマパーク'),
+    'heritage': ('heritage', '1', '世界遺産'),
+    'park': ('leisure', 'park', '公園'),
+    'theatre': ('amenity', 'theatre', '劇場'),
+    'restaurant': ('amenity', 'restaurant', '飲食店'),
+    'library': ('amenity', 'library', '図書館'),
+    'cinema': ('amenity', 'cinema', '映画館'),
+    'water_park': ('leisure', 'water_park', 'ウォーターパーク'),
+    'zoo': ('tourism', 'zoo', '動物園'),
+    'aquarium': ('tourism', 'aquarium', '水族館'),
+    'viewpoint': ('tourism', 'viewpoint', '展望台'),
+}
+
+
 @app.route('/api/search-combined', methods=['GET'])
+@conditional_json
 def search_combined():
-    """複数の検索条件を組み合わせて観光スポットを検索"""
-    
+    """
+    複数の検索条件を組み合わせて観光スポットを検索
+
+    limitを指定するとページング（next_cursorで続きを取得）
+    """
+    limit, error = parse_page_limit()
+    if error:
+        return error
+    _, _, error = parse_spot_format()
+    if error:
+        return error
+    cursor = request.args.get('cursor', '').strip()
+    if cursor:
+        return spot_page_from_cursor(cursor, limit)
+
     keyword = request.args.get('keyword', '').strip()
     category = request.args.get('category', '').strip()
     prefecture = request.args.get('prefecture', '').strip()
-    
+
     # すべての条件が空の場合はエラー
     if not keyword and not category and not prefecture:
         return jsonify({
             'success': False,
             'message': '少なくとも1つの検索条件を入力してください'
         }), 400
-    
-    # 都道府県ごとの境界ボックス
-    prefecture_bounds = {
-        'osaka': ((34.3, 135.2, 34.9, 135.8), '大阪府'),
-        'kyoto': ((34.7, 135.0, 35.8, 136.0), '京都府'),
-        'hyogo': ((34.2, 134.2, 35.7, 135.5), '兵庫県'),
-        'nara': ((33.9, 135.6, 34.8, 136.2), '奈良県'),
-        'shiga': ((34.8, 135.8, 35.6, 136.5), '滋賀県'),
-        'wakayama': ((33.4, 135.0, 34.4, 135.9), '和歌山県'),
-    }
-    
-    # カテゴリに応じたタグ条件
-    category_tags = {
-        'castle': ('historic', 'castle', '城'),
-        'buddhist': ('religion', 'buddhist', '寺院'),
-        'shinto': ('religion', 'shinto', '神社'),
-        'museum': ('tourism', 'museum', '博物館'),
-        'gallery': ('tourism', 'gallery', '美術館'),
-        'theme_park': ('tourism', 'theme_park', 'テーマパーク'),
-        'heritage': ('heritage', '1', '世界遺産'),
-        'park': ('leisure', 'park', '公園'),
-        'theatre': ('amenity', 'theatre', '劇場'),
-        'restaurant': ('amenity', 'restaurant', '飲食店'),
-        'library': ('amenity', 'library', '図書館'),
-        'cinema': ('amenity', 'cinema', '映画館'),
-        'water_park': ('leisure', 'water_park', 'ウォーターパーク'),
-        'zoo': ('tourism', 'zoo', '動物園'),
-        'aquarium': ('tourism', 'aquarium', '水族館'),
-        'viewpoint': ('tourism', 'viewpoint', '展望台'),
-    }
-    
-    # 検索範囲を決定
-    if prefecture and prefecture in prefecture_bounds:
-        bounds, prefecture_name = prefecture_bounds[prefecture]
-        min_lat, min_lon, max_lat, max_lon = bounds
-    else:
-        min_lat, min_lon, max_lat, max_lon = 33.5, 134.5, 35.8, 136.8
-        prefecture_name = '近畿地方'
-    
+
+    # 同じ条件のスナップショットがあればOverpass APIに問い合わせない
+    snapshot_id = spot_snapshot_id('search-combined', {
+        'keyword': keyword, 'category': category, 'prefecture': prefecture
+    })
+    if limit:
+        snapshot = spot_snapshots.get(snapshot_id)
+        if snapshot is not None:
+            return spot_page_response(snapshot_id, snapshot, 0, limit)
+
+    result, status = combined_spot_search(keyword, category, prefecture)
+    if status != 200:
+        return search_error_response(result, status)
+    if limit:
+        spot_snapshots.put(snapshot_id, result)
+        return spot_page_response(snapshot_id, result, 0, limit)
+    return spot_list_response(result)
+
+
+def build_search_query(keyword: str, category: str, bounds) -> str:
+    """search_combined のOverpassクエリを組み立てる（キャッシュの先読みでも使用）"""
+    category_tags = SEARCH_CATEGORY_TAGS
+    min_lat, min_lon, max_lat, max_lon = bounds
+
     # Overpass APIクエリを構築
     query_parts = []
     
@@ -1064,35 +2684,91 @@ def search_combined():
         query_parts.append(f'node["tourism"="aquarium"]({min_lat},{min_lon},{max_lat},{max_lon});')
         query_parts.append(f'node["leisure"="water_park"]({min_lat},{min_lon},{max_lat},{max_lon});')
     
-    overpass_query = f"""
+    return f"""
     [out:json][timeout:30];
     (
       {' '.join(query_parts)}
     );
-    out body;
-    >;
-    out skel qt;
+    {overpass_output_clause()}
+    """
+
+
+def overpass_busy_response(error: OverpassBusyError):
+    """Overpass APIの混雑を503（Retry-Afterつき）で返す"""
+    response = jsonify({'success': False, 'message': str(error), 'retry_after': error.retry_after})
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response, 503
+
+
+def search_error_response(result: Dict, status: int):
+    """combined_spot_search のエラーを返す（混雑の場合はRetry-Afterを付ける）"""
+    response = jsonify(result)
+    if result.get('retry_after'):
+        response.headers['Retry-After'] = str(result['retry_after'])
+    return response, status
+
+
+def combined_spot_search(keyword: str, category: str, prefecture: str):
     """
+    search_combined の検索本体（/api/search-spots・/api/search-by-category からも使用）
+
+    Returns:
+        (result, status): レスポンス用の辞書とHTTPステータス
+    """
+    prefecture_bounds = SEARCH_PREFECTURE_BOUNDS
+    category_tags = SEARCH_CATEGORY_TAGS
+    
+    # 検索範囲を決定
+    if prefecture and prefecture in prefecture_bounds:
+        bounds, prefecture_name = prefecture_bounds[prefecture]
+        min_lat, min_lon, max_lat, max_lon = bounds
+    else:
+        min_lat, min_lon, max_lat, max_lon = 33.5, 134.5, 35.8, 136.8
+        prefecture_name = '近畿地方'
+    
+    overpass_query = build_search_query(keyword, category, (min_lat, min_lon, max_lat, max_lon))
     
+    # キーワードなしの検索は形が決まっているのでタイル単位でキャッシュする
+    tiled = not keyword
+
     try:
-        overpass_url = "http://overpass-api.de/api/interpreter"
-        response = requests.post(overpass_url, data={'data': overpass_query}, timeout=60)
-        
-        if response.status_code != 200:
-            return jsonify({
+        # キーワード検索は（ローカルPOIストアから作成済みの）名前の索引で答えられればOverpass APIを使わない
+        data = None
+        if keyword:
+            data = spot_name_index.query((min_lat, min_lon, max_lat, max_lon),
+                                         search_local_filters(keyword, category), keyword,
+                                         coverage_keys=search_coverage_keys(keyword, category,
+                                                                            (min_lat, min_lon, max_lat, max_lon)))
+        # ローカルPOIストアが有効ならOverpass APIを使わずに検索
+        if data is None:
+            data = local_poi_query(
+                (min_lat, min_lon, max_lat, max_lon),
+                search_local_filters(keyword, category),
+                keyword=keyword or None
+            )
+        if data is None:
+            if tiled:
+                data = run_tiled_overpass_query(overpass_query, (min_lat, min_lon, max_lat, max_lon),
+                                                timeout=60, element_filter=is_search_candidate)
+            else:
+                data = run_overpass_query(overpass_query, timeout=60, element_filter=is_search_candidate)
+
+        if data is None:
+            return {
                 'success': False,
                 'message': 'Overpass APIからのデータ取得に失敗しました'
-            }), 500
-        
-        data = response.json()
-        
+            }, 500
+
         # デバッグ: 取得した要素数
         print(f"取得した全要素数: {len(data.get('elements', []))}")
         
         spots_dict = {}
         rejected_count = 0
         rejection_reasons = {}
-        
+
+        # node・way・relationの座標（out center / out geom / ノード再帰、またはキャッシュ済み）
+        centers = resolve_element_centers(data.get('elements', []))
+
         for element in data.get('elements', []):
             if 'tags' not in element:
                 continue
@@ -1120,23 +2796,15 @@ def search_combined():
                 rejection_reasons['名前が長すぎる'] = rejection_reasons.get('名前が長すぎる', 0) + 1
                 continue
             
-            bad_keywords = ['詰所', '案内', '地図', '乗り場', '駐車場', 'トイレ',
-                            '入口', '出口', '受付', '売店', 'ゲート', '記念碑']
-            if any(kw in name for kw in bad_keywords):
+            if bad_keyword_matcher.search(name):
                 rejected_count += 1
                 rejection_reasons['除外キーワード'] = rejection_reasons.get('除外キーワード', 0) + 1
                 continue
 
-            # wayの場合は座標がないので、スキップせずに保存しておく
-            if element_type == 'way':
+            # way・relationは中心座標を使う
+            if element_type in ('way', 'relation'):
                 if element_id not in spots_dict:
-                    spot_type = 'その他'
-                    if tags.get('historic') == 'castle':
-                        spot_type = '城'
-                    elif tags.get('tourism') == 'museum':
-                        spot_type = '博物館'
-                    elif tags.get('tourism') == 'theme_park':
-                        spot_type = 'テーマパーク'
+                    spot_type = classify_spot_type(tags)
                     
                     website = (tags.get('website') or 
                               tags.get('contact:website') or 
@@ -1158,47 +2826,12 @@ def search_combined():
                         'email': tags.get('contact:email', ''),
                         'facebook': tags.get('contact:facebook', ''),
                         'instagram': tags.get('contact:instagram', ''),
-                        'nodes': element.get('nodes', []),
-                        'lat': None,
-                        'lon': None
                     }
+                    spots_dict[element_id]['lat'], spots_dict[element_id]['lon'] = \
+                        centers.get((element_type, element_id), (None, None))
             elif element_type == 'node' and lat and lon:
                 if element_id not in spots_dict:
-                    spot_type = 'その他'
-                    if tags.get('historic') == 'castle':
-                        spot_type = '城'
-                    elif tags.get('religion') == 'buddhist':
-                        spot_type = '寺院'
-                    elif tags.get('religion') == 'shinto':
-                        spot_type = '神社'
-                    elif tags.get('tourism') == 'museum':
-                        spot_type = '博物館'
-                    elif tags.get('tourism') == 'gallery':
-                        spot_type = '美術館'
-                    elif tags.get('tourism') == 'theme_park':
-                        spot_type = 'テーマパーク'
-                    elif tags.get('heritage') == '1':
-                        spot_type = '世界遺産'
-                    elif tags.get('leisure') == 'park':
-                        spot_type = '公園'
-                    elif tags.get('amenity') == 'theatre':
-                        spot_type = '劇場'
-                    elif tags.get('amenity') == 'library':
-                        spot_type = '図書館'
-                    elif tags.get('amenity') == 'cinema':
-                        spot_type = '映画館'
-                    elif tags.get('leisure') == 'water_park':
-                        spot_type = 'ウォーターパーク'
-                    elif tags.get('tourism') == 'zoo':
-                        spot_type = '動物園'
-                    elif tags.get('tourism') == 'aquarium':
-                        spot_type = '水族館'
-                    elif tags.get('tourism') == 'viewpoint':
-                        spot_type = '展望台'
-                    elif tags.get('tourism') == 'attraction':
-                        spot_type = '観光地'
-                    elif tags.get('amenity') in ['restaurant', 'cafe', 'fast_food', 'food_court', 'bar', 'pub']:
-                        spot_type = '飲食店'
+                    spot_type = classify_spot_type(tags)
                     
                     website = (tags.get('website') or 
                               tags.get('contact:website') or 
@@ -1228,45 +2861,24 @@ def search_combined():
         print(f"除外理由: {rejection_reasons}")
         print(f"spots_dictに追加された要素数: {len(spots_dict)}")
         
-        # wayの中心座標を計算（ノード情報から）
-        node_coords = {}
-        for element in data.get('elements', []):
-            if element.get('type') == 'node':
-                node_id = element.get('id')
-                node_coords[node_id] = (element.get('lat'), element.get('lon'))
-        
-        print(f"ノード座標数: {len(node_coords)}")
-        
-        # wayの中心を計算
-        ways_with_coords = 0
+        # 中心座標が求められなかったway・relationは除外
         ways_without_coords = 0
         for spot_id, spot in list(spots_dict.items()):
-            if spot.get('lat') is None and 'nodes' in spot:
-                lats = []
-                lons = []
-                for node_id in spot['nodes']:
-                    if node_id in node_coords:
-                        lat, lon = node_coords[node_id]
-                        if lat and lon:
-                            lats.append(lat)
-                            lons.append(lon)
-                
-                if lats and lons:
-                    spot['lat'] = sum(lats) / len(lats)
-                    spot['lon'] = sum(lons) / len(lons)
-                    del spot['nodes']
-                    ways_with_coords += 1
-                    print(f"Way {spot_id} ({spot['name']}): 中心座標計算成功 ({spot['lat']}, {spot['lon']})")
-                else:
-                    # 座標が計算できない場合は削除
-                    ways_without_coords += 1
-                    print(f"Way {spot_id} ({spot['name']}): 座標計算失敗")
-                    del spots_dict[spot_id]
-        
+            if spot.get('lat') is None:
+                ways_without_coords += 1
+                print(f"Way {spot_id} ({spot['name']}): 座標計算失敗")
+                del spots_dict[spot_id]
+        ways_with_coords = sum(1 for key in centers if key[0] != 'node')
+
         print(f"座標計算成功したway: {ways_with_coords}")
         print(f"座標計算失敗したway: {ways_without_coords}")
         
         spots = [s for s in spots_dict.values() if s.get('lat') and s.get('lon')]
+
+        # タイル結合時は検索範囲外の要素も含まれるので範囲内に絞る
+        if tiled:
+            spots = [s for s in spots
+                     if min_lat <= s['lat'] <= max_lat and min_lon <= s['lon'] <= max_lon]
         
         print(f"最終的なスポット数: {len(spots)}")
         
@@ -1283,26 +2895,79 @@ def search_combined():
         
         print(f"統合検索結果: {len(spots)}件（{condition_text}）")
         
-        return jsonify({
+        result = {
             'success': True,
             'conditions': condition_text,
             'count': len(spots),
             'spots': spots
-        }), 200
+        }
+        return result, 200
         
+    except OverpassBusyError as e:
+        return {
+            'success': False,
+            'message': str(e),
+            'retry_after': e.retry_after
+        }, 503
     except requests.exceptions.Timeout:
-        return jsonify({
+        return {
             'success': False,
             'message': 'APIリクエストがタイムアウトしました'
-        }), 504
+        }, 504
     except Exception as e:
         print(f"統合検索エラー: {e}")
         import traceback
         traceback.print_exc()
-        return jsonify({
+        return {
             'success': False,
             'message': f'エラーが発生しました: {str(e)}'
-        }), 500
+        }, 500
+
+
+@app.route('/api/search-spots', methods=['GET'])
+@conditional_json
+def search_spots():
+    """キーワードで観光スポットを検索（地図画面のキーワード検索）"""
+    query = request.args.get('query', '').strip()
+    if not query:
+        return jsonify({'success': False, 'message': '検索キーワードを入力してください'}), 400
+    _, _, error = parse_spot_format()
+    if error:
+        return error
+
+    result, status = combined_spot_search(query, request.args.get('category', '').strip(),
+                                          request.args.get('prefecture', '').strip())
+    if status != 200:
+        return search_error_response(result, status)
+    return spot_list_response({
+        'success': True,
+        'query': query,
+        'count': result['count'],
+        'spots': result['spots']
+    })
+
+
+@app.route('/api/search-by-category', methods=['GET'])
+@conditional_json
+def search_by_category():
+    """カテゴリで観光スポットを検索（地図画面のカテゴリ検索）"""
+    category = request.args.get('category', '').strip()
+    if category not in SEARCH_CATEGORY_TAGS:
+        return jsonify({'success': False, 'message': 'カテゴリが不正です'}), 400
+    _, _, error = parse_spot_format()
+    if error:
+        return error
+
+    result, status = combined_spot_search('', category, request.args.get('prefecture', '').strip())
+    if status != 200:
+        return search_error_response(result, status)
+    return spot_list_response({
+        'success': True,
+        'category': category,
+        'category_name': SEARCH_CATEGORY_TAGS[category][2],
+        'count': result['count'],
+        'spots': result['spots']
+    })
 #####################################################################################################
 #####################################################################################################
 
@@ -1310,103 +2975,1202 @@ def search_combined():
 
 
 
-#APIからスポット情報取得し、旅行プラン作成
-######################################################################################################
-######################################################################################################
-def fetch_spots_from_overpass(category_keys: List[str], limit: int = 30) -> List[Dict]:
-    """Overpass APIから指定カテゴリーのスポットを取得（分割リクエスト版）"""
-    
-    # ★ カテゴリーごとに分割したクエリ定義
-    category_queries = {
-        'relax': """[out:json][timeout:15];
-(
-  node["leisure"="spa"](34.0,135.0,36.0,136.5);
-  node["amenity"="onsen"](34.0,135.0,36.0,136.5);
-);
-out body 15;""",
-        
-        'nature': """[out:json][timeout:15];
-(
-  node["natural"="peak"](34.0,135.0,36.0,136.5);
-  node["tourism"="viewpoint"](34.0,135.0,36.0,136.5);
-  way["leisure"="park"](34.0,135.0,36.0,136.5);
-);
-out body 15;""",
-        
-        'culture': """[out:json][timeout:15];
-(
-  node["historic"="castle"](34.0,135.0,36.0,136.5);
-  way["historic"="castle"](34.0,135.0,36.0,136.5);
-  node["tourism"="museum"](34.0,135.0,36.0,136.5);
-  way["tourism"="museum"](34.0,135.0,36.0,136.5);
-);
-out body 15;""",
-        
-        'gourmet': """[out:json][timeout:15];
-(
-  node["amenity"="restaurant"](34.5,135.5,35.5,136.0);
-);
-out body 15;""",
-        
-        'activity': """[out:json][timeout:15];
-(
-  node["tourism"="theme_park"](34.0,135.0,36.0,136.5);
-  way["tourism"="theme_park"](34.0,135.0,36.0,136.5);
-  node["tourism"="zoo"](34.0,135.0,36.0,136.5);
-  node["tourism"="aquarium"](34.0,135.0,36.0,136.5);
-);
-out body 15;""",
-        
-        'shopping': """[out:json][timeout:15];
-(
-  node["shop"="mall"](34.0,135.0,36.0,136.5);
-  way["shop"="mall"](34.0,135.0,36.0,136.5);
-);
-out body 15;"""
-    }
+#ローカルPOIストア（OSM抽出データから作成、オフライン検索用）
+########################################################################################################
+########################################################################################################
+
+# 'overpass'（既定）または 'local'。localの場合、ストアがあればOverpass APIを使わない
+SPOT_DATA_SOURCE = os.getenv('SPOT_DATA_SOURCE', 'overpass')
+POI_STORE_PATH = os.getenv('POI_STORE_PATH', os.path.join(BASE_DIR, 'data', 'poi_store.sqlite3'))
+
+# 近畿地方全体の境界ボックス（南, 西, 北, 東）
+KANSAI_BBOX = (33.5, 134.5, 35.8, 136.8)
+
+# 検索条件に使うタグ（poi_tagsテーブルに索引として保存）
+POI_INDEX_KEYS = ('historic', 'tourism', 'amenity', 'leisure', 'religion',
+                  'heritage', 'natural', 'shop')
+
+
+def match_tag_filter(tags: Dict, tag_filter: Dict) -> bool:
+    """タグ条件（SEARCH_LOCAL_FILTERS形式）に一致するか"""
+    for key, expected in tag_filter.items():
+        value = tags.get(key)
+        if value is None:
+            return False
+        if expected is None:
+            continue
+        if isinstance(expected, tuple):
+            if value not in expected:
+                return False
+        elif isinstance(expected, re.Pattern):
+            if not expected.search(value):
+                return False
+        elif value != expected:
+            return False
+    return True
+
+
+def to_poi_record(element: Dict):
+    """
+    Overpass形式の要素をPOIレコードに変換（search_combinedと同じ分類・除外条件）
+
+    Returns:
+        dict: POIレコード（観光スポットとして不適切な場合はNone）
+    """
+    tags = element.get('tags') or {}
+    if not any(key in tags for key in POI_INDEX_KEYS):
+        return None
+
+    name = tags.get('name:ja') or tags.get('name') or tags.get('name:en')
+    if not name or name == '名称不明' or len(name) > 40:
+        return None
+    if bad_keyword_matcher.search(name):
+        return None
+
+    lat = element.get('lat') or (element.get('center') or {}).get('lat')
+    lon = element.get('lon') or (element.get('center') or {}).get('lon')
+    if lat is None or lon is None:
+        return None
+
+    return {
+        'osm_type': element.get('type', 'node'),
+        'osm_id': element['id'],
+        'name': name,
+        'search_name': ' '.join(tags.get(k, '') for k in ('name', 'name:ja', 'name:en')).strip(),
+        'lat': float(lat),
+        'lon': float(lon),
+        'spot_type': classify_spot_type(tags),
+        'tags': tags,
+    }
+
+
+def iter_overpass_dump_elements(path: str):
+    """Overpass JSONダンプから要素を取り出す（wayは中心座標を補完）"""
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+
+    elements = data.get('elements', [])
+    node_coords = {e['id']: (e.get('lat'), e.get('lon')) for e in elements if e.get('type') == 'node'}
+
+    for element in elements:
+        if not element.get('tags'):
+            continue
+        if element.get('type') != 'node' and 'center' not in element:
+            # out geom の場合は geometry、out body; >; の場合は nodes から中心を求める
+            points = [(g['lat'], g['lon']) for g in element.get('geometry', []) if g]
+            if not points:
+                points = [node_coords[n] for n in element.get('nodes', []) if n in node_coords]
+            if not points:
+                continue
+            element = dict(element, center={
+                'lat': sum(p[0] for p in points) / len(points),
+                'lon': sum(p[1] for p in points) / len(points),
+            })
+        yield element
+
+
+def iter_pbf_elements(path: str):
+    """OSM PBFから要素を取り出す（pyosmiumが必要。relationは対象外）"""
+    try:
+        import osmium
+    except ImportError:
+        raise RuntimeError('PBFの読み込みには pyosmium が必要です（pip install osmium）')
+
+    collected = []
+
+    class PoiHandler(osmium.SimpleHandler):
+        def node(self, n):
+            if any(k in n.tags for k in POI_INDEX_KEYS):
+                collected.append({'type': 'node', 'id': n.id, 'lat': n.location.lat,
+                                  'lon': n.location.lon, 'tags': dict(n.tags)})
+
+        def way(self, w):
+            if not any(k in w.tags for k in POI_INDEX_KEYS):
+                return
+            points = [(nd.lat, nd.lon) for nd in w.nodes if nd.location.valid()]
+            if points:
+                collected.append({'type': 'way', 'id': w.id, 'tags': dict(w.tags), 'center': {
+                    'lat': sum(p[0] for p in points) / len(points),
+                    'lon': sum(p[1] for p in points) / len(points),
+                }})
+
+    PoiHandler().apply_file(path, locations=True)
+    return collected
+
+
+class LocalPoiStore:
+    """SQLite（R-tree＋タグ索引）によるローカルPOIストア"""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    @staticmethod
+    def build(path: str, elements, bbox=KANSAI_BBOX, watermark: str = None) -> int:
+        """
+        要素一覧からストアを作り直す（一時ファイルに作成して置き換え）
+
+        Args:
+            watermark: データの時点（ISO 8601、UTC）。以降の変更を sync-pois で取り込む
+        """
+        tmp_path = path + '.tmp'
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+        min_lat, min_lon, max_lat, max_lon = bbox
+        count = 0
+        with closing(sqlite3.connect(tmp_path)) as conn, conn:
+            conn.executescript('''
+                CREATE TABLE pois (
+                    id INTEGER PRIMARY KEY,
+                    osm_type TEXT NOT NULL,
+                    osm_id INTEGER NOT NULL,
+                    name TEXT NOT NULL,
+                    search_name TEXT NOT NULL,
+                    lat REAL NOT NULL,
+                    lon REAL NOT NULL,
+                    spot_type TEXT NOT NULL,
+                    tags TEXT NOT NULL,
+                    UNIQUE (osm_type, osm_id)
+                );
+                CREATE VIRTUAL TABLE pois_rtree USING rtree(id, min_lat, max_lat, min_lon, max_lon);
+                CREATE TABLE poi_tags (poi_id INTEGER NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL);
+            ''')
+            LocalPoiStore._create_sync_table(conn)
+            for element in elements:
+                record = to_poi_record(element)
+                if not record:
+                    continue
+                if not (min_lat <= record['lat'] <= max_lat and min_lon <= record['lon'] <= max_lon):
+                    continue
+                if LocalPoiStore._insert_record(conn, record):
+                    count += 1
+            conn.execute('CREATE INDEX idx_poi_tags ON poi_tags (key, value)')
+            conn.execute('CREATE INDEX idx_pois_spot_type ON pois (spot_type)')
+            if watermark:
+                conn.execute("INSERT OR REPLACE INTO sync_state VALUES ('watermark', ?)", (watermark,))
+
+        os.replace(tmp_path, path)
+        return count
+
+    @staticmethod
+    def _create_sync_table(conn):
+        conn.execute('CREATE TABLE IF NOT EXISTS sync_state (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+
+    @staticmethod
+    def _insert_record(conn, record: Dict) -> bool:
+        """POIレコードを追加（同じOSM要素が既にあれば追加しない）"""
+        cur = conn.execute(
+            '''INSERT OR IGNORE INTO pois (osm_type, osm_id, name, search_name, lat, lon, spot_type, tags)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+            (record['osm_type'], record['osm_id'], record['name'], record['search_name'],
+             record['lat'], record['lon'], record['spot_type'],
+             json.dumps(record['tags'], ensure_ascii=False))
+        )
+        if not cur.rowcount:
+            return False
+        poi_id = cur.lastrowid
+        conn.execute('INSERT INTO pois_rtree VALUES (?, ?, ?, ?, ?)',
+                     (poi_id, record['lat'], record['lat'], record['lon'], record['lon']))
+        conn.executemany('INSERT INTO poi_tags VALUES (?, ?, ?)',
+                         [(poi_id, k, record['tags'][k]) for k in POI_INDEX_KEYS if k in record['tags']])
+        return True
+
+    @staticmethod
+    def _delete_poi(conn, osm_type: str, osm_id: int) -> bool:
+        row = conn.execute('SELECT id FROM pois WHERE osm_type = ? AND osm_id = ?', (osm_type, osm_id)).fetchone()
+        if not row:
+            return False
+        conn.execute('DELETE FROM pois WHERE id = ?', row)
+        conn.execute('DELETE FROM pois_rtree WHERE id = ?', row)
+        conn.execute('DELETE FROM poi_tags WHERE poi_id = ?', row)
+        return True
+
+    def apply_changes(self, upserts: List[Dict], deletes: List[Tuple[str, int]],
+                      watermark: str, bbox=KANSAI_BBOX) -> Dict:
+        """
+        差分を反映して同期時点（watermark）を記録する（1トランザクション）
+
+        Args:
+            upserts: 追加・更新された要素（Overpass形式）。観光スポットでなくなったものは削除
+            deletes: 削除された要素の (type, id)
+
+        Returns:
+            dict: {'added', 'updated', 'deleted'} の件数
+        """
+        min_lat, min_lon, max_lat, max_lon = bbox
+        counts = {'added': 0, 'updated': 0, 'deleted': 0}
+        with closing(self._connect()) as conn, conn:
+            self._create_sync_table(conn)
+            for osm_type, osm_id in deletes:
+                if self._delete_poi(conn, osm_type, osm_id):
+                    counts['deleted'] += 1
+            for element in upserts:
+                existed = self._delete_poi(conn, element.get('type', 'node'), element['id'])
+                record = to_poi_record(element)
+                if record and min_lat <= record['lat'] <= max_lat and min_lon <= record['lon'] <= max_lon:
+                    self._insert_record(conn, record)
+                    counts['updated' if existed else 'added'] += 1
+                elif existed:
+                    counts['deleted'] += 1
+            conn.executemany('INSERT OR REPLACE INTO sync_state VALUES (?, ?)', [
+                ('watermark', watermark),
+                ('last_sync_at', time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())),
+                ('last_changes', json.dumps(counts)),
+            ])
+        return counts
+
+    def sync_state(self) -> Dict:
+        """同期状態（watermark・最終同期日時・直近の変更件数）。読むだけでテーブルは作らない"""
+        with closing(self._connect()) as conn:
+            exists = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sync_state'").fetchone()
+            return dict(conn.execute('SELECT key, value FROM sync_state')) if exists else {}
+
+    def query(self, bbox, tag_filters=None, keyword: str = None, limit: int = None) -> List[Dict]:
+        """
+        境界ボックス内のPOIをOverpass形式の要素として返す
+
+        Args:
+            bbox: (南, 西, 北, 東)
+            tag_filters: タグ条件のリスト（いずれかに一致）。Noneなら全POI
+            keyword: 名前の部分一致
+            limit: 最大件数
+        """
+        min_lat, min_lon, max_lat, max_lon = bbox
+        base_sql = '''SELECT p.id, p.osm_type, p.osm_id, p.lat, p.lon, p.tags
+                      FROM pois p JOIN pois_rtree r ON r.id = p.id
+                      WHERE r.min_lat >= ? AND r.max_lat <= ? AND r.min_lon >= ? AND r.max_lon <= ?'''
+        base_params = [min_lat, max_lat, min_lon, max_lon]
+        if keyword:
+            escaped = keyword.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            base_sql += " AND p.search_name LIKE ? ESCAPE '\\'"
+            base_params.append(f'%{escaped}%')
+
+        # 条件ごとに先頭の一致条件をタグ索引で絞り込み、残りはPythonで判定
+        queries = []
+        for tag_filter in (tag_filters if tag_filters is not None else [None]):
+            if not tag_filter:
+                queries.append((base_sql, base_params, tag_filter))
+                continue
+            key, expected = next(((k, v) for k, v in tag_filter.items() if isinstance(v, (str, tuple))),
+                                 (None, None))
+            if key is None:
+                queries.append((base_sql, base_params, tag_filter))
+                continue
+            values = expected if isinstance(expected, tuple) else (expected,)
+            sql = base_sql + f''' AND p.id IN (SELECT poi_id FROM poi_tags
+                                              WHERE key = ? AND value IN ({','.join('?' * len(values))}))'''
+            queries.append((sql, base_params + [key, *values], tag_filter))
+
+        seen = set()
+        elements = []
+        with closing(self._connect()) as conn:
+            for sql, params, tag_filter in queries:
+                for poi_id, osm_type, osm_id, lat, lon, tags_json in conn.execute(sql, params):
+                    if poi_id in seen:
+                        continue
+                    tags = json.loads(tags_json)
+                    if tag_filter and not match_tag_filter(tags, tag_filter):
+                        continue
+                    seen.add(poi_id)
+                    elements.append(self._to_element(osm_type, osm_id, lat, lon, tags))
+                    if limit and len(elements) >= limit:
+                        return elements
+        return elements
+
+    def iter_elements(self):
+        """全POIをOverpass形式の要素として返す（スポット名索引の作成用）"""
+        with closing(self._connect()) as conn:
+            for osm_type, osm_id, lat, lon, tags_json in conn.execute(
+                    'SELECT osm_type, osm_id, lat, lon, tags FROM pois'):
+                yield self._to_element(osm_type, osm_id, lat, lon, json.loads(tags_json))
+
+    @staticmethod
+    def _to_element(osm_type: str, osm_id: int, lat: float, lon: float, tags: Dict) -> Dict:
+        element = {'type': osm_type, 'id': osm_id, 'tags': tags}
+        if osm_type == 'node':
+            element['lat'], element['lon'] = lat, lon
+        else:
+            element['center'] = {'lat': lat, 'lon': lon}
+        return element
+
+
+_local_poi_store = None
+
+
+def get_local_poi_store():
+    """SPOT_DATA_SOURCE=local かつストアが存在する場合のみストアを返す"""
+    global _local_poi_store
+    if SPOT_DATA_SOURCE != 'local':
+        return None
+    if _local_poi_store is None and os.path.exists(POI_STORE_PATH):
+        _local_poi_store = LocalPoiStore(POI_STORE_PATH)
+        print(f"📦 ローカルPOIストアを使用: {POI_STORE_PATH}")
+    return _local_poi_store
+
+
+def local_poi_query(bbox, tag_filters=None, keyword: str = None, limit: int = None):
+    """
+    ローカルPOIストアを検索してOverpass形式のレスポンスを返す
+
+    Returns:
+        dict: {'elements': [...]}（ストアが使えない場合はNone → Overpass APIを使う）
+    """
+    store = get_local_poi_store()
+    if store is None:
+        return None
+    try:
+        return {'elements': store.query(bbox, tag_filters, keyword=keyword, limit=limit)}
+    except Exception as e:
+        print(f"⚠️ ローカルPOIストア検索エラー（Overpass APIを使用）: {e}")
+        return None
+
+
+# 差分同期（augmented diffで前回同期以降の追加・変更・削除だけを取得）
+POI_SYNC_INTERVAL = int(os.getenv('POI_SYNC_INTERVAL', 60 * 60))   # sync-pois --loop の間隔（秒）
+
+
+def poi_sync_query(watermark: str, bbox=KANSAI_BBOX) -> str:
+    """watermark以降にPOI_INDEX_KEYSのタグを持つ要素で起きた変更を取得するクエリ"""
+    south, west, north, east = bbox
+    return f"""[out:xml][timeout:180][adiff:"{watermark}"];
+(
+  nwr[~"^({'|'.join(POI_INDEX_KEYS)})$"~"."]({south},{west},{north},{east});
+);
+out center;"""
+
+
+def _adiff_element(node) -> Dict:
+    """augmented diffのXML要素をOverpass JSON形式の要素に変換"""
+    element = {
+        'type': node.tag,
+        'id': int(node.get('id')),
+        'tags': {tag.get('k'): tag.get('v') for tag in node.findall('tag')},
+    }
+    if node.get('lat') is not None:
+        element['lat'], element['lon'] = float(node.get('lat')), float(node.get('lon'))
+    center = node.find('center')
+    bounds = node.find('bounds')
+    if center is not None:
+        element['center'] = {'lat': float(center.get('lat')), 'lon': float(center.get('lon'))}
+    elif bounds is not None:
+        element['center'] = {
+            'lat': (float(bounds.get('minlat')) + float(bounds.get('maxlat'))) / 2,
+            'lon': (float(bounds.get('minlon')) + float(bounds.get('maxlon'))) / 2,
+        }
+    return element
+
+
+def parse_overpass_adiff(raw: bytes):
+    """
+    augmented diffを追加・更新と削除に分ける
+
+    条件に合わなくなった要素（タグの削除など）もdeleteとして返される。
+
+    Returns:
+        (upserts, deletes, osm_base): 要素のリスト、(type, id)のリスト、差分の終了時点
+    """
+    root = ElementTree.fromstring(raw)
+    remark = root.find('remark')
+    if remark is not None:
+        raise RuntimeError(f'Overpass APIエラー: {(remark.text or "").strip()}')
+    meta = root.find('meta')
+    osm_base = meta.get('osm_base') if meta is not None else None
+
+    upserts = {}
+    deletes = {}
+    for action in root.findall('action'):
+        kind = action.get('type')
+        if kind == 'create':
+            nodes = list(action)
+        else:
+            new = action.find('new')
+            nodes = list(new) if new is not None else []
+        for node in nodes:
+            if node.tag not in ('node', 'way', 'relation'):
+                continue
+            key = (node.tag, int(node.get('id')))
+            if kind == 'delete' or node.get('visible') == 'false':
+                upserts.pop(key, None)
+                deletes[key] = True
+            else:
+                deletes.pop(key, None)
+                upserts[key] = _adiff_element(node)
+    return list(upserts.values()), list(deletes), osm_base
+
+
+def sync_local_poi_store(path: str = None) -> Dict:
+    """
+    ローカルPOIストアに前回同期以降の変更を反映する
+
+    Returns:
+        dict: {'added', 'updated', 'deleted', 'bytes', 'watermark'}
+    """
+    path = path or POI_STORE_PATH
+    if not os.path.exists(path):
+        raise RuntimeError(f'ローカルPOIストアがありません（flask import-pois で作成してください）: {path}')
+    store = LocalPoiStore(path)
+    watermark = store.sync_state().get('watermark')
+    if not watermark:
+        raise RuntimeError('同期時点が記録されていません（import-pois --since で指定してください）')
+
+    raw = overpass_client.post_raw(poi_sync_query(watermark), timeout=200)
+    if raw is None:
+        raise RuntimeError('Overpass APIから差分を取得できませんでした')
+    upserts, deletes, osm_base = parse_overpass_adiff(raw)
+    counts = store.apply_changes(upserts, deletes, osm_base or watermark)
+
+    # スポット名の索引にも反映（サーバーとは別プロセスの場合、サーバーの索引は
+    # 同期時点の変化を検知して作り直す → SpotNameIndex.check_store_watermark）
+    spot_name_index.remove_elements([(e['type'], e['id']) for e in upserts] + deletes)
+    spot_name_index.add_elements(upserts)
+    spot_name_index.synced_to(osm_base or watermark)
+
+    counts.update({'bytes': len(raw), 'watermark': osm_base or watermark})
+    print(f"🔄 POI差分同期: 追加{counts['added']} / 更新{counts['updated']} / 削除{counts['deleted']}"
+          f"（{len(raw) / 1024:.1f}KB、{watermark} → {counts['watermark']}）")
+    return counts
+
+
+def osm_extract_timestamp(path: str):
+    """
+    OSM抽出データの時点（ISO 8601、UTC）。分からなければNone
+
+    PBFはヘッダーの osmosis_replication_timestamp（なければ timestamp）、
+    Overpass JSONは osm3s.timestamp_osm_base を使う。ファイルの更新日時は
+    ダウンロードした日時でありデータの時点ではないので使わない
+    """
+    if path.endswith('.pbf'):
+        try:
+            import osmium
+        except ImportError:
+            raise RuntimeError('PBFの読み込みには pyosmium が必要です（pip install osmium）')
+        reader = osmium.io.Reader(path, osmium.osm.osm_entity_bits.NOTHING)
+        try:
+            header = reader.header()
+            return header.get('osmosis_replication_timestamp') or header.get('timestamp') or None
+        finally:
+            reader.close()
+    # osm3sはレスポンスの先頭にあるので先頭だけ読む
+    with open(path, 'r', encoding='utf-8') as f:
+        match = re.search(r'"timestamp_osm_base"\s*:\s*"([^"]+)"', f.read(4096))
+    return match.group(1) if match else None
+
+
+@app.cli.command('import-pois')
+@click.argument('path')
+@click.option('--output', default=None, help='出力先（省略時はPOI_STORE_PATH）')
+@click.option('--since', default=None,
+              help='データの時点（例: 2024-05-01T00:00:00Z）。省略時は抽出データに記録された時点。'
+                   'sync-pois はここから差分を取得')
+def import_pois_command(path, output, since):
+    """OSM抽出データ（.osm.pbf またはOverpass JSON）からローカルPOIストアを作成"""
+    output = output or POI_STORE_PATH
+    since = since or osm_extract_timestamp(path)
+    if not since:
+        raise click.ClickException('抽出データに時点が記録されていません（--since で指定してください）')
+    started = time.time()
+    if path.endswith('.pbf'):
+        elements = iter_pbf_elements(path)
+    else:
+        elements = iter_overpass_dump_elements(path)
+    count = LocalPoiStore.build(output, elements, watermark=since)
+    print(f"✅ {count}件のPOIを {output} に保存しました（{time.time() - started:.1f}秒、時点: {since}）")
+
+
+@app.cli.command('sync-pois')
+@click.option('--loop', is_flag=True, help='POI_SYNC_INTERVALごとに繰り返す')
+def sync_pois_command(loop):
+    """
+    前回同期以降の変更だけをOverpass APIから取得してローカルPOIストアに反映
+
+    ストアの検索には次のリクエストから反映される。サーバーのスポット名の索引は
+    SPOT_INDEX_SYNC_CHECK_INTERVALごとに同期時点を確認し、変わっていれば作り直す
+    """
+    while True:
+        try:
+            sync_local_poi_store()
+        except Exception as e:
+            print(f"❌ POI差分同期エラー: {e}")
+            if not loop:
+                raise SystemExit(1)
+        if not loop:
+            break
+        time.sleep(POI_SYNC_INTERVAL)
+
+
+
+#スポット名の索引（キーワード検索用、文字バイグラムの転置索引）
+########################################################################################################
+########################################################################################################
+
+SPOT_INDEX_ENABLED = os.getenv('SPOT_INDEX_ENABLED', 'True') == 'True'
+# ローカルPOIストアの同期時点（別プロセスの sync-pois で更新される）を確認する間隔（秒）
+SPOT_INDEX_SYNC_CHECK_INTERVAL = int(os.getenv('SPOT_INDEX_SYNC_CHECK_INTERVAL', 60))
+
+# 索引の対象にする名前タグ
+SPOT_INDEX_NAME_KEYS = ('name', 'name:ja', 'name:en')
+
+# 比較時に無視する文字（空白・中黒）
+_SEARCH_IGNORE_RE = re.compile(r'[\s・]+')
+
+# カタカナ → ひらがな（「オオサカ」と「おおさか」を同じに扱う）
+_KANA_FOLD = str.maketrans({chr(c): chr(c - 0x60) for c in range(0x30A1, 0x30F7)})
+
+
+def normalize_search_text(text: str) -> str:
+    """検索用の正規化（NFKCで全角・半角をそろえ、カタカナ・大文字小文字・空白の違いを無視）"""
+    text = unicodedata.normalize('NFKC', text).casefold().translate(_KANA_FOLD)
+    return _SEARCH_IGNORE_RE.sub('', text)
+
+
+# 候補表示の重要度（タグ条件ごとの加点。値: None=タグが存在 / 文字列・タプル=一致）
+SPOT_IMPORTANCE_RULES = [
+    ('wikidata', None, 3),
+    ('wikipedia', None, 2),
+    ('heritage', None, 3),
+    ('historic', 'castle', 2),
+    ('tourism', ('theme_park', 'zoo', 'aquarium', 'museum', 'attraction'), 2),
+    ('tourism', ('gallery', 'viewpoint'), 1),
+    ('amenity', 'place_of_worship', 1),
+    ('leisure', ('park', 'water_park'), 1),
+    ('name:en', None, 1),
+    ('website', None, 1),
+]
+
+
+def spot_importance(tags: Dict) -> int:
+    """候補の並び順に使う重要度（有名なスポットほど大きい）"""
+    score = 0
+    for key, expected, points in SPOT_IMPORTANCE_RULES:
+        value = tags.get(key)
+        if value is None:
+            continue
+        if expected is None or value == expected or (isinstance(expected, tuple) and value in expected):
+            score += points
+    return score
+
+
+def search_grams(text: str) -> set:
+    """正規化済み文字列の1文字・2文字のグラム（1文字のキーワードにも対応）"""
+    return set(text) | {text[i:i + 2] for i in range(len(text) - 1)}
+
+
+class SpotNameIndex:
+    """
+    スポット名（name / name:ja / name:en）の文字バイグラム転置索引
+
+    ローカルPOIストアとOverpassキャッシュから作成し、以降はOverpass APIの
+    取得結果を随時追加する。日本語は単語区切りがないためバイグラムで引き、
+    候補を部分一致で確認する。
+    取り込んだOverpassの結果はキャッシュキーと有効期限を覚えておき、
+    キーワード検索を包含するカテゴリ検索のタイルがすべて有効なら索引で答える。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = {}          # (type, id) → 文書番号
+        self._elements = {}     # 文書番号 → Overpass形式の要素
+        self._names = {}        # 文書番号 → 正規化した名前のタプル
+        self._coords = {}       # 文書番号 → (lat, lon)
+        self._postings = {}     # グラム → 文書番号の集合
+        self._prefixes = []     # (正規化した名前, -重要度, 文書番号) の昇順（前方一致の候補用）
+        self._stale_prefixes = 0
+        self._next_doc = 0
+        self.complete = False   # ローカルPOIストアから作成済み（ヒットなしも確定）
+        self._covered = {}      # 取り込み済みのOverpassキャッシュキー → 有効期限
+        self._build_started = False
+        self._store_watermark = None    # 作成に使ったローカルPOIストアの同期時点
+        self._watermark_checked_at = 0.0
+
+    def __len__(self):
+        return len(self._elements)
+
+    def add_elements(self, elements: List[Dict]) -> int:
+        """Overpass形式の要素を追加（同じ要素は置き換え）"""
+        node_coords = {e.get('id'): (e.get('lat'), e.get('lon'))
+                       for e in elements if e.get('type') == 'node' and e.get('lat') is not None}
+        added = 0
+        with self._lock:
+            entries = []
+            for element in elements:
+                if not element.get('tags') or not is_search_candidate(element):
+                    continue
+                lat, lon = element_center(element, node_coords)
+                if lat is None or lon is None:
+                    continue
+                entries.extend(self._add(element, lat, lon))
+                added += 1
+            self._add_prefixes(entries)
+        return added
+
+    def mark_covered(self, cache_key: str, expires_at: float):
+        """Overpassの結果（キャッシュキー）を取り込み済みとして記録"""
+        with self._lock:
+            self._covered[cache_key] = max(expires_at, self._covered.get(cache_key, 0))
+
+    def covers(self, cache_keys: List[str]) -> bool:
+        """指定したOverpassの結果をすべて有効期限内に取り込み済みか"""
+        now = time.time()
+        with self._lock:
+            return all(self._covered.get(k, 0) > now for k in cache_keys)
+
+    def _add_prefixes(self, entries: List[Tuple]):
+        """前方一致用の配列に追加（少量は挿入、まとめて追加する場合は並べ直す）"""
+        if len(entries) > 64:
+            self._prefixes.extend(entries)
+            self._prefixes.sort()
+        else:
+            for entry in entries:
+                insort(self._prefixes, entry)
+        # 置き換えで不要になった項目が半分を超えたら詰める
+        if self._stale_prefixes > len(self._prefixes) // 2:
+            self._prefixes = [e for e in self._prefixes if e[2] in self._elements]
+            self._stale_prefixes = 0
+
+    def _add(self, element: Dict, lat: float, lon: float) -> List[Tuple]:
+        key = (element.get('type'), element.get('id'))
+        doc = self._ids.get(key)
+        if doc is not None:
+            self._remove(doc)
+        doc = self._next_doc
+        self._next_doc += 1
+
+        tags = element['tags']
+        names = tuple(dict.fromkeys(
+            normalize_search_text(tags[k]) for k in SPOT_INDEX_NAME_KEYS if tags.get(k)))
+        compact = {'type': key[0], 'id': key[1], 'tags': tags}
+        if key[0] == 'node':
+            compact['lat'], compact['lon'] = lat, lon
+        else:
+            compact['center'] = {'lat': lat, 'lon': lon}
+
+        self._ids[key] = doc
+        self._elements[doc] = compact
+        self._names[doc] = names
+        self._coords[doc] = (lat, lon)
+        for gram in set().union(*(search_grams(n) for n in names)):
+            self._postings.setdefault(gram, set()).add(doc)
+        importance = spot_importance(tags)
+        return [(n, -importance, doc) for n in names]
+
+    def _remove(self, doc: int):
+        element = self._elements.pop(doc)
+        del self._ids[(element['type'], element['id'])]
+        del self._coords[doc]
+        names = self._names.pop(doc)
+        # 前方一致用の配列からは削除せず、検索時に読み飛ばす
+        self._stale_prefixes += len(names)
+        for gram in set().union(*(search_grams(n) for n in names)):
+            postings = self._postings.get(gram)
+            if postings is not None:
+                postings.discard(doc)
+                if not postings:
+                    del self._postings[gram]
+
+    def search(self, keyword: str, bbox=None, tag_filters=None, limit: int = None) -> List[Dict]:
+        """
+        キーワードを名前に含む要素を返す（完全一致・前方一致・短い名前の順）
+
+        Args:
+            keyword: 検索キーワード
+            bbox: (南, 西, 北, 東)。Noneなら範囲指定なし
+            tag_filters: タグ条件のリスト（いずれかに一致）。Noneなら条件なし
+            limit: 最大件数
+        """
+        text = normalize_search_text(keyword)
+        if not text:
+            return []
+        grams = sorted({text[i:i + 2] for i in range(len(text) - 1)} or {text},
+                       key=lambda g: len(self._postings.get(g, ())))
+
+        with self._lock:
+            candidates = None
+            for gram in grams:
+                postings = self._postings.get(gram)
+                if not postings:
+                    return []
+                candidates = set(postings) if candidates is None else candidates & postings
+                if not candidates:
+                    return []
+
+            ranked = []
+            for doc in candidates:
+                names = self._names[doc]
+                # バイグラムは連続していることまでは保証しないので部分一致で確認
+                if not any(text in n for n in names):
+                    continue
+                if bbox is not None:
+                    lat, lon = self._coords[doc]
+                    if not (bbox[0] <= lat <= bbox[2] and bbox[1] <= lon <= bbox[3]):
+                        continue
+                element = self._elements[doc]
+                if tag_filters is not None and not any(
+                        match_tag_filter(element['tags'], f) for f in tag_filters):
+                    continue
+                if text in names:
+                    rank = 0
+                elif any(n.startswith(text) for n in names):
+                    rank = 1
+                else:
+                    rank = 2
+                ranked.append((rank, min(len(n) for n in names), doc, element))
+
+        ranked.sort(key=lambda r: r[:3])
+        elements = [r[3] for r in ranked]
+        return elements[:limit] if limit else elements
+
+    def suggest(self, prefix: str, limit: int = 10) -> List[Dict]:
+        """
+        名前が前方一致する要素を重要度の高い順に返す（入力途中の候補表示用）
+
+        Args:
+            prefix: 入力中の文字列
+            limit: 最大件数
+        """
+        text = normalize_search_text(prefix)
+        if not text:
+            return []
+        with self._lock:
+            prefixes = self._prefixes
+            lo = bisect_left(prefixes, (text,))
+            hi = bisect_left(prefixes, (text + '\U0010ffff',), lo)
+            best = {}
+            for i in range(lo, hi):
+                name, neg_importance, doc = prefixes[i]
+                if doc not in self._elements:
+                    continue
+                rank = (neg_importance, len(name), doc)
+                if doc not in best or rank < best[doc]:
+                    best[doc] = rank
+            top = heapq.nsmallest(limit, best.values())
+            return [self._elements[doc] for _, _, doc in top]
+
+    def query(self, bbox, tag_filters, keyword: str, limit: int = None, coverage_keys: List[str] = None):
+        """
+        索引でキーワード検索してOverpass形式のレスポンスを返す
+
+        使用中のローカルPOIストアから作成し終えた索引（complete）か、検索範囲を
+        覆うOverpassの結果（coverage_keys）をすべて取り込み済みの場合だけが検索結果を
+        網羅するので、それ以外はヒットがあっても答えない
+
+        Args:
+            coverage_keys: キーワード検索を包含するOverpass検索のキャッシュキー一覧
+
+        Returns:
+            dict: {'elements': [...]}（索引で答えられない場合はNone → 他の方法で検索）
+        """
+        if not SPOT_INDEX_ENABLED:
+            return None
+        self.ensure_built()
+        if not self.complete and not (coverage_keys and self.covers(coverage_keys)):
+            return None
+        started = time.time()
+        elements = self.search(keyword, bbox, tag_filters, limit)
+        print(f"🔎 スポット名索引で検索: 「{keyword}」{len(elements)}件（{(time.time() - started) * 1000:.1f}ms）")
+        return {'elements': elements}
+
+    def remove_elements(self, keys):
+        """(type, id) で指定した要素を索引から削除"""
+        with self._lock:
+            for key in keys:
+                doc = self._ids.get(tuple(key))
+                if doc is not None:
+                    self._remove(doc)
+
+    def ensure_built(self):
+        """初回利用時に裏で索引を作成（作成中も追加済みの分で検索できる）"""
+        with self._lock:
+            built = self._build_started
+            self._build_started = True
+        if built:
+            self.check_store_watermark()
+            return
+        threading.Thread(target=self.build, daemon=True).start()
+
+    def synced_to(self, watermark: str):
+        """同じプロセスでストアの差分を反映済み（作り直しは不要）"""
+        with self._lock:
+            if self._store_watermark is not None:
+                self._store_watermark = watermark
+
+    def check_store_watermark(self):
+        """
+        ローカルPOIストアが別プロセスの sync-pois で更新されていたら裏で作り直す
+
+        SPOT_INDEX_SYNC_CHECK_INTERVALごとに同期時点を読むだけなので、検索のたびには確認しない
+        """
+        now = time.time()
+        with self._lock:
+            if self._store_watermark is None or now - self._watermark_checked_at < SPOT_INDEX_SYNC_CHECK_INTERVAL:
+                return
+            self._watermark_checked_at = now
+        store = get_local_poi_store()
+        if store is None:
+            return
+        try:
+            watermark = store.sync_state().get('watermark')
+        except sqlite3.Error as e:
+            print(f"⚠️ ローカルPOIストアの同期状態の読み込みエラー: {e}")
+            return
+        with self._lock:
+            if watermark == self._store_watermark:
+                return
+            print(f"🔄 ローカルPOIストアが更新されたのでスポット名索引を作り直します: "
+                  f"{self._store_watermark} → {watermark}")
+            self._store_watermark = watermark
+        threading.Thread(target=self.rebuild, daemon=True).start()
+
+    def rebuild(self):
+        """新しい索引を作成して中身を入れ替える（作成中は古い索引で検索する）"""
+        fresh = SpotNameIndex()
+        fresh.build()
+        with self._lock, fresh._lock:
+            for name in ('_ids', '_elements', '_names', '_coords', '_postings', '_prefixes',
+                         '_stale_prefixes', '_next_doc', '_covered', 'complete', '_store_watermark'):
+                setattr(self, name, getattr(fresh, name))
+
+    def build(self):
+        """ローカルPOIストアとOverpassキャッシュから索引を作成"""
+        started = time.time()
+        try:
+            # SPOT_DATA_SOURCE=local で使用中のストアから作った場合だけ網羅的とみなす
+            store = get_local_poi_store()
+            if store is not None:
+                # 読み始める前の同期時点を覚える（読んでいる間に同期されたら次の確認で作り直す）
+                self._store_watermark = store.sync_state().get('watermark') or ''
+                self._watermark_checked_at = time.time()
+                batch = []
+                for element in store.iter_elements():
+                    batch.append(element)
+                    if len(batch) >= 5000:
+                        self.add_elements(batch)
+                        batch = []
+                self.add_elements(batch)
+                self.complete = True
+            if overpass_cache is not None:
+                for key, expires_at, data in overpass_cache.iter_payloads():
+                    self.add_elements(data.get('elements', []))
+                    self.mark_covered(key, expires_at)
+            print(f"✅ スポット名索引を作成: {len(self)}件（{time.time() - started:.1f}秒）")
+        except Exception as e:
+            print(f"⚠️ スポット名索引の作成エラー: {e}")
+
+
+spot_name_index = SpotNameIndex()
+
+# 候補表示の件数
+SPOT_SUGGEST_LIMIT = int(os.getenv('SPOT_SUGGEST_LIMIT', 10))
+SPOT_SUGGEST_MAX = 50
+
+
+@app.route('/api/spots/suggest', methods=['GET'])
+def suggest_spots():
+    """入力途中のスポット名の候補を返す（Overpass APIには問い合わせない）"""
+    q = request.args.get('q', '').strip()
+    limit = request.args.get('limit', '').strip()
+    if limit and (not limit.isdigit() or not 1 <= int(limit) <= SPOT_SUGGEST_MAX):
+        return jsonify({
+            'success': False,
+            'message': f'limitは1〜{SPOT_SUGGEST_MAX}の整数で指定してください'
+        }), 400
+    limit = int(limit) if limit else SPOT_SUGGEST_LIMIT
+
+    if SPOT_INDEX_ENABLED:
+        spot_name_index.ensure_built()
+    elements = spot_name_index.suggest(q, limit) if q else []
+
+    suggestions = []
+    for element in elements:
+        tags = element['tags']
+        lat, lon = element_center(element)
+        suggestions.append({
+            'id': element['id'],
+            'name': tags.get('name:ja') or tags.get('name') or tags.get('name:en'),
+            'type': classify_spot_type(tags),
+            'lat': lat,
+            'lon': lon,
+        })
+    return jsonify({'success': True, 'query': q, 'count': len(suggestions), 'suggestions': suggestions}), 200
+
+
+#APIからスポット情報取得し、旅行プラン作成
+######################################################################################################
+######################################################################################################
+# fetch_spots_from_overpass のカテゴリー定義（OverpassクエリとローカルPOIストアの条件をここから作る）
+#   bbox: (南, 西, 北, 東) / limit: カテゴリーごとの out N / selectors: (要素の種類, タグ条件)
+SPOT_CATEGORY_DEFS = {
+    'relax': {
+        'bbox': (34.0, 135.0, 36.0, 136.5), 'limit': 15,
+        'selectors': [('node', {'leisure': 'spa'}), ('node', {'amenity': 'onsen'})],
+    },
+    'nature': {
+        'bbox': (34.0, 135.0, 36.0, 136.5), 'limit': 15,
+        'selectors': [('node', {'natural': 'peak'}), ('node', {'tourism': 'viewpoint'}), ('way', {'leisure': 'park'})],
+    },
+    'culture': {
+        'bbox': (34.0, 135.0, 36.0, 136.5), 'limit': 15,
+        'selectors': [('node', {'historic': 'castle'}), ('way', {'historic': 'castle'}),
+                      ('node', {'tourism': 'museum'}), ('way', {'tourism': 'museum'})],
+    },
+    'gourmet': {
+        'bbox': (34.5, 135.5, 35.5, 136.0), 'limit': 15,
+        'selectors': [('node', {'amenity': 'restaurant'})],
+    },
+    'activity': {
+        'bbox': (34.0, 135.0, 36.0, 136.5), 'limit': 15,
+        'selectors': [('node', {'tourism': 'theme_park'}), ('way', {'tourism': 'theme_park'}),
+                      ('node', {'tourism': 'zoo'}), ('node', {'tourism': 'aquarium'})],
+    },
+    'shopping': {
+        'bbox': (34.0, 135.0, 36.0, 136.5), 'limit': 15,
+        'selectors': [('node', {'shop': 'mall'}), ('way', {'shop': 'mall'})],
+    },
+}
+
+# ローカルPOIストア用の条件（要素の種類を除いたタグ条件）
+CATEGORY_LOCAL_FILTERS = {
+    cat_key: (d['bbox'], [dict(f) for f in dict.fromkeys(tuple(f.items()) for _, f in d['selectors'])])
+    for cat_key, d in SPOT_CATEGORY_DEFS.items()
+}
+
+# クエリ計画（カテゴリーをまとめて1回で取得するか、分けて並列に取得するか）
+OVERPASS_PLAN_TARGET_LATENCY = float(os.getenv('OVERPASS_PLAN_TARGET_LATENCY', 5.0))  # 1クエリの目標秒数
+OVERPASS_PLAN_MAX_ELEMENTS = int(os.getenv('OVERPASS_PLAN_MAX_ELEMENTS', 2000))       # 1クエリの要素数の上限
+OVERPASS_PLAN_DEFAULT_LATENCY = float(os.getenv('OVERPASS_PLAN_DEFAULT_LATENCY', 3.0))  # 未計測カテゴリーの見込み秒数
+
+
+def overpass_selector(element_type: str, tag_filter: Dict, bbox) -> str:
+    """(要素の種類, タグ条件) をOverpass QLの1文にする"""
+    parts = []
+    for key, expected in tag_filter.items():
+        if expected is None:
+            parts.append(f'["{key}"]')
+        elif isinstance(expected, tuple):
+            parts.append(f'["{key}"~"^({"|".join(expected)})$"]')
+        else:
+            parts.append(f'["{key}"="{expected}"]')
+    return f'{element_type}{"".join(parts)}({",".join(str(v) for v in bbox)});'
+
+
+def build_category_query(cat_keys: List[str]) -> str:
+    """
+    カテゴリーのクエリを組み立てる
+
+    複数カテゴリーをまとめる場合はカテゴリーごとに名前付きセットに入れ、
+    それぞれに out N を付ける（件数の多いカテゴリーが他を押し出さない）。
+    """
+    if len(cat_keys) == 1:
+        d = SPOT_CATEGORY_DEFS[cat_keys[0]]
+        selectors = '\n'.join(f'  {overpass_selector(t, f, d["bbox"])}' for t, f in d['selectors'])
+        return f"""[out:json][timeout:15];
+(
+{selectors}
+);
+{overpass_output_clause(d['limit'])}"""
+
+    blocks = []
+    for cat_key in cat_keys:
+        d = SPOT_CATEGORY_DEFS[cat_key]
+        selectors = '\n'.join(f'  {overpass_selector(t, f, d["bbox"])}' for t, f in d['selectors'])
+        blocks.append(f"""(
+{selectors}
+)->.{cat_key};
+{overpass_output_clause(d['limit'], cat_key)}""")
+    return '[out:json][timeout:25];\n' + '\n'.join(blocks)
+
+
+def build_category_queries() -> Dict[str, str]:
+    """fetch_spots_from_overpass のカテゴリーごとのクエリ（キャッシュの先読みでも使用）"""
+    return {cat_key: build_category_query([cat_key]) for cat_key in SPOT_CATEGORY_DEFS}
+
+
+def category_of_element(element: Dict, cat_keys: List[str]):
+    """要素がどのカテゴリーの条件に一致したか（統計用。一致しなければNone）"""
+    tags = element.get('tags') or {}
+    for cat_key in cat_keys:
+        for element_type, tag_filter in SPOT_CATEGORY_DEFS[cat_key]['selectors']:
+            if element.get('type') == element_type and match_tag_filter(tags, tag_filter):
+                return cat_key
+    return None
+
+
+def requested_spot_type(element: Dict, cat_keys: List[str]) -> str:
+    """
+    スポットタイプを判定（複数の種類のタグを持つ要素は、取得したカテゴリーの条件になったタグを優先）
+
+    例: leisure=spa と tourism=attraction を持つ要素をrelaxで取得した場合は「温泉」
+    """
+    tags = element.get('tags') or {}
+    spot_type = classify_spot_type(tags)
+    cat_key = category_of_element(element, cat_keys)
+    if cat_key is None or determine_category_key(spot_type) == cat_key:
+        return spot_type
+    for element_type, tag_filter in SPOT_CATEGORY_DEFS[cat_key]['selectors']:
+        if element.get('type') == element_type and match_tag_filter(tags, tag_filter):
+            return classify_spot_type(tag_filter, spot_type)
+    return spot_type
+
+
+def overpass_query_cached(query: str, element_filter=None) -> bool:
+    """キャッシュから（期限切れでも再取得を待たずに）返せるクエリか"""
+    if overpass_cache is None:
+        return False
+    try:
+        remaining = overpass_cache.expires_in(overpass_cache_key(query, element_filter))
+    except Exception:
+        return False
+    return remaining is not None and remaining > -OVERPASS_CACHE_STALE_TTL
+
+
+class CategoryQueryStats:
+    """カテゴリーごとの応答時間・要素数の指数移動平均（クエリ計画に使用）"""
+
+    def __init__(self, alpha: float):
+        self.alpha = alpha
+        self.latency = {}
+        self.size = {}
+        self._lock = threading.Lock()
+
+    def _update(self, table: Dict, cat_key: str, value: float):
+        old = table.get(cat_key)
+        table[cat_key] = value if old is None else self.alpha * value + (1 - self.alpha) * old
+
+    def record(self, cat_keys: List[str], latency: float, elements: List[Dict]):
+        """1回のクエリの結果を記録（まとめたクエリは要素数の比で時間を按分）"""
+        counts = {k: 0 for k in cat_keys}
+        for element in elements:
+            cat_key = category_of_element(element, cat_keys)
+            if cat_key:
+                counts[cat_key] += 1
+        total = sum(counts.values())
+        with self._lock:
+            for cat_key in cat_keys:
+                share = counts[cat_key] / total if total else 1 / len(cat_keys)
+                self._update(self.latency, cat_key, latency * share)
+                self._update(self.size, cat_key, counts[cat_key])
+
+    def estimate(self, cat_key: str) -> Tuple[float, float]:
+        """(見込み秒数, 見込み要素数)"""
+        with self._lock:
+            return (self.latency.get(cat_key, OVERPASS_PLAN_DEFAULT_LATENCY),
+                    self.size.get(cat_key, SPOT_CATEGORY_DEFS[cat_key]['limit']))
+
+    def status(self) -> Dict:
+        with self._lock:
+            return {k: {'latency': round(self.latency[k], 2), 'size': round(self.size.get(k, 0), 1)}
+                    for k in self.latency}
+
+
+category_query_stats = CategoryQueryStats(OVERPASS_EWMA_ALPHA)
+
+
+def plan_category_queries(cat_keys: List[str]) -> List[List[str]]:
+    """
+    カテゴリーをクエリ単位のグループに分ける
+
+    - キャッシュ済みのカテゴリーは単独のクエリのまま（キャッシュを使う）
+    - 残りは見込み秒数の大きい順に、合計が目標秒数（最も遅いカテゴリーがそれより遅ければ
+      その秒数）と要素数の上限に収まるようにまとめる。並列に取得したときの所要時間を
+      延ばさずに往復回数とスロットの使用を減らす
+    """
+    cached = [k for k in cat_keys if overpass_query_cached(build_category_query([k]))]
+    rest = [k for k in cat_keys if k not in cached]
+    estimates = {k: category_query_stats.estimate(k) for k in rest}
+    budget = max([OVERPASS_PLAN_TARGET_LATENCY] + [estimates[k][0] for k in rest])
+
+    groups = []
+    for cat_key in sorted(rest, key=lambda k: -estimates[k][0]):
+        latency, size = estimates[cat_key]
+        for group in groups:
+            if (group['latency'] + latency <= budget
+                    and group['size'] + size <= OVERPASS_PLAN_MAX_ELEMENTS):
+                group['keys'].append(cat_key)
+                group['latency'] += latency
+                group['size'] += size
+                break
+        else:
+            groups.append({'keys': [cat_key], 'latency': latency, 'size': size})
+
+    order = {k: i for i, k in enumerate(cat_keys)}
+    planned = [[k] for k in cached] + [sorted(g['keys'], key=order.get) for g in groups]
+    return sorted(planned, key=lambda g: order[g[0]])
+
+
+def fetch_spots_from_overpass(category_keys: List[str], limit: int = 30,
+                              max_workers: int = None, deadline: float = None) -> List[Dict]:
+    """Overpass APIから指定カテゴリーのスポットを取得（クエリ計画に従ってまとめる・分ける）"""
     
     print(f"\n{'='*60}")
-    print(f"🔍 Overpass APIクエリ実行（分割版）")
+    print(f"🔍 Overpass APIクエリ実行")
     print(f"📊 対象カテゴリー: {category_keys}")
     print(f"{'='*60}\n")
     
+    target_keys = [k for k in dict.fromkeys(category_keys) if k in SPOT_CATEGORY_DEFS]
+    max_workers = max_workers or OVERPASS_MAX_CONCURRENCY
+    deadline = deadline or OVERPASS_FETCH_DEADLINE
+
+    # ★ ローカルPOIストアがなければ、統計をもとにカテゴリーをクエリ単位にまとめる
+    if get_local_poi_store() is None:
+        plan = plan_category_queries(target_keys)
+    else:
+        plan = [[k] for k in target_keys]
+    if plan:
+        print(f"🧭 クエリ計画: {' / '.join('+'.join(g) for g in plan)}")
+
+    def fetch_group(group):
+        print(f"🔄 カテゴリー '{'+'.join(group)}' を取得中...")
+        if len(group) == 1:
+            bbox, tag_filters = CATEGORY_LOCAL_FILTERS[group[0]]
+            data = local_poi_query(bbox, tag_filters, limit=SPOT_CATEGORY_DEFS[group[0]]['limit'])
+            if data is not None:
+                return data
+        query = build_category_query(group)
+        cached = overpass_query_cached(query)
+        started = time.time()
+        data = run_overpass_query(query, timeout=20 if len(group) == 1 else 30)
+        # キャッシュから返した場合は応答時間の統計に入れない
+        if data is not None and not cached and 'remark' not in data:
+            category_query_stats.record(group, time.time() - started, data.get('elements', []))
+        return data
+
+    results = {}
+    if plan:
+        executor = ThreadPoolExecutor(max_workers=min(max_workers, len(plan)))
+        futures = {executor.submit(fetch_group, g): tuple(g) for g in plan}
+        done, not_done = wait(futures, timeout=deadline)
+        # 期限内に終わらなかったカテゴリーは待たずに諦める
+        executor.shutdown(wait=False, cancel_futures=True)
+
+        for future in not_done:
+            print(f"  ⏱️ カテゴリー '{'+'.join(futures[future])}' は{deadline}秒以内に完了せず")
+
+        for future in done:
+            group = futures[future]
+            try:
+                results[group] = future.result()
+            except Exception as e:
+                print(f"  ❌ カテゴリー '{'+'.join(group)}' エラー: {e}")
+
+    # 従来と同じ順序（カテゴリー指定順）で結合し、後段でID重複を除く
     all_elements = []
-    overpass_url = "http://overpass-api.de/api/interpreter"
-    
-    # ★ カテゴリーごとに個別リクエスト
-    for cat_key in category_keys:
-        if cat_key not in category_queries:
-            continue
-        
-        query = category_queries[cat_key]
-        
-        print(f"🔄 カテゴリー '{cat_key}' を取得中...")
-        
-        try:
-            response = requests.post(
-                overpass_url,
-                data={'data': query},
-                timeout=20
-            )
-            
-            if response.status_code != 200:
-                print(f"  ❌ ステータス {response.status_code}")
-                continue
-            
-            data = response.json()
-            elements = data.get('elements', [])
-            
-            print(f"  ✅ {len(elements)}件取得")
-            
-            if 'remark' in data:
-                print(f"  ⚠️ remark: {data['remark']}")
-            
-            all_elements.extend(elements)
-            
-        except Exception as e:
-            print(f"  ❌ エラー: {e}")
+    for group in plan:
+        data = results.get(tuple(group))
+        if data is None:
             continue
-    
+
+        elements = data.get('elements', [])
+        print(f"  ✅ '{'+'.join(group)}': {len(elements)}件取得")
+
+        if 'remark' in data:
+            print(f"  ⚠️ remark: {data['remark']}")
+
+        all_elements.extend(elements)
+
     print(f"\n📦 合計取得: {len(all_elements)}件")
     
     if not all_elements:
@@ -1417,14 +4181,15 @@ out body 15;"""
     spots_dict = {}
     stats = {'filtered': 0, 'no_name': 0, 'no_coords': 0}
     
+    centers = resolve_element_centers(all_elements)
+
     for element in all_elements:
         tags = element.get('tags', {})
         if not tags:
             continue
-        
+
         element_id = element.get('id')
-        lat = element.get('lat') or element.get('center', {}).get('lat')
-        lon = element.get('lon') or element.get('center', {}).get('lon')
+        lat, lon = centers.get((element.get('type'), element_id), (None, None))
         
         if not lat or not lon:
             stats['no_coords'] += 1
@@ -1439,45 +4204,15 @@ out body 15;"""
             stats['filtered'] += 1
             continue
         
-        bad_keywords = ['詰所', '案内', '駐車場', 'トイレ', '入口', '出口', '売店', 
-                       'ゲート', '記念碑', '乗り場', '受付']
-        if any(kw in name for kw in bad_keywords):
+        if bad_keyword_matcher.search(name):
             stats['filtered'] += 1
             continue
         
         if element_id in spots_dict:
             continue
         
-        # スポットタイプ判定
-        spot_type = 'その他'
-        if tags.get('historic') == 'castle':
-            spot_type = '城'
-        elif tags.get('religion') == 'buddhist':
-            spot_type = '寺院'
-        elif tags.get('religion') == 'shinto':
-            spot_type = '神社'
-        elif tags.get('tourism') == 'museum':
-            spot_type = '博物館'
-        elif tags.get('tourism') == 'theme_park':
-            spot_type = 'テーマパーク'
-        elif tags.get('tourism') == 'zoo':
-            spot_type = '動物園'
-        elif tags.get('tourism') == 'aquarium':
-            spot_type = '水族館'
-        elif tags.get('tourism') == 'viewpoint':
-            spot_type = '展望台'
-        elif tags.get('leisure') == 'park':
-            spot_type = '公園'
-        elif tags.get('leisure') == 'spa':
-            spot_type = '温泉'
-        elif tags.get('amenity') == 'onsen':
-            spot_type = '温泉'
-        elif tags.get('amenity') == 'restaurant':
-            spot_type = 'レストラン'
-        elif tags.get('natural') == 'peak':
-            spot_type = '山'
-        elif tags.get('shop') == 'mall':
-            spot_type = 'ショッピングモール'
+        # スポットタイプ判定（取得したカテゴリーのタグを優先）
+        spot_type = requested_spot_type(element, target_keys)
         
         category = map_type_to_category(spot_type)
         category_key = determine_category_key(spot_type)
@@ -1518,6 +4253,140 @@ out body 15;"""
     
     return spots
 
+
+#Overpassキャッシュの先読み（よく使うクエリを期限切れ前に再取得）
+########################################################################################################
+########################################################################################################
+
+OVERPASS_WARM_ENABLED = os.getenv('OVERPASS_WARM_ENABLED', 'False') == 'True'    # アプリ内で定期実行するか
+OVERPASS_WARM_TARGETS = [t.strip() for t in os.getenv('OVERPASS_WARM_TARGETS', 'categories,prefectures').split(',') if t.strip()]
+OVERPASS_WARM_INTERVAL = int(os.getenv('OVERPASS_WARM_INTERVAL', 10 * 60))      # 確認する間隔（秒）
+OVERPASS_WARM_MARGIN = int(os.getenv('OVERPASS_WARM_MARGIN', 2 * 60 * 60))      # 期限切れのこの秒数前から再取得
+OVERPASS_WARM_STAGGER = float(os.getenv('OVERPASS_WARM_STAGGER', 3))            # 取得ごとの間隔（秒）
+OVERPASS_WARM_START_DELAY = float(os.getenv('OVERPASS_WARM_START_DELAY', 30))   # 起動後に待つ秒数
+
+
+def overpass_warm_jobs() -> List[Tuple[str, List[Tuple[str, int, object]]]]:
+    """
+    先読みするクエリ一覧
+
+    Returns:
+        list: [(ジョブ名, [(クエリ, タイムアウト, element_filter), ...]), ...]
+    """
+    jobs = []
+    if 'categories' in OVERPASS_WARM_TARGETS:
+        for cat_key, query in build_category_queries().items():
+            jobs.append((f'category:{cat_key}', [(query, 20, None)]))
+    if 'prefectures' in OVERPASS_WARM_TARGETS:
+        # search_combined の都道府県のみの検索（タイル単位でキャッシュされる）
+        for prefecture, (bounds, _) in SEARCH_PREFECTURE_BOUNDS.items():
+            query = build_search_query('', '', bounds)
+            tile_queries = overpass_tile_queries(query, bounds) or [query]
+            jobs.append((f'prefecture:{prefecture}', [(q, 60, is_search_candidate) for q in tile_queries]))
+    return jobs
+
+
+class OverpassCacheWarmer:
+    """
+    決まった形のクエリを期限切れ前に裏で再取得し、ユーザーの検索が常にキャッシュに当たるようにする
+
+    取得は低い優先度で1件ずつ間隔を空けて行う（Overpassのスロットを使い切らない）。
+    """
+
+    def __init__(self, interval: int, margin: int, stagger: float):
+        self.interval = interval
+        self.margin = margin
+        self.stagger = stagger
+        self.jobs = {}          # ジョブ名 → 直近の実行結果
+        self.last_run = None
+        self.next_run = None
+        self.running = False
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def run_once(self) -> Dict:
+        """すべてのジョブを1回実行（期限まで余裕のあるキャッシュは取得しない）"""
+        if overpass_cache is None or get_local_poi_store() is not None:
+            return {}
+        with self._lock:
+            if self.running:
+                return {}
+            self.running = True
+        started = time.time()
+        try:
+            for name, queries in overpass_warm_jobs():
+                result = {'queries': len(queries), 'refreshed': 0, 'fresh': 0, 'failed': 0, 'error': None}
+                for query, timeout, element_filter in queries:
+                    key = overpass_cache_key(query, element_filter)
+                    try:
+                        remaining = overpass_cache.expires_in(key)
+                        if remaining is not None and remaining > self.margin:
+                            result['fresh'] += 1
+                            continue
+                        data = _fetch_and_store(key, query, timeout, OVERPASS_CACHE_TTL,
+                                                element_filter, OVERPASS_PRIORITY_BACKGROUND)
+                        result['refreshed' if data is not None else 'failed'] += 1
+                    except Exception as e:
+                        result['failed'] += 1
+                        result['error'] = str(e)
+                    time.sleep(self.stagger)
+                result['finished_at'] = time.time()
+                self.jobs[name] = result
+                if result['refreshed'] or result['failed']:
+                    print(f"🔥 キャッシュ先読み {name}: 再取得{result['refreshed']}件、失敗{result['failed']}件")
+        finally:
+            self.last_run = started
+            self.running = False
+        return self.jobs
+
+    def start(self):
+        """アプリ内で定期実行を開始"""
+        if self._thread is not None:
+            return
+
+        def loop():
+            time.sleep(OVERPASS_WARM_START_DELAY)
+            while True:
+                try:
+                    self.run_once()
+                except Exception as e:
+                    print(f"⚠️ キャッシュ先読みエラー: {e}")
+                self.next_run = time.time() + self.interval
+                time.sleep(self.interval)
+
+        self.next_run = time.time() + OVERPASS_WARM_START_DELAY
+        self._thread = threading.Thread(target=loop, daemon=True)
+        self._thread.start()
+        print(f"🔥 キャッシュ先読みを開始（{self.interval}秒ごと、対象: {', '.join(OVERPASS_WARM_TARGETS)}）")
+
+    def status(self) -> Dict:
+        return {
+            'enabled': self._thread is not None,
+            'running': self.running,
+            'last_run': self.last_run,
+            'next_run': self.next_run,
+            'jobs': dict(self.jobs),
+        }
+
+
+overpass_warmer = OverpassCacheWarmer(OVERPASS_WARM_INTERVAL, OVERPASS_WARM_MARGIN, OVERPASS_WARM_STAGGER)
+if OVERPASS_WARM_ENABLED:
+    overpass_warmer.start()
+
+
+@app.cli.command('warm-cache')
+@click.option('--loop', is_flag=True, help='OVERPASS_WARM_INTERVALごとに繰り返す（別プロセスで先読みする場合）')
+def warm_cache_command(loop):
+    """よく使うOverpassクエリを先読みしてキャッシュする"""
+    while True:
+        jobs = overpass_warmer.run_once()
+        for name, result in jobs.items():
+            print(f"  {name}: 再取得{result['refreshed']} / 有効{result['fresh']} / 失敗{result['failed']}")
+        if not loop:
+            break
+        time.sleep(OVERPASS_WARM_INTERVAL)
+
+
 def get_recommended_spots_from_api(analysis: Dict, num_spots: int = 6) -> List[Dict]:
     """Overpass APIを使ってスポットを推薦（配分ロジック改善版）"""
     print(f"\n{'='*60}")
@@ -1701,6 +4570,12 @@ def api_recommend():
             'message': 'すべての質問に回答してください'
         }), 400
     
+    # 宿（任意）: hotels=lat,lon[,名前];... 1泊ごと
+    hotels, error = parse_hotels_param(request.args.get('hotels', ''))
+    if error:
+        return jsonify({'success': False, 'message': error}), 400
+    answers['hotels'] = hotels
+    
     try:
         # 分析
         analysis = analyze_answers(answers)
@@ -1736,31 +4611,7 @@ def api_recommend():
 
 def determine_spot_type(tags: Dict) -> str:
     """タグからスポットタイプを判定"""
-    if tags.get('historic') == 'castle':
-        return '城'
-    elif tags.get('religion') == 'buddhist':
-        return '寺院'
-    elif tags.get('religion') == 'shinto':
-        return '神社'
-    elif tags.get('tourism') == 'museum':
-        return '博物館'
-    elif tags.get('tourism') == 'theme_park':
-        return 'テーマパーク'
-    elif tags.get('tourism') == 'zoo':
-        return '動物園'
-    elif tags.get('tourism') == 'aquarium':
-        return '水族館'
-    elif tags.get('tourism') == 'viewpoint':
-        return '展望台'
-    elif tags.get('natural') in ['peak', 'beach']:
-        return '自然'
-    elif tags.get('leisure') == 'spa':
-        return '温泉'
-    elif tags.get('amenity') == 'restaurant':
-        return 'レストラン'
-    elif tags.get('shop') == 'mall':
-        return 'ショッピングモール'
-    return '観光地'
+    return classify_spot_type(tags, default='観光地')
 
 
 def map_type_to_category(spot_type: str) -> str:
@@ -1773,7 +4624,14 @@ def map_type_to_category(spot_type: str) -> str:
         '寺院': '文化・歴史',
         '神社': '文化・歴史',
         '博物館': '文化・歴史',
+        '美術館': '文化・歴史',
+        '世界遺産': '文化・歴史',
+        '観光地': '文化・歴史',
+        '山': '自然・景色',
+        'ビーチ': '自然・景色',
+        '公園': '自然・景色',
         'レストラン': 'グルメ',
+        '飲食店': 'グルメ',
         'ショッピングモール': 'ショッピング',
         'テーマパーク': 'アクティビティ',
         '動物園': 'アクティビティ',
@@ -1795,6 +4653,8 @@ def determine_category_key(spot_type: str) -> str:
         '神社': 'culture',
         '博物館': 'culture',
         '美術館': 'culture',
+        '世界遺産': 'culture',
+        '観光地': 'culture',
         'レストラン': 'gourmet',
         '飲食店': 'gourmet',
         'ショッピングモール': 'shopping',
@@ -1815,7 +4675,10 @@ def get_emoji_for_type(spot_type: str) -> str:
         '寺院': '🏯',
         '神社': '⛩️',
         '博物館': '🏛️',
+        '山': '⛰️',
+        'ビーチ': '🏖️',
         'レストラン': '🍽️',
+        '飲食店': '🍽️',
         'ショッピングモール': '🛍️',
         'テーマパーク': '🎢',
         '動物園': '🦁',
@@ -1915,6 +4778,701 @@ def calculate_distance(lat1, lon1, lat2, lon2):
     return round(distance, 2)  # 小数点2桁で四捨五入
 
 
+#距離行列（まとめて計算）
+##################################################
+##################################################
+
+try:
+    import numpy as np  # あれば距離行列をベクトル化して計算（pip install numpy）
+except ImportError:
+    np = None
+
+EARTH_RADIUS_KM = 6371  # 地球の半径（km）
+
+
+def spot_latlon(spot: Dict):
+    """スポットの (lat, lon) を返す。座標がなければNone"""
+    if 'lat' in spot and 'lon' in spot and spot['lat'] is not None and spot['lon'] is not None:
+        return float(spot['lat']), float(spot['lon'])
+    return None
+
+
+def _haversine_pairs(lats1, lons1, lats2, lons2) -> List[float]:
+    """
+    対応する地点同士の距離（km、小数点2桁）を一括で計算
+
+    numpyがあればブロードキャストして1回で計算する（引数は配列でもスカラーでもよい）
+    """
+    if np is not None:
+        lat1, lon1, lat2, lon2 = (np.radians(np.asarray(v, dtype=float))
+                                  for v in (lats1, lons1, lats2, lons2))
+        a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+        a = np.clip(a, 0.0, 1.0)
+        return np.round(2 * EARTH_RADIUS_KM * np.arctan2(np.sqrt(a), np.sqrt(1 - a)), 2)
+    return [calculate_distance(a, b, c, d) for a, b, c, d in zip(lats1, lons1, lats2, lons2)]
+
+
+def distance_matrix(spots: List[Dict]) -> List[List[float]]:
+    """
+    スポット全組の距離行列（km）を作成
+
+    座標がないスポットを含む組は math.inf（calculate_distanceと同じく小数点2桁）
+
+    Returns:
+        list: matrix[i][j] が spots[i] → spots[j] の距離
+    """
+    n = len(spots)
+    coords = [spot_latlon(s) for s in spots]
+    valid = [i for i, c in enumerate(coords) if c]
+    matrix = [[math.inf] * n for _ in range(n)]
+    if not valid:
+        return matrix
+
+    if np is not None:
+        lats = np.array([coords[i][0] for i in valid])
+        lons = np.array([coords[i][1] for i in valid])
+        sub = _haversine_pairs(lats[:, None], lons[:, None], lats[None, :], lons[None, :]).tolist()
+        if len(valid) == n:
+            return sub
+        for row, i in zip(sub, valid):
+            for value, j in zip(row, valid):
+                matrix[i][j] = value
+        return matrix
+
+    # numpy無し: 対称なので上三角だけ計算
+    for a, i in enumerate(valid):
+        matrix[i][i] = 0.0
+        for j in valid[a + 1:]:
+            d = calculate_distance(coords[i][0], coords[i][1], coords[j][0], coords[j][1])
+            matrix[i][j] = matrix[j][i] = d
+    return matrix
+
+
+def distances_from(lat: float, lon: float, spots: List[Dict]) -> List[float]:
+    """1地点から各スポットまでの距離（km）をまとめて計算（座標がなければ math.inf）"""
+    coords = [spot_latlon(s) for s in spots]
+    valid = [i for i, c in enumerate(coords) if c]
+    result = [math.inf] * len(spots)
+    if not valid:
+        return result
+    values = _haversine_pairs([lat] * len(valid), [lon] * len(valid),
+                              [coords[i][0] for i in valid], [coords[i][1] for i in valid])
+    for i, d in zip(valid, values):
+        result[i] = float(d)
+    return result
+
+
+def route_leg_distances(spots: List[Dict]) -> List[float]:
+    """順番に回った時の各区間の距離（km）。どちらかに座標がない区間は math.inf"""
+    if len(spots) < 2:
+        return []
+    coords = [spot_latlon(s) for s in spots]
+    legs = [i for i in range(len(spots) - 1) if coords[i] and coords[i + 1]]
+    result = [math.inf] * (len(spots) - 1)
+    if not legs:
+        return result
+    values = _haversine_pairs([coords[i][0] for i in legs], [coords[i][1] for i in legs],
+                              [coords[i + 1][0] for i in legs], [coords[i + 1][1] for i in legs])
+    for i, d in zip(legs, values):
+        result[i] = float(d)
+    return result
+
+
+def route_length(order: List[int], matrix: List[List[float]]) -> float:
+    """距離行列上で order の順に回った時の合計距離（座標がない区間は数えない）"""
+    return sum(d for d in (matrix[a][b] for a, b in zip(order, order[1:])) if d != math.inf)
+
+
+#道路網による移動時間（OSM抽出データから作成、ALTランドマーク）
+##################################################
+##################################################
+
+import bz2
+from array import array
+
+ROAD_GRAPH_PATH = os.getenv('ROAD_GRAPH_PATH', os.path.join(BASE_DIR, 'data', 'road_graph.sqlite3'))
+ROUTE_USE_ROAD_NETWORK = os.getenv('ROUTE_USE_ROAD_NETWORK', 'False') == 'True'
+ROAD_LANDMARKS = int(os.getenv('ROAD_LANDMARKS', '8'))  # ALTのランドマーク数
+ROAD_SNAP_MAX_KM = float(os.getenv('ROAD_SNAP_MAX_KM', '2'))  # これより道路から遠い地点は直線距離で計算
+ROAD_SNAP_SPEED_KMH = 15  # 地点から最寄りの交差点までの移動速度
+ROAD_ROUTE_CACHE_SIZE = int(os.getenv('ROAD_ROUTE_CACHE_SIZE', '100000'))
+ROAD_SEARCH_MAX_MINUTES = float(os.getenv('ROAD_SEARCH_MAX_MINUTES', '300'))  # これより遠い組は探索を打ち切る
+ROAD_GRID_DEG = 0.01  # 最寄り交差点の検索に使う格子（約1km）
+
+# 道路種別ごとの平均速度（km/h）。ここにない highway は対象外
+ROAD_SPEED_KMH = {
+    'motorway': 80, 'motorway_link': 50,
+    'trunk': 60, 'trunk_link': 40,
+    'primary': 45, 'primary_link': 35,
+    'secondary': 40, 'secondary_link': 30,
+    'tertiary': 35, 'tertiary_link': 25,
+    'unclassified': 30, 'road': 25, 'residential': 25,
+    'living_street': 10, 'service': 15,
+}
+
+
+def road_way_speed(tags: Dict):
+    """道路のwayなら平均速度（km/h）、通行できない・対象外ならNone"""
+    speed = ROAD_SPEED_KMH.get(tags.get('highway'))
+    if speed is None or tags.get('area') == 'yes' or tags.get('access') in ('no', 'private'):
+        return None
+    maxspeed = re.match(r'\d+', tags.get('maxspeed', ''))
+    if maxspeed:
+        speed = min(speed, int(maxspeed.group()))
+    return speed
+
+
+def road_way_direction(tags: Dict) -> int:
+    """1: 順方向のみ / -1: 逆方向のみ / 0: 双方向"""
+    oneway = tags.get('oneway')
+    if oneway == '-1':
+        return -1
+    if oneway in ('yes', '1', 'true') or tags.get('junction') == 'roundabout':
+        return 1
+    if oneway is None and tags.get('highway') == 'motorway':
+        return 1
+    return 0
+
+
+def _haversine_m(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """2地点間の距離（m、丸めなし）"""
+    lat1, lon1, lat2, lon2 = map(radians, (lat1, lon1, lat2, lon2))
+    a = sin((lat2 - lat1) / 2) ** 2 + cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * 1000 * atan2(sqrt(a), sqrt(1 - a))
+
+
+def read_osm_roads(path: str):
+    """
+    OSM抽出データ（.osm / .osm.gz / .osm.bz2、または .osm.pbf）から道路を読み込む
+
+    Returns:
+        (coords, ways): coordsはノードID → (lat, lon)、waysは (ノードIDのリスト, タグ) のリスト
+    """
+    coords = {}
+    ways = []
+    if path.endswith('.pbf'):
+        try:
+            import osmium
+        except ImportError:
+            raise RuntimeError('PBFの読み込みには pyosmium が必要です（pip install osmium）')
+
+        class RoadHandler(osmium.SimpleHandler):
+            def way(self, w):
+                tags = dict(w.tags)
+                if road_way_speed(tags) is None:
+                    return
+                refs = []
+                for nd in w.nodes:
+                    if nd.location.valid():
+                        coords[nd.ref] = (nd.lat, nd.lon)
+                        refs.append(nd.ref)
+                ways.append((refs, tags))
+
+        RoadHandler().apply_file(path, locations=True)
+        return coords, ways
+
+    opener = gzip.open if path.endswith('.gz') else bz2.open if path.endswith('.bz2') else open
+
+    def iter_elements(tag):
+        """tag（node / way）の要素を順に返す（読み終えた要素はすぐ解放）"""
+        with opener(path, 'rb') as f:
+            root = None
+            for event, elem in ElementTree.iterparse(f, events=('start', 'end')):
+                if root is None:
+                    root = elem
+                if event != 'end' or elem.tag not in ('node', 'way', 'relation'):
+                    continue
+                if elem.tag == tag:
+                    yield elem
+                root.clear()
+
+    # 1回目は道路のwayだけを読み、2回目はその道路が使うノードの座標だけを読む
+    used = set()
+    for elem in iter_elements('way'):
+        tags = {t.get('k'): t.get('v') for t in elem.iter('tag')}
+        if road_way_speed(tags) is not None:
+            refs = [int(nd.get('ref')) for nd in elem.iter('nd')]
+            used.update(refs)
+            ways.append((refs, tags))
+    for elem in iter_elements('node'):
+        node_id = int(elem.get('id'))
+        if node_id in used:
+            coords[node_id] = (float(elem.get('lat')), float(elem.get('lon')))
+    return coords, ways
+
+
+def _dijkstra_all(adj: List[List[Tuple]], source: int) -> List[float]:
+    """sourceから全ノードへの最短時間（到達できなければ math.inf）"""
+    dist = [math.inf] * len(adj)
+    dist[source] = 0.0
+    heap = [(0.0, source)]
+    while heap:
+        d, u = heapq.heappop(heap)
+        if d > dist[u]:
+            continue
+        for v, seconds in adj[u]:
+            nd = d + seconds
+            if nd < dist[v]:
+                dist[v] = nd
+                heapq.heappush(heap, (nd, v))
+    return dist
+
+
+class RoadNetwork:
+    """
+    OSMの道路網（交差点間に縮約したグラフ）で移動時間・道のりを求める
+
+    事前計算したランドマークからの最短時間（ALT: A*, Landmarks, Triangle inequality）を
+    下界に使ったA*で2地点間を検索する。結果はLRUでキャッシュする
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with closing(sqlite3.connect(path)) as conn:
+            rows = conn.execute('SELECT id, lat, lon FROM nodes ORDER BY id').fetchall()
+            self.lat = array('d', (row[1] for row in rows))
+            self.lon = array('d', (row[2] for row in rows))
+            self.adj = [[] for _ in rows]
+            for src, dst, seconds, meters in conn.execute('SELECT src, dst, seconds, meters FROM edges'):
+                self.adj[src].append((dst, seconds, meters))
+            self.landmarks = []
+            for forward_blob, backward_blob in conn.execute(
+                    'SELECT forward, backward FROM landmarks ORDER BY k'):
+                forward, backward = array('d'), array('d')
+                forward.frombytes(forward_blob)
+                backward.frombytes(backward_blob)
+                self.landmarks.append((forward, backward))
+            self.meta = dict(conn.execute('SELECT key, value FROM meta'))
+
+        self.grid = {}
+        for i, (lat, lon) in enumerate(zip(self.lat, self.lon)):
+            self.grid.setdefault((int(lat // ROAD_GRID_DEG), int(lon // ROAD_GRID_DEG)), []).append(i)
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.settled = 0        # 複数target探索で確定させたノード数の累計
+
+    def __len__(self):
+        return len(self.adj)
+
+    @staticmethod
+    def build(osm_path: str, output: str, landmarks: int = ROAD_LANDMARKS) -> Dict:
+        """
+        OSM抽出データから道路グラフを作成（一時ファイルに作成して置き換え）
+
+        交差点と行き止まりだけをノードとして残し、間の区間は1本の辺（所要秒数・m）にまとめる。
+        最大の連結成分だけを残し、ランドマークは既存のランドマークから最も遠いノードを順に選ぶ
+        """
+        coords, ways = read_osm_roads(osm_path)
+
+        # 2本以上のwayで使われるノード・wayの端点を交差点として残す
+        usage = {}
+        for refs, _ in ways:
+            for ref in refs:
+                usage[ref] = usage.get(ref, 0) + 1
+        keep = set()
+        for refs, _ in ways:
+            if refs:
+                keep.add(refs[0])
+                keep.add(refs[-1])
+        keep.update(ref for ref, count in usage.items() if count > 1)
+
+        edges = {}
+        for refs, tags in ways:
+            refs = [ref for ref in refs if ref in coords]
+            if len(refs) < 2:
+                continue
+            speed = road_way_speed(tags) / 3.6  # m/s
+            direction = road_way_direction(tags)
+            start, meters = refs[0], 0.0
+            for prev, ref in zip(refs, refs[1:]):
+                meters += _haversine_m(*coords[prev], *coords[ref])
+                if ref not in keep and ref != refs[-1]:
+                    continue
+                if start != ref:
+                    seconds = meters / speed
+                    pairs = [(start, ref)] if direction == 1 else [(ref, start)] if direction == -1 \
+                        else [(start, ref), (ref, start)]
+                    for pair in pairs:
+                        if pair not in edges or seconds < edges[pair][0]:
+                            edges[pair] = (seconds, meters)
+                start, meters = ref, 0.0
+
+        # 最大の連結成分（向きを無視）だけを残す
+        parent = {}
+
+        def find(x):
+            while parent.setdefault(x, x) != x:
+                parent[x] = parent[parent[x]]
+                x = parent[x]
+            return x
+
+        for a, b in edges:
+            ra, rb = find(a), find(b)
+            if ra != rb:
+                parent[ra] = rb
+        sizes = {}
+        for node in parent:
+            root = find(node)
+            sizes[root] = sizes.get(root, 0) + 1
+        if not sizes:
+            raise RuntimeError('道路が見つかりませんでした')
+        largest = max(sizes, key=sizes.get)
+        osm_ids = sorted(node for node in parent if find(node) == largest)
+        index = {osm_id: i for i, osm_id in enumerate(osm_ids)}
+        edge_rows = [(index[a], index[b], seconds, meters)
+                     for (a, b), (seconds, meters) in edges.items() if a in index and b in index]
+
+        forward_adj = [[] for _ in osm_ids]
+        backward_adj = [[] for _ in osm_ids]
+        for a, b, seconds, _ in edge_rows:
+            forward_adj[a].append((b, seconds))
+            backward_adj[b].append((a, seconds))
+
+        # ランドマーク選択（最初は任意のノードから、以降は既存ランドマークから最も遠いノード）
+        chosen = []
+        nearest = _dijkstra_all(forward_adj, 0)
+        for _ in range(min(landmarks, len(osm_ids))):
+            candidate = max(range(len(osm_ids)),
+                            key=lambda v: nearest[v] if nearest[v] != math.inf else -1.0)
+            if any(candidate == node for node, _, _ in chosen):
+                break
+            forward = _dijkstra_all(forward_adj, candidate)
+            backward = _dijkstra_all(backward_adj, candidate)
+            chosen.append((candidate, forward, backward))
+            nearest = forward if len(chosen) == 1 else [min(a, b) for a, b in zip(nearest, forward)]
+
+        tmp_path = output + '.tmp'
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+        with closing(sqlite3.connect(tmp_path)) as conn, conn:
+            conn.executescript('''
+                CREATE TABLE nodes (id INTEGER PRIMARY KEY, osm_id INTEGER NOT NULL,
+                                    lat REAL NOT NULL, lon REAL NOT NULL);
+                CREATE TABLE edges (src INTEGER NOT NULL, dst INTEGER NOT NULL,
+                                    seconds REAL NOT NULL, meters REAL NOT NULL);
+                CREATE TABLE landmarks (k INTEGER PRIMARY KEY, node INTEGER NOT NULL,
+                                        forward BLOB NOT NULL, backward BLOB NOT NULL);
+                CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+            ''')
+            conn.executemany('INSERT INTO nodes VALUES (?, ?, ?, ?)',
+                             ((i, osm_id, *coords[osm_id]) for i, osm_id in enumerate(osm_ids)))
+            conn.executemany('INSERT INTO edges VALUES (?, ?, ?, ?)', edge_rows)
+            conn.executemany('INSERT INTO landmarks VALUES (?, ?, ?, ?)',
+                             ((k, node, array('d', forward).tobytes(), array('d', backward).tobytes())
+                              for k, (node, forward, backward) in enumerate(chosen)))
+            conn.executemany('INSERT INTO meta VALUES (?, ?)', [
+                ('source', os.path.basename(osm_path)),
+                ('built_at', time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())),
+            ])
+        os.replace(tmp_path, output)
+        return {'nodes': len(osm_ids), 'edges': len(edge_rows), 'landmarks': len(chosen),
+                'ways': len(ways)}
+
+    def snap(self, lat: float, lon: float):
+        """最寄りのノード (node, km)。ROAD_SNAP_MAX_KM以内になければNone"""
+        cy, cx = int(lat // ROAD_GRID_DEG), int(lon // ROAD_GRID_DEG)
+        reach = int(ROAD_SNAP_MAX_KM / (ROAD_GRID_DEG * 111 * cos(radians(lat)))) + 1
+        kx = cos(radians(lat))
+        best = None
+        for dy in range(-reach, reach + 1):
+            for dx in range(-reach, reach + 1):
+                for node in self.grid.get((cy + dy, cx + dx), ()):
+                    d2 = (self.lat[node] - lat) ** 2 + ((self.lon[node] - lon) * kx) ** 2
+                    if best is None or d2 < best[1]:
+                        best = (node, d2)
+        if best is None:
+            return None
+        km = _haversine_m(lat, lon, self.lat[best[0]], self.lon[best[0]]) / 1000
+        return (best[0], km) if km <= ROAD_SNAP_MAX_KM else None
+
+    def _lower_bound(self, v: int, target: int) -> float:
+        """ランドマークと三角不等式による v → target の所要時間の下界"""
+        bound = 0.0
+        for forward, backward in self.landmarks:
+            a, b = forward[target], forward[v]
+            if a != math.inf and b != math.inf and a - b > bound:
+                bound = a - b
+            a, b = backward[v], backward[target]
+            if a != math.inf and b != math.inf and a - b > bound:
+                bound = a - b
+        return bound
+
+    def route(self, source: int, target: int):
+        """ノード間の最短 (秒, m)。到達できなければNone"""
+        if source == target:
+            return 0.0, 0.0
+        return self._pair_costs({source: {target}})[(source, target)]
+
+    def _alt_search(self, source: int, target: int):
+        """1組だけのA*（ランドマークの下界を使う）"""
+        dist = {source: 0.0}
+        meters = {source: 0.0}
+        heap = [(self._lower_bound(source, target), source)]
+        closed = set()
+        result = None
+        while heap:
+            _, u = heapq.heappop(heap)
+            if u in closed:
+                continue
+            if u == target:
+                result = (dist[u], meters[u])
+                break
+            closed.add(u)
+            du = dist[u]
+            for v, seconds, length in self.adj[u]:
+                nd = du + seconds
+                if nd < dist.get(v, math.inf):
+                    dist[v] = nd
+                    meters[v] = meters[u] + length
+                    heapq.heappush(heap, (nd + self._lower_bound(v, target), v))
+        return result
+
+    def _set_lower_bound(self, targets: set):
+        """
+        target群のいずれかまでの所要時間の下界 h(v) を返す関数
+
+        ランドマークごとの下界（targetについての最小・最大は先に求めておく）と、
+        target群を囲む矩形までの直線距離 ÷ 最高速度の大きい方。どれも整合的なので
+        A*で取り出したノードの時間は確定している
+        """
+        bounds = []
+        for forward, backward in self.landmarks:
+            to_targets = [forward[t] for t in targets]
+            from_targets = [backward[t] for t in targets]
+            bounds.append((forward, backward,
+                           min(to_targets), max(from_targets) if math.inf not in from_targets else math.inf))
+        lats = [self.lat[t] for t in targets]
+        lons = [self.lon[t] for t in targets]
+        south, north, west, east = min(lats), max(lats), min(lons), max(lons)
+        # 直線距離は道のり以下・速度は最高速度以下なので下界になる（近似誤差の分だけ縮める）
+        seconds_per_m = 0.95 / (max(ROAD_SPEED_KMH.values()) / 3.6)
+        lat_arr, lon_arr = self.lat, self.lon
+
+        def lower_bound(v: int) -> float:
+            bound = 0.0
+            for forward, backward, min_to, max_from in bounds:
+                a = forward[v]
+                if min_to != math.inf and a != math.inf and min_to - a > bound:
+                    bound = min_to - a
+                a = backward[v]
+                if max_from != math.inf and a != math.inf and a - max_from > bound:
+                    bound = a - max_from
+            lat, lon = lat_arr[v], lon_arr[v]
+            clamped_lat = south if lat < south else north if lat > north else lat
+            clamped_lon = west if lon < west else east if lon > east else lon
+            if clamped_lat != lat or clamped_lon != lon:
+                geometric = _haversine_m(lat, lon, clamped_lat, clamped_lon) * seconds_per_m
+                if geometric > bound:
+                    bound = geometric
+            return bound
+
+        return lower_bound
+
+    def _one_to_many(self, source: int, targets: set) -> Dict:
+        """
+        sourceからtarget群へのA*（下界はtarget群までのランドマーク・矩形の下界）
+
+        全targetが確定するか、下界を足してもROAD_SEARCH_MAX_MINUTESを超えるノードだけに
+        なったら打ち切る。target群から離れる方向のノードは後回しになるので、
+        打ち切りなしのダイクストラ法より確定させるノードが少ない
+
+        Returns:
+            dict: target → (秒, m)（届かなかったtargetは含まない）
+        """
+        remaining = set(targets)
+        limit = ROAD_SEARCH_MAX_MINUTES * 60
+        lower_bound = self._set_lower_bound(remaining)
+        dist = {source: 0.0}
+        meters = {source: 0.0}
+        heap = [(lower_bound(source), source)]
+        settled = set()
+        found = {}
+        while heap and remaining:
+            f, u = heapq.heappop(heap)
+            if u in settled:
+                continue
+            if f > limit:
+                break
+            settled.add(u)
+            du = dist[u]
+            if u in remaining:
+                found[u] = (du, meters[u])
+                remaining.discard(u)
+            for v, seconds, length in self.adj[u]:
+                nd = du + seconds
+                if nd < dist.get(v, math.inf):
+                    dist[v] = nd
+                    meters[v] = meters[u] + length
+                    heapq.heappush(heap, (nd + lower_bound(v), v))
+        self.settled += len(settled)
+        return found
+
+    def _pair_costs(self, requests: Dict) -> Dict:
+        """
+        {source: {target, ...}} の各組の (秒, m) をまとめて求める（到達できなければNone）
+
+        キャッシュにない組は、targetが1つならALTのA*、複数ならtarget群へのA*を
+        出発ノードごとに1回だけ実行する
+        """
+        results = {}
+        missing = {}
+        with self._lock:
+            for source, targets in requests.items():
+                for target in targets:
+                    key = (source, target)
+                    if key in self._cache:
+                        self._cache.move_to_end(key)
+                        self.hits += 1
+                        results[key] = self._cache[key]
+                    else:
+                        missing.setdefault(source, set()).add(target)
+
+        for source, targets in missing.items():
+            if len(targets) == 1:
+                target = next(iter(targets))
+                computed = {(source, target): self._alt_search(source, target)}
+            else:
+                found = self._one_to_many(source, targets)
+                computed = {(source, target): found.get(target) for target in targets}
+            results.update(computed)
+            with self._lock:
+                self.misses += len(computed)
+                self._cache.update(computed)
+                while len(self._cache) > ROAD_ROUTE_CACHE_SIZE:
+                    self._cache.popitem(last=False)
+        return results
+
+    def _snap_points(self, points: List[Dict]) -> List:
+        return [self.snap(*c) if c else None for c in (spot_latlon(p) for p in points)]
+
+    @staticmethod
+    def _with_access(found, a, b):
+        """ノード間の (秒, m) に地点 ↔ 交差点の移動を足して (分, km) にする"""
+        if found is None:
+            return None
+        access_km = a[1] + b[1]
+        return found[0] / 60 + access_km / ROAD_SNAP_SPEED_KMH * 60, found[1] / 1000 + access_km
+
+    def travel_matrix(self, points: List[Dict]) -> List[List]:
+        """
+        地点の全組について道路での (所要分, km) の行列を計算（出発地点ごとに1回の探索）
+
+        Returns:
+            list: matrix[i][j] が (分, km)。道路から遠い・同じ交差点に寄る・到達できない組はNone
+        """
+        snapped = self._snap_points(points)
+        requests = {}
+        for a in snapped:
+            for b in snapped:
+                if a and b and a[0] != b[0]:
+                    requests.setdefault(a[0], set()).add(b[0])
+        costs = self._pair_costs(requests)
+        return [[self._with_access(costs[(a[0], b[0])], a, b)
+                 if i != j and a and b and a[0] != b[0] else None
+                 for j, b in enumerate(snapped)] for i, a in enumerate(snapped)]
+
+    def travel_legs(self, points: List[Dict]) -> List:
+        """順番に回った時の各区間の (所要分, km)。求められない区間はNone"""
+        snapped = self._snap_points(points)
+        legs = list(zip(snapped, snapped[1:]))
+        requests = {}
+        for a, b in legs:
+            if a and b and a[0] != b[0]:
+                requests.setdefault(a[0], set()).add(b[0])
+        costs = self._pair_costs(requests)
+        return [self._with_access(costs[(a[0], b[0])], a, b) if a and b and a[0] != b[0] else None
+                for a, b in legs]
+
+    def status(self) -> Dict:
+        return {'path': self.path, 'nodes': len(self), 'landmarks': len(self.landmarks),
+                'cached_routes': len(self._cache), 'hits': self.hits, 'misses': self.misses,
+                'settled': self.settled, **self.meta}
+
+
+_road_network = None
+
+
+def load_road_network(path: str = None):
+    """道路網を読み込む（ROUTE_USE_ROAD_NETWORK=Trueなら起動時に裏で実行）"""
+    global _road_network
+    path = path or ROAD_GRAPH_PATH
+    if not os.path.exists(path):
+        print(f"⚠️ 道路網がありません（flask build-road-graph で作成）: {path}")
+        return None
+    try:
+        started = time.time()
+        network = RoadNetwork(path)
+    except Exception as e:
+        print(f"⚠️ 道路網の読み込みエラー（直線距離で計算します）: {e}")
+        return None
+    _road_network = network
+    print(f"✅ 道路網を読み込み: {len(network)}ノード（{time.time() - started:.1f}秒）")
+    return network
+
+
+def get_road_network():
+    """読み込み済みの道路網（無効・未作成・読み込み中はNone → 直線距離で計算）"""
+    if not ROUTE_USE_ROAD_NETWORK:
+        return None
+    return _road_network
+
+
+# リクエスト処理中に読み込むと初回のリクエストが待たされるので起動時に読み込む
+if ROUTE_USE_ROAD_NETWORK:
+    threading.Thread(target=load_road_network, daemon=True).start()
+
+
+def road_matrices(points: List[Dict]):
+    """
+    地点間の (所要時間（分）, 距離（km）) の行列
+
+    道路網があれば道路での値、なければ（または道路から遠い組は）
+    直線距離 × ROUTE_DETOUR_FACTOR ÷ ROUTE_TRAVEL_SPEED_KMH で見積もる
+    """
+    km = distance_matrix(points)
+    factor = ROUTE_DETOUR_FACTOR / ROUTE_TRAVEL_SPEED_KMH * 60
+    minutes = [[d * factor for d in row] for row in km]
+    network = get_road_network()
+    if network is not None:
+        for i, row in enumerate(network.travel_matrix(points)):
+            for j, road in enumerate(row):
+                if road:
+                    minutes[i][j] = road[0]
+                    km[i][j] = round(road[1], 2)
+    return minutes, km
+
+
+def route_cost_matrices(points: List[Dict]):
+    """
+    ルート最適化に使う (コスト行列, 距離（km）の行列)
+
+    コストは道路網があれば所要時間（分）、なければ直線距離（km）
+    """
+    if get_road_network() is None:
+        matrix = distance_matrix(points)
+        return matrix, matrix
+    minutes, km = road_matrices(points)
+    # 2-opt は往復で同じコストを前提にするため、一方通行による差は往復の平均にならす
+    n = len(minutes)
+    return [[(minutes[i][j] + minutes[j][i]) / 2 for j in range(n)] for i in range(n)], km
+
+
+@app.cli.command('build-road-graph')
+@click.argument('path')
+@click.option('--output', default=None, help='出力先（省略時はROAD_GRAPH_PATH）')
+@click.option('--landmarks', default=ROAD_LANDMARKS, help='ALTのランドマーク数')
+def build_road_graph_command(path, output, landmarks):
+    """OSM抽出データ（.osm / .osm.gz / .osm.bz2 / .osm.pbf）から道路グラフを作成"""
+    output = output or ROAD_GRAPH_PATH
+    started = time.time()
+    stats = RoadNetwork.build(path, output, landmarks)
+    print(f"✅ 道路グラフを {output} に保存しました: {stats['nodes']}ノード / {stats['edges']}辺 / "
+          f"ランドマーク{stats['landmarks']}（{time.time() - started:.1f}秒）")
+
+
 def calculate_route_distance(spots):
     """
     スポットリストを順番に回った時の合計距離を計算
@@ -1930,18 +5488,19 @@ def calculate_route_distance(spots):
     
     total_distance = 0.0
     
-    for i in range(len(spots) - 1):
-        spot1 = spots[i]
-        spot2 = spots[i + 1]
-        
-        # 緯度経度が存在するか確認
-        if 'lat' in spot1 and 'lon' in spot1 and 'lat' in spot2 and 'lon' in spot2:
-            distance = calculate_distance(
-                spot1['lat'], spot1['lon'],
-                spot2['lat'], spot2['lon']
-            )
+    # 全区間の距離をまとめて計算（座標がない区間は math.inf）
+    legs = route_leg_distances(spots)
+    network = get_road_network()
+    if network is not None:
+        # 道路網があれば道のりに置き換え（道路から遠い区間は直線距離のまま）
+        for i, road in enumerate(network.travel_legs(spots)):
+            if road:
+                legs[i] = round(road[1], 2)
+    
+    for i, distance in enumerate(legs):
+        if distance != math.inf:
             total_distance += distance
-            print(f"  {spot1.get('name', '?')} → {spot2.get('name', '?')}: {distance}km")
+            print(f"  {spots[i].get('name', '?')} → {spots[i + 1].get('name', '?')}: {distance}km")
     
     return round(total_distance, 2)
 
@@ -1965,15 +5524,10 @@ def sort_spots_by_distance(base_spot, spots_list, max_distance=60):
         print("⚠️ 基準スポットに座標がありません")
         return spots_list
     
-    # 各スポットに基準点からの距離を追加
+    # 各スポットに基準点からの距離を追加（まとめて計算）
     spots_with_distance = []
-    for spot in spots_list:
-        if 'lat' in spot and 'lon' in spot:
-            distance = calculate_distance(
-                base_lat, base_lon,
-                spot['lat'], spot['lon']
-            )
-            
+    for spot, distance in zip(spots_list, distances_from(base_lat, base_lon, spots_list)):
+        if distance != math.inf:
             # 最大距離以内のスポットのみ追加
             if distance <= max_distance:
                 spot['distance_from_base'] = distance
@@ -1989,100 +5543,739 @@ def sort_spots_by_distance(base_spot, spots_list, max_distance=60):
     
     return sorted_spots
 
-def optimize_daily_route(spots):
+#ルート最適化（最近傍法 + 2-opt / Or-opt）
+##################################################
+##################################################
+
+ROUTE_OPT_METHOD = os.getenv('ROUTE_OPT_METHOD', 'local_search')  # greedy / local_search
+ROUTE_OPT_TIME_BUDGET = float(os.getenv('ROUTE_OPT_TIME_BUDGET', '0.05'))  # 1ルートの改善に使う秒数
+ROUTE_OPT_SEGMENT_MAX = 3  # Or-optで動かす区間の最大長
+
+
+def greedy_route_order(matrix: List[List[float]], nodes: List[int], start=None, end=None) -> List[int]:
+    """
+    最近傍法で巡回順を作成（開いた経路）
+
+    Args:
+        matrix: 距離行列
+        nodes: 並べる添字（start / end を含んでもよい）
+        start: 先頭に固定する添字（Noneならnodesの先頭から始める）
+        end: 末尾に固定する添字（Noneなら終点は自由）
+    """
+    remaining = [n for n in nodes if n != start and n != end]
+    order = [start] if start is not None else ([remaining.pop(0)] if remaining else [])
+    while remaining:
+        row = matrix[order[-1]]
+        nearest = min(remaining, key=row.__getitem__)
+        order.append(nearest)
+        remaining.remove(nearest)
+    if end is not None:
+        order.append(end)
+    return order
+
+
+def _edge(matrix, a, b) -> float:
+    """経路の端（None）を含む辺は0"""
+    return 0.0 if a is None or b is None else matrix[a][b]
+
+
+def _two_opt_pass(order: List[int], matrix, lo: int, hi: int, deadline: float) -> bool:
+    """order[i..j]（lo <= i < j <= hi）を反転して短くなれば適用"""
+    improved = False
+    n = len(order)
+    for i in range(lo, hi):
+        if time.perf_counter() > deadline:
+            break
+        a = order[i - 1] if i > 0 else None
+        for j in range(i + 1, hi + 1):
+            b, c = order[i], order[j]
+            e = order[j + 1] if j + 1 < n else None
+            delta = (_edge(matrix, a, c) + _edge(matrix, b, e)
+                     - _edge(matrix, a, b) - _edge(matrix, c, e))
+            if delta < -1e-9:
+                order[i:j + 1] = order[i:j + 1][::-1]
+                improved = True
+    return improved
+
+
+def _or_opt_pass(order: List[int], matrix, lo: int, hi: int, deadline: float) -> bool:
+    """長さ1〜ROUTE_OPT_SEGMENT_MAXの区間を別の位置へ（反転も含めて）移して短くなれば適用"""
+    improved = False
+    for k in range(1, ROUTE_OPT_SEGMENT_MAX + 1):
+        i = lo
+        while i + k - 1 <= hi:
+            if time.perf_counter() > deadline:
+                return improved
+            segment = order[i:i + k]
+            prev = order[i - 1] if i > 0 else None
+            nxt = order[i + k] if i + k < len(order) else None
+            removed = (_edge(matrix, prev, segment[0]) + _edge(matrix, segment[-1], nxt)
+                       - _edge(matrix, prev, nxt))
+            rest = order[:i] + order[i + k:]
+            # 固定された先頭・末尾の外側には入れない
+            first = lo
+            last = len(rest) - (len(order) - 1 - hi)
+            best = None
+            for p in range(first, last + 1):
+                if p == i:
+                    continue
+                x = rest[p - 1] if p > 0 else None
+                y = rest[p] if p < len(rest) else None
+                base = _edge(matrix, x, y)
+                for seg in (segment, segment[::-1]):
+                    added = _edge(matrix, x, seg[0]) + _edge(matrix, seg[-1], y) - base
+                    if added - removed < -1e-9 and (best is None or added - removed < best[0]):
+                        best = (added - removed, p, seg)
+            if best:
+                _, p, seg = best
+                order[:] = rest[:p] + seg + rest[p:]
+                improved = True
+            i += 1
+    return improved
+
+
+def improve_route_order(order: List[int], matrix: List[List[float]], fixed_start: bool = True,
+                        fixed_end: bool = False, time_budget: float = None) -> List[int]:
+    """
+    巡回順を2-opt / Or-optで改善（改善がなくなるか時間切れまで）
+
+    Args:
+        order: 初期の巡回順（開いた経路）
+        fixed_start / fixed_end: 先頭・末尾を動かさない（ホテルなど）
+        time_budget: 使ってよい秒数（省略時はROUTE_OPT_TIME_BUDGET）
+    """
+    order = list(order)
+    lo = 1 if fixed_start else 0
+    hi = len(order) - 2 if fixed_end else len(order) - 1
+    if hi - lo < 1:
+        return order
+    deadline = time.perf_counter() + (ROUTE_OPT_TIME_BUDGET if time_budget is None else time_budget)
+    improved = True
+    while improved and time.perf_counter() < deadline:
+        improved = _two_opt_pass(order, matrix, lo, hi, deadline)
+        improved = _or_opt_pass(order, matrix, lo, hi, deadline) or improved
+    return order
+
+
+def _greedy_optimizer(matrix, nodes, start, end, time_budget):
+    return greedy_route_order(matrix, nodes, start, end)
+
+
+def _local_search_optimizer(matrix, nodes, start, end, time_budget):
+    order = greedy_route_order(matrix, nodes, start, end)
+    return improve_route_order(order, matrix, start is not None, end is not None, time_budget)
+
+
+# method名 → 最適化関数（matrix, nodes, start, end, time_budget）→ 巡回順
+ROUTE_OPTIMIZERS = {
+    'greedy': _greedy_optimizer,
+    'local_search': _local_search_optimizer,
+}
+
+
+def solve_route(matrix: List[List[float]], nodes: List[int], start=None, end=None,
+                method: str = None, time_budget: float = None) -> List[int]:
+    """
+    巡回順を求める（ROUTE_OPTIMIZERSから手法を選ぶ）
+
+    start / end を省略した側は自由（開いた経路）。start省略時の初期解はnodesの先頭から作る
+    """
+    optimizer = ROUTE_OPTIMIZERS.get(method or ROUTE_OPT_METHOD, _local_search_optimizer)
+    return optimizer(matrix, nodes, start, end, time_budget)
+
+
+def optimize_daily_route(spots, start: Dict = None, end: Dict = None, method: str = None):
     """
-    その日のスポットを最短ルートに並び替え（貪欲法）
+    その日のスポットを最短ルートに並び替え（最近傍法 + 2-opt / Or-opt）
     
     Args:
         spots: その日のスポットリスト
+        start: 出発地点（ホテルなど lat, lon を持つdict）。省略時は最初のスポットを固定
+        end: 到着地点（省略時は終点自由）
+        method: ROUTE_OPTIMIZERSの手法名（省略時はROUTE_OPT_METHOD）
     
     Returns:
-        list: 最適化されたスポットリスト
+        list: 最適化されたスポットリスト（start / end は含まない）
     """
     if len(spots) <= 1:
         return spots
     
     print(f"\n🔄 {len(spots)}スポットのルート最適化中...")
     
-    # 最初のスポットは固定（拠点に近いスポット）
-    optimized = [spots[0]]
-    remaining = spots[1:].copy()
+    # 座標があるスポットだけを並べ替え、座標がないスポットは最後に追加
+    valid = [s for s in spots if spot_latlon(s)]
+    missing = [s for s in spots if not spot_latlon(s)]
+    points = valid + [p for p in (start, end) if p and spot_latlon(p)]
+    # 出発地点がなければ最初のスポットを固定（拠点に近いスポット）
+    start_index = len(valid) if start and spot_latlon(start) else 0
+    end_index = len(points) - 1 if end and spot_latlon(end) else None
     
-    # 貪欲法: 現在地から最も近いスポットを次に選ぶ
-    while remaining:
-        current_spot = optimized[-1]
-        
-        # 現在地から各スポットへの距離を計算
-        nearest_spot = None
-        nearest_distance = float('inf')
-        
-        for spot in remaining:
-            if 'lat' in spot and 'lon' in spot and 'lat' in current_spot and 'lon' in current_spot:
-                distance = calculate_distance(
-                    current_spot['lat'], current_spot['lon'],
-                    spot['lat'], spot['lon']
-                )
-                
-                if distance < nearest_distance:
-                    nearest_distance = distance
-                    nearest_spot = spot
-        
-        if nearest_spot:
-            optimized.append(nearest_spot)
-            remaining.remove(nearest_spot)
-            print(f"  {current_spot.get('name', '?')} → {nearest_spot.get('name', '?')}: {nearest_distance}km")
-        else:
-            # 座標がないスポットは最後に追加
-            optimized.extend(remaining)
-            break
+    # コスト行列・距離行列を一度だけ作成（道路網があれば所要時間・道のり）
+    matrix, km = route_cost_matrices(points)
+    nodes = list(range(len(valid)))
+    started = time.perf_counter()
+    order = solve_route(matrix, nodes, start_index, end_index, method)
     
-    # 最適化前後の距離を比較
-    original_distance = calculate_route_distance(spots)
-    optimized_distance = calculate_route_distance(optimized)
+    optimized = [valid[i] for i in order if i < len(valid)] + missing
     
-    print(f"  📉 最適化: {original_distance}km → {optimized_distance}km（{original_distance - optimized_distance:.1f}km削減）")
+    # 最適化前後の距離を比較（作成済みの距離行列から計算）
+    original_distance = round(route_length(nodes, km), 2)
+    optimized_distance = round(route_length([i for i in order if i < len(valid)], km), 2)
+    
+    print(f"  📉 最適化: {original_distance}km → {optimized_distance}km"
+          f"（{original_distance - optimized_distance:.1f}km削減、{(time.perf_counter() - started) * 1000:.1f}ms）")
     
     return optimized
 
 
+KANSAI_BENCH_CENTERS = [
+    (34.6937, 135.5023),  # 大阪
+    (35.0116, 135.7681),  # 京都
+    (34.6851, 135.8048),  # 奈良
+    (34.6901, 135.1955),  # 神戸
+    (34.2261, 135.1675),  # 和歌山
+    (35.0045, 135.8686),  # 大津
+]
+
+
+@app.cli.command('bench-route')
+@click.option('--spots', default=12, help='1ルートのスポット数')
+@click.option('--trials', default=50, help='試行回数')
+@click.option('--budget', default=None, type=float, help='改善に使う秒数（省略時はROUTE_OPT_TIME_BUDGET）')
+@click.option('--hotel', is_flag=True, help='ホテル発着（始点・終点固定）で比較')
+def bench_route_command(spots, trials, budget, hotel):
+    """関西の疑似スポットで最近傍法と2-opt / Or-optを比較"""
+    rng = random.Random(0)
+    results = {name: {'distance': 0.0, 'time': 0.0} for name in ROUTE_OPTIMIZERS}
+    for _ in range(trials):
+        points = []
+        for _ in range(spots):
+            lat, lon = rng.choice(KANSAI_BENCH_CENTERS)
+            points.append({'lat': rng.gauss(lat, 0.08), 'lon': rng.gauss(lon, 0.08)})
+        # ホテルなしは optimize_daily_route と同じく最初のスポットを固定した開いた経路
+        start, end = 0, None
+        if hotel:
+            lat, lon = rng.choice(KANSAI_BENCH_CENTERS)
+            start = end = len(points)
+            points.append({'lat': lat, 'lon': lon})
+        matrix = distance_matrix(points)
+        nodes = list(range(spots))
+        for name in ROUTE_OPTIMIZERS:
+            started = time.perf_counter()
+            order = solve_route(matrix, nodes, start, end, name, budget)
+            results[name]['time'] += time.perf_counter() - started
+            results[name]['distance'] += route_length(order, matrix)
+
+    base = results['greedy']['distance'] or 1.0
+    print(f"スポット数: {spots} / 試行: {trials}{'（ホテル発着）' if hotel else ''}")
+    for name, result in results.items():
+        print(f"  {name:<13}: 平均{result['distance'] / trials:.1f}km"
+              f"（最近傍法比 {(result['distance'] / base - 1) * 100:+.1f}%）"
+              f" 平均{result['time'] / trials * 1000:.2f}ms")
+
+
+
+#日程へのスポット配分（地理的なまとまり）
+##################################################
+##################################################
+
+DAY_ASSIGN_METHOD = os.getenv('DAY_ASSIGN_METHOD', 'sweep')  # sweep / order（従来の先頭から順に配分）
+DAY_ASSIGN_ROTATIONS = int(os.getenv('DAY_ASSIGN_ROTATIONS', '16'))  # スイープの開始位置の候補数
+
+
+def day_spot_counts(spot_count: int, duration_days: int, max_spots_per_day: int) -> List[int]:
+    """残り日数で均等に分配した各日のスポット数（最大max_spots_per_day、スポットが尽きた日以降は含まない）"""
+    counts = []
+    remaining = spot_count
+    for day_num in range(1, duration_days + 1):
+        if remaining <= 0:
+            break
+        remaining_days = duration_days - day_num + 1
+        ideal_count = (remaining + remaining_days - 1) // remaining_days
+        count = min(max_spots_per_day, ideal_count, remaining)
+        counts.append(count)
+        remaining -= count
+    return counts
+
+
+def _plane_points(coords: List[Tuple[float, float]]) -> List[Tuple[float, float]]:
+    """緯度経度を重心まわりの平面座標（km）に変換（正距円筒近似）"""
+    lat0 = sum(lat for lat, _ in coords) / len(coords)
+    lon0 = sum(lon for _, lon in coords) / len(coords)
+    kx = 111.32 * cos(radians(lat0))
+    return [((lon - lon0) * kx, (lat - lat0) * 110.57) for lat, lon in coords]
+
+
+def _clusters_cost(points: List[Tuple[float, float]], sequence: List[int], counts: List[int]) -> float:
+    """連続する区間を1日とした時の、各点から日ごとの重心までの距離の合計"""
+    total = 0.0
+    pos = 0
+    for count in counts:
+        chunk = [points[i] for i in sequence[pos:pos + count]]
+        pos += count
+        if not chunk:
+            continue
+        cx = sum(x for x, _ in chunk) / len(chunk)
+        cy = sum(y for _, y in chunk) / len(chunk)
+        total += sum(sqrt((x - cx) ** 2 + (y - cy) ** 2) for x, y in chunk)
+    return total
+
+
+def sweep_day_assignment(spots: List[Dict], counts: List[int]) -> List[List[Dict]]:
+    """
+    スイープ法でスポットを日ごとにまとめる（O(n log n)）
+
+    重心から見た方位角順に並べ、各日の定員（counts）ごとに区切る。開始位置は
+    方位角の最も大きな隙間を含むDAY_ASSIGN_ROTATIONS個の候補から、日ごとの重心までの
+    距離の合計が最小のものを選ぶ。座標がないスポットは最後の日に回す
+    """
+    valid = [i for i, s in enumerate(spots) if spot_latlon(s)]
+    missing = [i for i, s in enumerate(spots) if not spot_latlon(s)]
+    sequence = valid
+    if len(valid) > 1 and len(counts) > 1:
+        points = _plane_points([spot_latlon(spots[i]) for i in valid])
+        by_angle = sorted(range(len(valid)), key=lambda k: atan2(points[k][1], points[k][0]))
+        n = len(by_angle)
+        angles = [atan2(points[k][1], points[k][0]) for k in by_angle]
+        gaps = [(angles[(k + 1) % n] - angles[k]) % (2 * math.pi) or 2 * math.pi for k in range(n)]
+        widest = (max(range(n), key=gaps.__getitem__) + 1) % n
+        step = max(1, n // max(1, DAY_ASSIGN_ROTATIONS))
+        candidates = {(widest + k * step) % n for k in range(min(n, DAY_ASSIGN_ROTATIONS))}
+        best = min(candidates, key=lambda r: (_clusters_cost(points, by_angle[r:] + by_angle[:r], counts),
+                                              r != widest))
+        sequence = [valid[k] for k in by_angle[best:] + by_angle[:best]]
+
+    sequence = sequence + missing
+    days = []
+    pos = 0
+    for count in counts:
+        days.append([spots[i] for i in sequence[pos:pos + count]])
+        pos += count
+    return days
+
+
+def assign_spots_to_days(spots: List[Dict], duration_days: int, max_spots_per_day: int,
+                         method: str = None) -> List[List[Dict]]:
+    """
+    スポットを日ごとに配分
+
+    入りきらない場合は先頭（優先度の高い）スポットから定員分だけ使う
+    """
+    counts = day_spot_counts(len(spots), duration_days, max_spots_per_day)
+    selected = spots[:sum(counts)]
+    if (method or DAY_ASSIGN_METHOD) == 'sweep':
+        return sweep_day_assignment(selected, counts)
+    days = []
+    pos = 0
+    for count in counts:
+        days.append(selected[pos:pos + count])
+        pos += count
+    return days
+
+
+def itinerary_distance(days: List[List[Dict]]) -> float:
+    """日ごとに巡回した時の直線距離の合計（km）。optimize_daily_routeと同じく最初のスポットを固定した開いた経路"""
+    total = 0.0
+    for day_spots in days:
+        if len(day_spots) < 2:
+            continue
+        matrix = distance_matrix(day_spots)
+        order = solve_route(matrix, list(range(len(day_spots))), 0, None)
+        total += route_length(order, matrix)
+    return total
+
+
+@app.cli.command('bench-days')
+@click.option('--days', default=5, help='日数')
+@click.option('--spots', default=20, help='スポット数')
+@click.option('--trials', default=50, help='試行回数')
+def bench_days_command(days, spots, trials):
+    """関西の疑似スポットで日程への配分（order / sweep）を比較"""
+    rng = random.Random(0)
+    totals = {'order': 0.0, 'sweep': 0.0}
+    elapsed = {'order': 0.0, 'sweep': 0.0}
+    for _ in range(trials):
+        points = []
+        for i in range(spots):
+            lat, lon = rng.choice(KANSAI_BENCH_CENTERS)
+            points.append({'name': f'spot{i}', 'lat': rng.gauss(lat, 0.08), 'lon': rng.gauss(lon, 0.08)})
+        for method in totals:
+            started = time.perf_counter()
+            assigned = assign_spots_to_days(points, days, 4, method)
+            elapsed[method] += time.perf_counter() - started
+            totals[method] += itinerary_distance(assigned)
+
+    print(f"スポット数: {spots} / 日数: {days} / 試行: {trials}")
+    for method, total in totals.items():
+        print(f"  {method:<6}: 平均{total / trials:.1f}km"
+              f"（order比 {(total / (totals['order'] or 1.0) - 1) * 100:+.1f}%）"
+              f" 配分{elapsed[method] / trials * 1000:.2f}ms")
+
+
+#複数日の巡回計画（ホテル発着・時間制約つき）
+##################################################
+##################################################
+
+TRIP_DAY_MINUTES = int(os.getenv('TRIP_DAY_MINUTES', '540'))  # 1日に使える時間（分、ホテル出発から帰着まで）
+ROUTE_TRAVEL_SPEED_KMH = float(os.getenv('ROUTE_TRAVEL_SPEED_KMH', '30'))  # 移動の平均速度
+ROUTE_DETOUR_FACTOR = float(os.getenv('ROUTE_DETOUR_FACTOR', '1.3'))  # 直線距離 → 道のりの係数
+ROUTE_VRP_TIME_LIMIT = float(os.getenv('ROUTE_VRP_TIME_LIMIT', '0.5'))  # 局所探索に使う秒数
+ROUTE_SKIP_PENALTY = float(os.getenv('ROUTE_SKIP_PENALTY', '240'))  # 訪問できなかったスポットの罰則（分）
+SPOT_DWELL_DEFAULT = 60  # 滞在時間（分）の既定値
+SPOT_DWELL_MINUTES = {
+    'テーマパーク': 240,
+    'ウォーターパーク': 180,
+    '動物園': 120,
+    '水族館': 120,
+    '城': 90,
+    '博物館': 90,
+    '美術館': 90,
+    '世界遺産': 90,
+    '温泉': 90,
+    'ショッピングモール': 90,
+    '寺院': 60,
+    '公園': 60,
+    '飲食店': 60,
+    '神社': 45,
+    '展望台': 30,
+}
+
+
+def spot_dwell_minutes(spot: Dict) -> int:
+    """スポットの滞在時間（分）。dwell_minutesがあればそれを使う"""
+    if spot.get('dwell_minutes'):
+        return int(spot['dwell_minutes'])
+    return SPOT_DWELL_MINUTES.get(spot.get('type'), SPOT_DWELL_DEFAULT)
+
+
+def parse_hotels_param(value: str):
+    """
+    hotels パラメータ（"lat,lon[,名前];lat,lon[,名前];..." 1泊ごと）を解析
+
+    Returns:
+        (hotels, error): hotelsは [{'name', 'lat', 'lon'}, ...]（指定なしは空リスト）
+    """
+    hotels = []
+    for night, part in enumerate(p for p in value.split(';') if p.strip()):
+        fields = [f.strip() for f in part.split(',')]
+        try:
+            lat, lon = float(fields[0]), float(fields[1])
+        except (ValueError, IndexError):
+            return None, f'hotelsの{night + 1}泊目の座標が不正です（lat,lon[,名前]）'
+        if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+            return None, f'hotelsの{night + 1}泊目の座標が範囲外です'
+        hotels.append({'name': ','.join(fields[2:]) or f'{night + 1}泊目の宿', 'lat': lat, 'lon': lon})
+    return hotels, None
+
+
+def travel_time_matrix(points: List[Dict]) -> List[List[float]]:
+    """
+    地点間の移動時間（分）の行列
+
+    道路網があれば道路での所要時間、なければ（または道路から遠い組は）
+    直線距離 × ROUTE_DETOUR_FACTOR ÷ ROUTE_TRAVEL_SPEED_KMH
+    """
+    return road_matrices(points)[0]
+
+
+class MultiDayRouter:
+    """
+    ホテル発着の複数日巡回（時間制約つきVRP）をヒューリスティックで解く
+
+    1. セービング法で、定員（1日のスポット数）と1日の持ち時間を守るルートを作る
+    2. 価値（推薦順の重み）の高いルートを日数分だけ残し、発着地が近い日に割り当てる
+    3. 制限時間まで局所探索（日ごとの2-opt / Or-opt、未訪問スポットの挿入・入れ替え、
+       日をまたぐ移動）
+
+    目的関数 = 総移動時間（分）+ ROUTE_SKIP_PENALTY × 訪問できなかったスポットの重み
+    """
+
+    def __init__(self, spots: List[Dict], days: int, hotels: List[Dict],
+                 day_minutes: int = None, max_spots_per_day: int = 4, time_limit: float = None):
+        self.spots = spots
+        self.days = days
+        self.max_spots = max_spots_per_day
+        self.day_minutes = day_minutes or TRIP_DAY_MINUTES
+        self.time_limit = ROUTE_VRP_TIME_LIMIT if time_limit is None else time_limit
+        self.hotels = hotels
+        n = len(spots)
+        self.n = n
+        self.time = travel_time_matrix(spots + hotels)
+        self.dwell = [spot_dwell_minutes(s) for s in spots]
+        # 推薦順に 2.0 → 1.0 の重み（先頭ほど訪問を優先）
+        self.weight = [1.0 + (n - rank) / n for rank in range(n)]
+        self.usable = [i for i in range(n) if spot_latlon(spots[i])
+                       and self.dwell[i] + self._leg(self._start(0), i) + self._leg(i, self._end(0)) <= self.day_minutes]
+
+    def _start(self, day: int) -> int:
+        """day日目（0始まり）の出発地 = 前夜の宿"""
+        return self.n + min(max(day - 1, 0), len(self.hotels) - 1)
+
+    def _end(self, day: int) -> int:
+        """day日目（0始まり）の到着地 = その夜の宿"""
+        return self.n + min(day, len(self.hotels) - 1)
+
+    def _leg(self, a: int, b: int) -> float:
+        return self.time[a][b]
+
+    def duration(self, route: List[int], day: int) -> float:
+        """宿を出てから戻るまでの時間（分）"""
+        if not route:
+            return 0.0
+        path = [self._start(day)] + route + [self._end(day)]
+        return (sum(self.time[a][b] for a, b in zip(path, path[1:]))
+                + sum(self.dwell[i] for i in route))
+
+    def travel(self, route: List[int], day: int) -> float:
+        """移動時間（分）"""
+        if not route:
+            return 0.0
+        path = [self._start(day)] + route + [self._end(day)]
+        return sum(self.time[a][b] for a, b in zip(path, path[1:]))
+
+    def _feasible(self, route: List[int], day: int) -> bool:
+        return len(route) <= self.max_spots and self.duration(route, day) <= self.day_minutes + 1e-9
+
+    def objective(self, routes: List[List[int]]) -> float:
+        visited = {i for route in routes for i in route}
+        skipped = sum(self.weight[i] for i in range(self.n) if i not in visited)
+        return sum(self.travel(route, day) for day, route in enumerate(routes)) + ROUTE_SKIP_PENALTY * skipped
+
+    def _savings_routes(self) -> List[List[int]]:
+        """セービング法（1泊目の宿を拠点として計算）"""
+        hub = self._start(0)
+        routes = {i: [i] for i in self.usable}
+        owner = {i: i for i in self.usable}
+        savings = sorted(
+            ((self.time[hub][i] + self.time[j][hub] - self.time[i][j], i, j)
+             for a, i in enumerate(self.usable) for j in self.usable[a + 1:]),
+            reverse=True)
+        for saving, i, j in savings:
+            if saving <= 0:
+                break
+            ri, rj = owner[i], owner[j]
+            if ri == rj:
+                continue
+            a, b = routes[ri], routes[rj]
+            if i not in (a[0], a[-1]) or j not in (b[0], b[-1]):
+                continue
+            # i を a の末尾、j を b の先頭に向きをそろえてつなぐ
+            merged = (a if a[-1] == i else a[::-1]) + (b if b[0] == j else b[::-1])
+            if len(merged) > self.max_spots or self.duration(merged, 0) > self.day_minutes:
+                continue
+            routes[ri] = merged
+            del routes[rj]
+            for k in b:
+                owner[k] = ri
+        return list(routes.values())
+
+    def _assign_days(self, routes: List[List[int]]) -> List[List[int]]:
+        """価値の高いルートを日数分だけ残し、各日に割り当てる"""
+        routes = sorted(routes, key=lambda r: (-sum(self.weight[i] for i in r), self.duration(r, 0)))
+        candidates = routes[:self.days]
+        result = []
+        for day in range(self.days):
+            best = None
+            for route in candidates:
+                for oriented in (route, route[::-1]):
+                    if self._feasible(oriented, day) and (
+                            best is None or self.travel(oriented, day) < self.travel(best[1], day)):
+                        best = (route, oriented)
+            if best:
+                candidates.remove(best[0])
+                result.append(best[1])
+            else:
+                result.append([])
+        return result
+
+    def _best_insertion(self, route: List[int], day: int, spot: int):
+        """spotを挿入して移動時間の増加が最小になる位置 (増加分, 新ルート)。入らなければNone"""
+        if len(route) >= self.max_spots:
+            return None
+        base = self.travel(route, day)
+        best = None
+        for pos in range(len(route) + 1):
+            candidate = route[:pos] + [spot] + route[pos:]
+            if self._feasible(candidate, day):
+                delta = self.travel(candidate, day) - base
+                if best is None or delta < best[0]:
+                    best = (delta, candidate)
+        return best
+
+    def _improve_day(self, routes: List[List[int]], day: int, deadline: float) -> bool:
+        route = routes[day]
+        if len(route) < 2:
+            return False
+        start, end = self._start(day), self._end(day)
+        order = improve_route_order([start] + route + [end], self.time, True, True,
+                                    max(0.0, deadline - time.perf_counter()))
+        improved = order[1:-1]
+        if self.travel(improved, day) < self.travel(route, day) - 1e-9 and self._feasible(improved, day):
+            routes[day] = improved
+            return True
+        return False
+
+    def _insert_skipped(self, routes: List[List[int]]) -> bool:
+        changed = False
+        visited = {i for route in routes for i in route}
+        for spot in sorted((i for i in self.usable if i not in visited), key=lambda i: -self.weight[i]):
+            best = None
+            for day, route in enumerate(routes):
+                found = self._best_insertion(route, day, spot)
+                if found and (best is None or found[0] < best[0]):
+                    best = (found[0], day, found[1])
+            if best and best[0] < ROUTE_SKIP_PENALTY * self.weight[spot]:
+                routes[best[1]] = best[2]
+                changed = True
+        return changed
+
+    def _swap_skipped(self, routes: List[List[int]]) -> bool:
+        """未訪問スポットと、より重みの低い訪問スポットを入れ替えて目的関数が下がれば適用"""
+        visited = {i for route in routes for i in route}
+        for spot in sorted((i for i in self.usable if i not in visited), key=lambda i: -self.weight[i]):
+            for day, route in enumerate(routes):
+                for victim in route:
+                    if self.weight[victim] >= self.weight[spot]:
+                        continue
+                    reduced = [i for i in route if i != victim]
+                    found = self._best_insertion(reduced, day, spot)
+                    if not found:
+                        continue
+                    gain = (ROUTE_SKIP_PENALTY * (self.weight[spot] - self.weight[victim])
+                            - (self.travel(found[1], day) - self.travel(route, day)))
+                    if gain > 1e-9:
+                        routes[day] = found[1]
+                        return True
+        return False
+
+    def _relocate(self, routes: List[List[int]]) -> bool:
+        """スポットを別の日へ移して総移動時間が下がれば適用"""
+        for day, route in enumerate(routes):
+            for spot in route:
+                reduced = [i for i in route if i != spot]
+                removed = self.travel(route, day) - self.travel(reduced, day)
+                for other in range(len(routes)):
+                    if other == day:
+                        continue
+                    found = self._best_insertion(routes[other], other, spot)
+                    if found and found[0] < removed - 1e-9:
+                        routes[day] = reduced
+                        routes[other] = found[1]
+                        return True
+        return False
+
+    def solve(self) -> Dict:
+        started = time.perf_counter()
+        deadline = started + self.time_limit
+        routes = self._assign_days(self._savings_routes())
+        changed = True
+        while changed and time.perf_counter() < deadline:
+            changed = False
+            for day in range(self.days):
+                changed = self._improve_day(routes, day, deadline) or changed
+            changed = self._insert_skipped(routes) or changed
+            changed = self._swap_skipped(routes) or changed
+            changed = self._relocate(routes) or changed
+
+        visited = {i for route in routes for i in route}
+        result_days = []
+        for day, route in enumerate(routes):
+            clock = 0.0
+            schedule = []
+            previous = self._start(day)
+            for i in route:
+                clock += self.time[previous][i]
+                schedule.append({'spot': self.spots[i], 'arrive': clock, 'depart': clock + self.dwell[i]})
+                clock += self.dwell[i]
+                previous = i
+            result_days.append({
+                'spots': [self.spots[i] for i in route],
+                'start': self.hotels[self._start(day) - self.n],
+                'end': self.hotels[self._end(day) - self.n],
+                'schedule': schedule,
+                'travel_minutes': round(self.travel(route, day), 1),
+                'duration_minutes': round(self.duration(route, day), 1),
+            })
+        return {
+            'days': result_days,
+            'objective': round(self.objective(routes), 1),
+            'travel_minutes': round(sum(d['travel_minutes'] for d in result_days), 1),
+            'skipped': [self.spots[i] for i in range(self.n) if i not in visited],
+            'elapsed_ms': round((time.perf_counter() - started) * 1000, 1),
+        }
+
+
+def solve_multiday_routes(spots: List[Dict], days: int, hotels: List[Dict], day_minutes: int = None,
+                          max_spots_per_day: int = 4, time_limit: float = None) -> Dict:
+    """ホテル発着の複数日巡回を計算（MultiDayRouterの結果を返す）"""
+    router = MultiDayRouter(spots, days, hotels, day_minutes, max_spots_per_day, time_limit)
+    result = router.solve()
+    print(f"  🏨 巡回計画: {sum(len(d['spots']) for d in result['days'])}スポット / {days}日"
+          f"（移動{result['travel_minutes']}分、未訪問{len(result['skipped'])}件、"
+          f"目的関数{result['objective']}、{result['elapsed_ms']}ms）")
+    return result
+
+
+def format_clock(start_time: str, minutes: float) -> str:
+    """"HH:MM" に分を足した時刻"""
+    hour, minute = map(int, start_time.split(':'))
+    total = hour * 60 + minute + int(round(minutes))
+    return f"{total // 60:02d}:{total % 60:02d}"
+
 
 def generate_daily_itinerary(spots: List[Dict], duration_days: int = 1, 
-                            start_time: str = "09:00") -> List[Dict]:
-    """日ごとの詳細スケジュールを生成（シンプル版）"""
+                            start_time: str = "09:00", routing: Dict = None) -> List[Dict]:
+    """
+    日ごとの詳細スケジュールを生成（シンプル版）
+    
+    routing（solve_multiday_routesの結果）があれば、その日ごとのルートと到着時刻を使う
+    """
     
     max_spots_per_day = 4  # 1日最大4スポット
     
     itineraries = []
-    remaining_spots = spots.copy()
     
     print(f"\n📅 日程配分: {len(spots)}スポット ÷ {duration_days}日")
     
-    for day_num in range(1, duration_days + 1):
-        if not remaining_spots:
-            break
-        
+    if routing:
+        # ホテル発着で計算済みのルート（スポットのない日も残して日付と宿の対応を保つ）
+        day_assignments = [day['spots'] for day in routing['days']]
+        routed_days = routing['days']
+    else:
+        # 残り日数で均等に分配（最大4スポット）し、近いスポット同士を同じ日にまとめる
+        day_assignments = assign_spots_to_days(spots, duration_days, max_spots_per_day)
+        routed_days = None
+    
+    for day_num, day_spots in enumerate(day_assignments, start=1):
         day_schedule = {
             'day': day_num,
             'date': (datetime.now() + timedelta(days=day_num-1)).strftime('%Y年%m月%d日'),
             'activities': []
         }
         
-        # 残り日数で均等に分配、ただし最大4スポットまで
-        remaining_days = duration_days - day_num + 1
-        remaining_spot_count = len(remaining_spots)
-        
-        if remaining_days == 1:
-            day_spot_count = min(max_spots_per_day, remaining_spot_count)
-        else:
-            ideal_count = (remaining_spot_count + remaining_days - 1) // remaining_days
-            day_spot_count = min(max_spots_per_day, ideal_count)
-        
-        print(f"  {day_num}日目: {day_spot_count}スポット")
-        
-        # その日のスポットを選択
-        day_spots = []
-        for _ in range(min(day_spot_count, len(remaining_spots))):
-            day_spots.append(remaining_spots.pop(0))
+        print(f"  {day_num}日目: {len(day_spots)}スポット")
+        
+        if routed_days:
+            routed = routed_days[day_num - 1]
+            for stop in routed['schedule']:
+                spot = stop['spot']
+                day_schedule['activities'].append({
+                    'type': 'spot',
+                    'time': format_clock(start_time, stop['arrive']),
+                    'name': f"{spot.get('image', '📍')} {spot['name']}",
+                    'spot_data': spot,
+                    'description': spot.get('description', ''),
+                    'address': spot.get('address', '')
+                })
+            day_schedule['start_point'] = routed['start']
+            day_schedule['hotel'] = routed['end']
+            day_schedule['travel_minutes'] = routed['travel_minutes']
+            day_schedule['end_time'] = format_clock(start_time, routed['duration_minutes'])
+            day_schedule['total_distance'] = calculate_route_distance(
+                [routed['start']] + day_spots + [routed['end']])
+            print(f"  📊 {day_num}日目の移動距離: {day_schedule['total_distance']}km（宿の発着を含む）")
+            itineraries.append(day_schedule)
+            continue
         
         # ★★★ ルート最適化: その日のスポットを効率的な順序に並び替え ★★★
         if len(day_spots) > 1:
@@ -2139,8 +6332,14 @@ def create_travel_plan(spots: List[Dict], answers: Dict) -> Dict:
         duration_days = max(1, len(spots) // 3)
         print(f"⚠️ スポット数が少ないため、{duration_days}日間に調整")
     
+    # 宿の指定があればホテル発着・時間制約つきで日ごとのルートを計算
+    routing = None
+    hotels = answers.get('hotels') or []
+    if hotels:
+        routing = solve_multiday_routes(spots, duration_days, hotels)
+    
     # 日程作成
-    itineraries = generate_daily_itinerary(spots, duration_days)
+    itineraries = generate_daily_itinerary(spots, duration_days, routing=routing)
     
     # プラン全体のサマリー
     total_distance = sum(day['total_distance'] for day in itineraries)
@@ -2159,6 +6358,15 @@ def create_travel_plan(spots: List[Dict], answers: Dict) -> Dict:
         #'tips': generate_travel_tips(answers, itineraries)
     }
     
+    if routing:
+        plan['summary']['travel_minutes'] = routing['travel_minutes']
+        plan['routing'] = {
+            'objective': routing['objective'],
+            'travel_minutes': routing['travel_minutes'],
+            'skipped': [spot.get('name', '?') for spot in routing['skipped']],
+            'elapsed_ms': routing['elapsed_ms'],
+        }
+    
     return plan
 
 
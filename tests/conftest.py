@@ -0,0 +1,70 @@
+import os
+import sys
+import tempfile
+
+# テスト用のキャッシュ・ストアは一時ディレクトリに作る（data/ を汚さない）
+_tmp = tempfile.mkdtemp(prefix='app-tests-')
+os.environ.setdefault('OVERPASS_CACHE_PATH', os.path.join(_tmp, 'overpass_cache.sqlite3'))
+os.environ.setdefault('POI_STORE_PATH', os.path.join(_tmp, 'poi_store.sqlite3'))
+os.environ.setdefault('ROAD_GRAPH_PATH', os.path.join(_tmp, 'road_graph.sqlite3'))
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'apps'))
+
+import io
+import json
+
+import pytest
+
+
+class FakeOverpassResponse:
+    """requests.Response の代わり（json() と逐次パース用の raw だけ）"""
+
+    def __init__(self, payload, status_code=200):
+        self.payload = payload
+        self.status_code = status_code
+        self.headers = {}
+
+    def json(self):
+        return self.payload
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def raw(self):
+        raw = io.BytesIO(json.dumps(self.payload).encode('utf-8'))
+        raw.decode_content = False
+        return raw
+
+
+@pytest.fixture
+def fake_overpass(monkeypatch):
+    """
+    Overpass APIへの送信を差し替える（空のキャッシュ・索引から始める）
+
+    fake_overpass.handler(query) の戻り値（要素のリスト）を応答し、
+    送信したクエリは fake_overpass.queries に残る
+    """
+    import app
+
+    class Fake:
+        queries = []
+
+        @staticmethod
+        def handler(query):
+            return []
+
+    def post(url, data=None, timeout=None, stream=False):
+        Fake.queries.append(data['data'])
+        return FakeOverpassResponse({'elements': Fake.handler(data['data'])})
+
+    app.overpass_cache.clear()
+    monkeypatch.setattr(app.overpass_client.session, 'post', post)
+    monkeypatch.setattr(app, 'spot_name_index', app.SpotNameIndex())
+    return Fake
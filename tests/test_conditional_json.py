@@ -0,0 +1,64 @@
+import gzip
+import json
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def spots_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'BASE_DIR', str(tmp_path))
+    (tmp_path / 'data').mkdir()
+    path = tmp_path / 'data' / 'spots.json'
+
+    def write(count):
+        path.write_text(json.dumps([{'name': f'spot{i}', 'lat': 34.0, 'lon': 135.0} for i in range(count)]),
+                        encoding='utf-8')
+    return write
+
+
+@pytest.mark.parametrize('count, encoding', [(1, None), (200, 'gzip')])
+def test_spots_304_uses_same_encoding_as_200(spots_file, count, encoding):
+    spots_file(count)
+    client = app.app.test_client()
+    headers = {'Accept-Encoding': 'gzip'}
+
+    first = client.get('/api/spots', headers=headers)
+    assert first.status_code == 200
+    assert first.headers.get('Content-Encoding') == encoding
+    etag = first.headers['ETag']
+    assert etag.endswith('-gzip"') == (encoding == 'gzip')
+
+    second = client.get('/api/spots', headers={**headers, 'If-None-Match': etag})
+    assert second.status_code == 304
+    assert second.headers['ETag'] == etag
+    assert second.data == b''
+
+
+def test_gzip_body_round_trips(spots_file):
+    spots_file(200)
+    response = app.app.test_client().get('/api/spots', headers={'Accept-Encoding': 'gzip'})
+    assert len(json.loads(gzip.decompress(response.data))['data']) == 200
+
+
+def test_changed_file_gets_new_etag(spots_file):
+    spots_file(1)
+    client = app.app.test_client()
+    etag = client.get('/api/spots').headers['ETag']
+    spots_file(2)
+    response = client.get('/api/spots', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+
+@pytest.mark.parametrize('path', ['/api/search-by-category?category=castle&prefecture=osaka',
+                                  '/api/search-spots?query=大阪&prefecture=osaka'])
+def test_search_routes_answer_304(fake_overpass, path):
+    fake_overpass.handler = lambda query: [
+        {'type': 'node', 'id': 1, 'lat': 34.6873, 'lon': 135.5259, 'tags': {'historic': 'castle', 'name': '大阪城'}}]
+    client = app.app.test_client()
+    first = client.get(path)
+    assert first.status_code == 200
+    second = client.get(path, headers={'If-None-Match': first.headers['ETag']})
+    assert second.status_code == 304
@@ -0,0 +1,30 @@
+import random
+
+import app
+
+
+def _kansai_spots(rng, n):
+    spots = []
+    for i in range(n):
+        lat, lon = rng.choice(app.KANSAI_BENCH_CENTERS)
+        spots.append({'name': f'spot{i}', 'lat': rng.gauss(lat, 0.08), 'lon': rng.gauss(lon, 0.08)})
+    return spots
+
+
+def test_sweep_never_worse_than_order():
+    rng = random.Random(0)
+    for _ in range(30):
+        spots = _kansai_spots(rng, 20)
+        order = app.itinerary_distance(app.assign_spots_to_days(spots, 5, 4, 'order'))
+        sweep = app.itinerary_distance(app.assign_spots_to_days(spots, 5, 4, 'sweep'))
+        assert sweep <= order + 1e-9
+
+
+def test_sweep_keeps_counts_and_every_spot():
+    rng = random.Random(1)
+    spots = _kansai_spots(rng, 11) + [{'name': 'no-coords'}]
+    days = app.assign_spots_to_days(spots, 3, 4, 'sweep')
+    assert [len(day) for day in days] == app.day_spot_counts(12, 3, 4)
+    assert sorted(s['name'] for day in days for s in day) == sorted(s['name'] for s in spots)
+    # 座標がないスポットは最後の日
+    assert days[-1][-1]['name'] == 'no-coords'
@@ -0,0 +1,47 @@
+import random
+
+import app
+
+
+def _spots(rng, n):
+    return [{'name': f's{i}', 'lat': 34.6 + rng.random() * 0.5, 'lon': 135.4 + rng.random() * 0.5,
+             'type': '寺院'} for i in range(n)]
+
+
+HOTELS = [{'name': '大阪の宿', 'lat': 34.70, 'lon': 135.50},
+          {'name': '京都の宿', 'lat': 35.00, 'lon': 135.77}]
+
+
+def test_days_respect_limits_and_start_end_at_hotels():
+    for seed in range(5):
+        rng = random.Random(seed)
+        spots = _spots(rng, 14)
+        router = app.MultiDayRouter(spots, 3, HOTELS, day_minutes=420, max_spots_per_day=4, time_limit=0.2)
+        result = router.solve()
+        assert len(result['days']) == 3
+        nights = [HOTELS[0], HOTELS[1], HOTELS[1]]
+        visited = []
+        for day, routed in enumerate(result['days']):
+            assert len(routed['spots']) <= 4
+            assert routed['duration_minutes'] <= 420 + 0.1
+            # 1日目は1泊目の宿から、以降は前夜の宿から出発してその夜の宿に戻る
+            assert routed['start'] is nights[max(day - 1, 0)]
+            assert routed['end'] is nights[day]
+            arrivals = [stop['arrive'] for stop in routed['schedule']]
+            assert arrivals == sorted(arrivals)
+            visited.extend(s['name'] for s in routed['spots'])
+        assert len(visited) == len(set(visited))
+        assert sorted(visited + [s['name'] for s in result['skipped']]) == sorted(s['name'] for s in spots)
+
+
+def test_itinerary_keeps_empty_days_paired_with_their_hotels():
+    spots = _spots(random.Random(0), 2)
+    routing = app.solve_multiday_routes(spots, 3, HOTELS, max_spots_per_day=1, time_limit=0.1)
+    assert any(not day['spots'] for day in routing['days'])
+
+    itinerary = app.generate_daily_itinerary(spots, 3, routing=routing)
+    assert [day['day'] for day in itinerary] == [1, 2, 3]
+    for day, routed in zip(itinerary, routing['days']):
+        assert day['hotel'] is routed['end']
+        assert day['start_point'] is routed['start']
+        assert [a['spot_data'] for a in day['activities']] == routed['spots']
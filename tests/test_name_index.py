@@ -0,0 +1,83 @@
+import app
+
+
+def _castle(element_id, name, lat=35.01, lon=135.76):
+    return {'type': 'node', 'id': element_id, 'lat': lat, 'lon': lon,
+            'tags': {'historic': 'castle', 'name': name}}
+
+
+def _castles(query):
+    return [_castle(1, '二条城'), _castle(2, '伏見城', 34.94, 135.77), _castle(3, '淀城跡', 34.9, 135.72)]
+
+
+def test_search_ranks_exact_then_prefix_then_substring():
+    index = app.SpotNameIndex()
+    index.add_elements([_castle(1, '大阪城公園'), _castle(2, '大阪城'), _castle(3, '新大阪城跡')])
+    assert [e['id'] for e in index.search('大阪城')] == [2, 1, 3]
+    assert index.search('名古屋') == []
+    # bboxとタグ条件で絞り込む
+    assert index.search('大阪城', bbox=(36, 135, 37, 136)) == []
+    assert index.search('大阪城', tag_filters=[{'tourism': 'museum'}]) == []
+
+
+def test_replaced_and_removed_elements_leave_no_stale_hits():
+    index = app.SpotNameIndex()
+    index.add_elements([_castle(1, '大阪城')])
+    index.add_elements([_castle(1, '岸和田城')])
+    assert index.search('大阪') == []
+    assert [e['id'] for e in index.suggest('岸和田')] == [1]
+    index.remove_elements([('node', 1)])
+    assert index.search('岸和田') == []
+    assert index.suggest('岸和田') == []
+
+
+def test_suggest_orders_by_importance():
+    index = app.SpotNameIndex()
+    plain = _castle(1, '姫路城跡')
+    famous = _castle(2, '姫路城')
+    famous['tags'].update({'wikidata': 'Q193072', 'heritage': '1'})
+    index.add_elements([plain, famous])
+    assert [e['id'] for e in index.suggest('姫路')] == [2, 1]
+    assert [e['id'] for e in index.suggest('姫路', limit=1)] == [2]
+
+
+def test_query_declines_without_coverage():
+    index = app.SpotNameIndex()
+    index._build_started = True
+    index.add_elements([_castle(1, '二条城')])
+    assert index.query(None, None, '二条城') is None
+    index.mark_covered('k', 0)
+    assert index.query(None, None, '二条城', coverage_keys=['k']) is None
+
+
+def test_keyword_search_answered_from_cached_category_tiles(fake_overpass):
+    fake_overpass.handler = _castles
+    client = app.app.test_client()
+
+    response = client.get('/api/search-combined?category=castle&prefecture=kyoto')
+    assert response.status_code == 200
+    fetched = len(fake_overpass.queries)
+    assert fetched > 0
+
+    response = client.get('/api/search-combined?keyword=伏見&category=castle&prefecture=kyoto')
+    assert response.status_code == 200
+    assert [s['name'] for s in response.get_json()['spots']] == ['伏見城']
+    assert len(fake_overpass.queries) == fetched
+
+
+def test_keyword_search_outside_cached_tiles_reaches_overpass(fake_overpass):
+    fake_overpass.handler = _castles
+    client = app.app.test_client()
+
+    client.get('/api/search-combined?category=castle&prefecture=kyoto')
+    fetched = len(fake_overpass.queries)
+
+    # 寺院のキーワード検索はカテゴリ検索と条件が違う（wikidataなしも含む）
+    client.get('/api/search-combined?keyword=清水&category=buddhist&prefecture=kyoto')
+    assert len(fake_overpass.queries) == fetched + 1
+    # キーワードのみの検索は包含するカテゴリ検索がない
+    client.get('/api/search-combined?keyword=伏見&prefecture=kyoto')
+    assert len(fake_overpass.queries) == fetched + 2
+    # 取得していない府県のタイル
+    client.get('/api/search-combined?keyword=姫路&category=castle&prefecture=hyogo')
+    assert len(fake_overpass.queries) == fetched + 3
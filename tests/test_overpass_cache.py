@@ -0,0 +1,94 @@
+import app
+
+
+def _way(element_id, lat, lon):
+    return {'type': 'way', 'id': element_id, 'center': {'lat': lat, 'lon': lon},
+            'tags': {'historic': 'castle', 'name': f'城{element_id}'}}
+
+
+def test_centroids_are_written_only_on_fetch(fake_overpass, monkeypatch):
+    fake_overpass.handler = lambda query: [_way(1, 34.68, 135.52)]
+    writes = []
+    put_centroids = app.overpass_cache.put_centroids
+    monkeypatch.setattr(app.overpass_cache, 'put_centroids',
+                        lambda centroids: (writes.append(dict(centroids)), put_centroids(centroids)))
+
+    query = '[out:json];way["historic"="castle"](34.6,135.4,34.8,135.6);out center;'
+    data = app.run_overpass_query(query)
+    assert writes == [{('way', 1): (34.68, 135.52)}]
+
+    # キャッシュヒットした結果の座標解決では書き込まない
+    assert app.run_overpass_query(query) == data
+    assert app.resolve_element_centers(data['elements']) == {('way', 1): (34.68, 135.52)}
+    assert len(writes) == 1
+
+    # 座標を含まない要素はキャッシュ済みの中心座標で解決する
+    bare = {'type': 'way', 'id': 1, 'tags': {'name': '城1'}}
+    assert app.resolve_element_centers([bare]) == {('way', 1): (34.68, 135.52)}
+
+
+class Clock:
+    def __init__(self, now=1_000_000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def test_ttl_fresh_then_stale_then_gone(tmp_path, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(app.time, 'time', clock)
+    cache = app.OverpassCache(str(tmp_path / 'cache.sqlite3'), 1 << 20)
+    cache.put('k', 'q', {'elements': [1]}, ttl=60, stale_ttl=30)
+    assert cache.get('k') == ({'elements': [1]}, 'fresh')
+    clock.now += 61
+    assert cache.get('k') == ({'elements': [1]}, 'stale')
+    clock.now += 30
+    assert cache.get('k') == (None, None)
+    assert cache.expires_in('k') is None
+
+
+def test_lru_evicts_least_recently_used(tmp_path, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(app.time, 'time', clock)
+    payload = {'elements': ['x' * 100]}
+    size = len(app.json.dumps(payload, ensure_ascii=False).encode('utf-8'))
+    cache = app.OverpassCache(str(tmp_path / 'cache.sqlite3'), size * 2)
+    cache.put('a', 'qa', payload, 60, 60)
+    clock.now += 1
+    cache.put('b', 'qb', payload, 60, 60)
+    clock.now += 1
+    cache.get('a')   # a を最近使ったことにする
+    clock.now += 1
+    cache.put('c', 'qc', payload, 60, 60)
+    assert cache.get('a')[1] == 'fresh'
+    assert cache.get('b') == (None, None)
+    assert cache.get('c')[1] == 'fresh'
+    # 上限より大きい結果は保存しない
+    cache.put('big', 'q', {'elements': ['x' * size * 3]}, 60, 60)
+    assert cache.get('big') == (None, None)
+
+
+def test_cache_key_ignores_whitespace_but_not_bbox():
+    a = app.overpass_cache_key('[out:json];\n  node["name"="大 阪"](34,135,35,136);\nout;')
+    b = app.overpass_cache_key('[out:json]; node["name"="大 阪"](34,135,35,136); out;')
+    c = app.overpass_cache_key('[out:json]; node["name"="大 阪"](34,135,35,137); out;')
+    d = app.overpass_cache_key('[out:json]; node["name"="大阪"](34,135,35,136); out;')
+    assert a == b
+    assert len({b, c, d}) == 3
+
+
+def test_stale_result_is_served_and_refreshed(fake_overpass, monkeypatch):
+    fake_overpass.handler = lambda query: [{'type': 'node', 'id': 1, 'lat': 34.7, 'lon': 135.5,
+                                            'tags': {'name': 'old'}}]
+    query = '[out:json];node(34.6,135.4,34.8,135.6);out;'
+    app.run_overpass_query(query, ttl=-1)   # すぐに期限切れ（stale）になる
+    fake_overpass.handler = lambda query: [{'type': 'node', 'id': 1, 'lat': 34.7, 'lon': 135.5,
+                                            'tags': {'name': 'new'}}]
+    stale = app.run_overpass_query(query)
+    assert stale['elements'][0]['tags']['name'] == 'old'
+    deadline = app.time.time() + 5
+    while app.overpass_cache.get(app.overpass_cache_key(query))[1] != 'fresh':
+        assert app.time.time() < deadline
+        app.time.sleep(0.01)
+    assert app.run_overpass_query(query)['elements'][0]['tags']['name'] == 'new'
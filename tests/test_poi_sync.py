@@ -0,0 +1,68 @@
+import json
+import os
+import sqlite3
+import time
+
+from click.testing import CliRunner
+
+import app
+
+
+def _temple(element_id, name):
+    return {'type': 'node', 'id': element_id, 'lat': 35.0, 'lon': 135.78,
+            'tags': {'amenity': 'place_of_worship', 'religion': 'buddhist', 'name': name}}
+
+
+def test_status_does_not_create_tables(tmp_path, monkeypatch):
+    path = tmp_path / 'poi_store.sqlite3'
+    sqlite3.connect(path).close()
+    monkeypatch.setattr(app, 'POI_STORE_PATH', str(path))
+    response = app.app.test_client().get('/api/overpass-status')
+    assert response.get_json()['poi_sync'] == {}
+    with sqlite3.connect(path) as conn:
+        assert conn.execute('SELECT count(*) FROM sqlite_master').fetchone() == (0,)
+
+
+def test_import_watermark_comes_from_extract(tmp_path):
+    dump = tmp_path / 'dump.json'
+    dump.write_text(json.dumps({
+        'version': 0.6,
+        'osm3s': {'timestamp_osm_base': '2024-05-01T12:34:56Z'},
+        'elements': [_temple(1, '清水寺')],
+    }), encoding='utf-8')
+    os.utime(dump, (0, 0))
+    output = str(tmp_path / 'store.sqlite3')
+    result = CliRunner().invoke(app.import_pois_command, [str(dump), '--output', output])
+    assert result.exit_code == 0, result.output
+    assert app.LocalPoiStore(output).sync_state()['watermark'] == '2024-05-01T12:34:56Z'
+
+    undated = tmp_path / 'undated.json'
+    undated.write_text(json.dumps({'elements': [_temple(1, '清水寺')]}), encoding='utf-8')
+    result = CliRunner().invoke(app.import_pois_command, [str(undated), '--output', output])
+    assert result.exit_code != 0
+    assert '--since' in result.output
+
+
+def test_index_rebuilds_after_sync_in_another_process(tmp_path, monkeypatch):
+    path = str(tmp_path / 'store.sqlite3')
+    app.LocalPoiStore.build(path, [_temple(1, '清水寺')], watermark='2024-05-01T00:00:00Z')
+    monkeypatch.setattr(app, 'SPOT_DATA_SOURCE', 'local')
+    monkeypatch.setattr(app, 'POI_STORE_PATH', path)
+    monkeypatch.setattr(app, '_local_poi_store', None)
+    monkeypatch.setattr(app, 'SPOT_INDEX_SYNC_CHECK_INTERVAL', 0)
+    app.overpass_cache.clear()
+
+    index = app.SpotNameIndex()
+    index._build_started = True
+    index.build()
+    assert [e['tags']['name'] for e in index.search('寺')] == ['清水寺']
+
+    # sync-pois（別プロセス）がストアだけを更新した
+    app.LocalPoiStore(path).apply_changes([_temple(2, '金閣寺')], [('node', 1)], '2024-05-02T00:00:00Z')
+    index.ensure_built()
+    deadline = time.time() + 5
+    while [e['tags']['name'] for e in index.search('寺')] != ['金閣寺']:
+        assert time.time() < deadline, '索引が作り直されなかった'
+        time.sleep(0.01)
+    assert index.complete
+    assert index._store_watermark == '2024-05-02T00:00:00Z'
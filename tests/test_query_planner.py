@@ -0,0 +1,76 @@
+import pytest
+
+import app
+
+
+@pytest.fixture
+def stats(monkeypatch):
+    fresh = app.CategoryQueryStats(1.0)
+    monkeypatch.setattr(app, 'category_query_stats', fresh)
+    app.overpass_cache.clear()
+    return fresh
+
+
+def _element(element_type, tags, element_id=1):
+    return {'type': element_type, 'id': element_id, 'lat': 34.7, 'lon': 135.5, 'tags': tags}
+
+
+def test_unmeasured_categories_stay_separate(stats):
+    keys = ['relax', 'nature', 'culture']
+    assert app.plan_category_queries(keys) == [['relax'], ['nature'], ['culture']]
+
+
+def test_fast_categories_are_merged_within_budget(stats, monkeypatch):
+    monkeypatch.setattr(app, 'OVERPASS_PLAN_TARGET_LATENCY', 5.0)
+    for key, latency in {'culture': 4.0, 'relax': 1.0, 'nature': 1.0, 'gourmet': 0.5}.items():
+        stats.record([key], latency, [])
+    plan = app.plan_category_queries(['relax', 'nature', 'culture', 'gourmet'])
+    assert sorted(k for group in plan for k in group) == ['culture', 'gourmet', 'nature', 'relax']
+    assert len(plan) == 2
+    for group in plan:
+        assert sum(stats.estimate(k)[0] for k in group) <= 5.0
+        # グループ内は指定順
+        assert group == sorted(group, key=['relax', 'nature', 'culture', 'gourmet'].index)
+
+
+def test_size_cap_and_cached_categories_are_not_merged(stats, monkeypatch):
+    monkeypatch.setattr(app, 'OVERPASS_PLAN_MAX_ELEMENTS', 100)
+    big = [_element('node', {'leisure': 'spa'}, i) for i in range(80)]
+    stats.record(['relax'], 0.5, big)
+    stats.record(['nature'], 0.5, [_element('node', {'natural': 'peak'}, i) for i in range(80)])
+    stats.record(['activity'], 0.5, [])
+    stats.record(['shopping'], 0.5, [])
+    query = app.build_category_query(['shopping'])
+    app.overpass_cache.put(app.overpass_cache_key(query), query, {'elements': []}, 60, 60)
+
+    plan = app.plan_category_queries(['relax', 'nature', 'activity', 'shopping'])
+    assert ['shopping'] in plan
+    assert not any('relax' in g and 'nature' in g for g in plan)
+
+
+def test_record_apportions_latency_by_matched_elements(stats):
+    elements = ([_element('node', {'leisure': 'spa'}, i) for i in range(3)]
+                + [_element('way', {'historic': 'castle'}, 10)])
+    stats.record(['relax', 'culture'], 4.0, elements)
+    assert stats.estimate('relax') == (3.0, 3)
+    assert stats.estimate('culture') == (1.0, 1)
+
+
+def test_merged_query_keeps_per_category_limits():
+    query = app.build_category_query(['relax', 'culture'])
+    assert ')->.relax;' in query and ')->.culture;' in query
+    assert query.count('out center 15;') == 2
+
+
+def test_fetch_sends_one_query_per_planned_group(stats, fake_overpass, monkeypatch):
+    monkeypatch.setattr(app, 'OVERPASS_PLAN_TARGET_LATENCY', 5.0)
+    for key in ('relax', 'nature', 'culture'):
+        stats.record([key], 1.0, [])
+    fake_overpass.handler = lambda query: [
+        _element('node', {'leisure': 'spa', 'name': '有馬温泉'}, 1),
+        _element('node', {'natural': 'peak', 'name': '六甲山'}, 2),
+        _element('way', {'historic': 'castle', 'name': '姫路城'}, 3),
+    ]
+    spots = app.fetch_spots_from_overpass(['relax', 'nature', 'culture'])
+    assert len(fake_overpass.queries) == 1
+    assert {s['name'] for s in spots} == {'有馬温泉', '六甲山', '姫路城'}
@@ -0,0 +1,81 @@
+import math
+import os
+
+import pytest
+
+import app
+
+FIXTURE = os.path.join(os.path.dirname(__file__), 'fixtures', 'roads.osm')
+
+
+@pytest.fixture(scope='module')
+def network(tmp_path_factory):
+    output = str(tmp_path_factory.mktemp('road') / 'road_graph.sqlite3')
+    stats = app.RoadNetwork.build(FIXTURE, output, landmarks=3)
+    assert stats == {'nodes': 16, 'edges': 45, 'landmarks': 3, 'ways': 8}
+    return app.RoadNetwork(output)
+
+
+def _grid_point(i, j):
+    return {'name': f'{i}-{j}', 'lat': 34.70 + i * 0.005, 'lon': 135.50 + j * 0.005}
+
+
+def test_building_nodes_are_not_read():
+    coords, ways = app.read_osm_roads(FIXTURE)
+    assert len(ways) == 8
+    assert set(coords) == set(range(1, 17))
+
+
+def test_travel_matrix_matches_plain_dijkstra(network):
+    points = [_grid_point(i, j) for i, j in [(0, 0), (0, 3), (1, 2), (3, 0), (3, 3), (2, 1)]]
+    matrix = network.travel_matrix(points)
+    nodes = [network.snap(p['lat'], p['lon'])[0] for p in points]
+    adj = [[(v, seconds) for v, seconds, _ in edges] for edges in network.adj]
+    for i, a in enumerate(nodes):
+        reference = app._dijkstra_all(adj, a)
+        for j, b in enumerate(nodes):
+            if i == j:
+                assert matrix[i][j] is None
+                continue
+            minutes, km = matrix[i][j]
+            assert minutes == pytest.approx(reference[b] / 60)
+            assert km > 0
+            # 1組だけのA*とも一致する
+            assert network._alt_search(a, b)[0] == pytest.approx(reference[b])
+
+
+def test_oneway_street_is_only_used_eastbound(network):
+    west, east = _grid_point(0, 0), _grid_point(0, 1)
+    matrix = network.travel_matrix([west, east])
+    eastbound, westbound = matrix[0][1], matrix[1][0]
+    # 西→東は一方通行を直進、東→西は1本北の通りを迂回する
+    assert eastbound[1] == pytest.approx(0.46, abs=0.01)
+    assert westbound[1] == pytest.approx(eastbound[1] + 2 * 0.56, abs=0.02)
+    assert westbound[0] > eastbound[0] * 2
+
+
+def test_travel_legs_reuse_matrix_results(network):
+    points = [_grid_point(0, 0), _grid_point(3, 3), _grid_point(1, 2)]
+    matrix = network.travel_matrix(points)
+    misses = network.misses
+    legs = network.travel_legs(points)
+    assert network.misses == misses
+    assert legs == [matrix[0][1], matrix[1][2]]
+
+
+def test_points_far_from_roads_fall_back(network):
+    far = {'name': 'far', 'lat': 34.9, 'lon': 135.9}
+    matrix = network.travel_matrix([_grid_point(0, 0), far])
+    assert matrix[0][1] is None and matrix[1][0] is None
+    assert network.travel_legs([far, _grid_point(0, 0)]) == [None]
+
+
+def test_road_matrices_use_loaded_network(network, monkeypatch):
+    monkeypatch.setattr(app, 'ROUTE_USE_ROAD_NETWORK', True)
+    monkeypatch.setattr(app, '_road_network', network)
+    points = [_grid_point(0, 0), _grid_point(3, 3)]
+    minutes, km = app.road_matrices(points)
+    assert minutes[0][1] == pytest.approx(network.travel_matrix(points)[0][1][0])
+    cost, _ = app.route_cost_matrices(points)
+    assert cost[0][1] == cost[1][0]
+    assert not math.isinf(cost[0][1])
@@ -0,0 +1,53 @@
+import itertools
+import random
+
+import app
+
+
+def _points(rng, n):
+    return [{'name': f'p{i}', 'lat': 34.3 + rng.random(), 'lon': 135.0 + rng.random()} for i in range(n)]
+
+
+def test_local_search_never_worse_than_greedy_and_keeps_endpoints():
+    rng = random.Random(0)
+    for _ in range(50):
+        n = 9
+        matrix = app.distance_matrix(_points(rng, n + 1))
+        nodes = list(range(n))
+        for start, end in [(0, None), (None, None), (n, n), (n, None)]:
+            greedy = app.solve_route(matrix, nodes, start, end, 'greedy')
+            improved = app.solve_route(matrix, nodes, start, end, 'local_search', 1.0)
+            assert sorted(i for i in improved if i < n) == nodes
+            if start is not None:
+                assert improved[0] == start
+            if end is not None:
+                assert improved[-1] == end
+            assert app.route_length(improved, matrix) <= app.route_length(greedy, matrix) + 1e-9
+
+
+def test_local_search_close_to_optimal_on_small_open_tours():
+    rng = random.Random(1)
+    gaps = []
+    for _ in range(30):
+        matrix = app.distance_matrix(_points(rng, 7))
+        best = min(app.route_length([0] + list(p), matrix) for p in itertools.permutations(range(1, 7)))
+        found = app.route_length(app.solve_route(matrix, list(range(7)), 0, None, 'local_search', 1.0), matrix)
+        gaps.append(found / best - 1)
+    assert sum(gaps) / len(gaps) < 0.02
+
+
+def test_optimize_daily_route_pins_first_spot_and_keeps_missing_coords_last():
+    rng = random.Random(2)
+    spots = _points(rng, 8) + [{'name': 'no-coords'}]
+    optimized = app.optimize_daily_route(spots)
+    assert optimized[0] is spots[0]
+    assert optimized[-1]['name'] == 'no-coords'
+    assert sorted(s['name'] for s in optimized) == sorted(s['name'] for s in spots)
+
+
+def test_optimize_daily_route_with_hotel_start_does_not_return_hotel():
+    rng = random.Random(3)
+    spots = _points(rng, 5)
+    hotel = {'name': 'hotel', 'lat': 34.7, 'lon': 135.5}
+    optimized = app.optimize_daily_route(spots, start=hotel, end=hotel)
+    assert sorted(s['name'] for s in optimized) == sorted(s['name'] for s in spots)
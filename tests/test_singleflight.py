@@ -0,0 +1,75 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import app
+
+
+def test_concurrent_calls_share_one_execution():
+    flight = app.SingleFlight()
+    calls = []
+    release = threading.Event()
+
+    def fetch():
+        calls.append(1)
+        release.wait(5)
+        return {'elements': [1]}
+
+    with ThreadPoolExecutor(8) as executor:
+        futures = [executor.submit(flight.do, 'k', fetch) for _ in range(8)]
+        deadline = time.time() + 5
+        while flight.coalesced < 7:
+            assert time.time() < deadline
+            time.sleep(0.01)
+        release.set()
+        results = [f.result(5) for f in futures]
+    assert len(calls) == 1
+    assert all(r is results[0] for r in results)
+
+
+def test_errors_are_shared_and_next_call_retries():
+    flight = app.SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+
+    def failing():
+        started.set()
+        release.wait(5)
+        raise RuntimeError('boom')
+
+    with ThreadPoolExecutor(2) as executor:
+        leader = executor.submit(flight.do, 'k', failing)
+        started.wait(5)
+        follower = executor.submit(flight.do, 'k', lambda: 'not called')
+        deadline = time.time() + 5
+        while flight.coalesced < 1:
+            assert time.time() < deadline
+            time.sleep(0.01)
+        release.set()
+        for future in (leader, follower):
+            with pytest.raises(RuntimeError):
+                future.result(5)
+    assert flight.do('k', lambda: 'retried') == 'retried'
+
+
+def test_identical_overpass_queries_are_sent_once(fake_overpass):
+    release = threading.Event()
+
+    def slow(query):
+        release.wait(5)
+        return []
+
+    fake_overpass.handler = slow
+    query = '[out:json];node(34.6,135.4,34.8,135.6);out;'
+    coalesced = app.overpass_singleflight.coalesced
+    with ThreadPoolExecutor(4) as executor:
+        futures = [executor.submit(app.run_overpass_query, query) for _ in range(4)]
+        deadline = time.time() + 5
+        while app.overpass_singleflight.coalesced < coalesced + 3:
+            assert time.time() < deadline
+            time.sleep(0.01)
+        release.set()
+        assert [f.result(5) for f in futures] == [{'elements': []}] * 4
+    assert len(fake_overpass.queries) == 1
@@ -0,0 +1,75 @@
+import threading
+import time
+
+import pytest
+
+import app
+
+
+def test_waits_for_advertised_slot_time_beyond_timeout():
+    scheduler = app.OverpassSlotScheduler(1, 20)
+    scheduler.paused_until = time.time() + 0.3
+    started = time.time()
+    scheduler.acquire(timeout=0.1)
+    assert time.time() - started >= 0.29
+    scheduler.release(200)
+
+
+def test_long_pause_is_a_retry_later_error():
+    scheduler = app.OverpassSlotScheduler(1, 20)
+    scheduler.paused_until = time.time() + app.OVERPASS_SLOT_MAX_WAIT + 30
+    started = time.time()
+    with pytest.raises(app.OverpassBusyError) as raised:
+        scheduler.acquire(timeout=10)
+    assert time.time() - started < 1
+    assert raised.value.retry_after >= app.OVERPASS_SLOT_MAX_WAIT + 29
+    assert scheduler.status()['queued'] == 0
+
+
+def test_full_slots_time_out_as_busy_and_keep_queue_order():
+    scheduler = app.OverpassSlotScheduler(1, 20)
+    scheduler.acquire()
+    with pytest.raises(app.OverpassBusyError):
+        scheduler.acquire(timeout=0.05)
+
+    order = []
+
+    def waiter(name, priority):
+        scheduler.acquire(priority, timeout=5)
+        order.append(name)
+        scheduler.release(200)
+
+    threads = [threading.Thread(target=waiter, args=('background', app.OVERPASS_PRIORITY_BACKGROUND))]
+    threads[0].start()
+    time.sleep(0.05)
+    threads.append(threading.Thread(target=waiter, args=('interactive', app.OVERPASS_PRIORITY_INTERACTIVE)))
+    threads[1].start()
+    time.sleep(0.05)
+    scheduler.release(200)
+    for thread in threads:
+        thread.join(5)
+    assert order == ['interactive', 'background']
+
+
+def test_unparseable_body_is_released_as_failure(fake_overpass, monkeypatch):
+    class Broken(app.requests.Response):
+        def __init__(self):
+            super().__init__()
+            self.status_code = 200
+            self._content = b'{"elements": [{"type": "no'
+
+    monkeypatch.setattr(app.overpass_client.session, 'post', lambda *a, **k: Broken())
+    scheduler = app.overpass_scheduler
+    successes = scheduler._successes
+    with pytest.raises(ValueError):
+        app.overpass_client.post('[out:json];node(1);out;')
+    assert scheduler._successes == successes
+    assert scheduler.in_flight == 0
+
+
+def test_search_returns_503_with_retry_after_when_paused(fake_overpass, monkeypatch):
+    monkeypatch.setattr(app.overpass_scheduler, 'paused_until', time.time() + app.OVERPASS_SLOT_MAX_WAIT + 100)
+    response = app.app.test_client().get('/api/search-combined?category=museum&prefecture=nara')
+    assert response.status_code == 503
+    assert int(response.headers['Retry-After']) > app.OVERPASS_SLOT_MAX_WAIT
+    assert fake_overpass.queries == []
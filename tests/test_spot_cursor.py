@@ -0,0 +1,43 @@
+import base64
+
+import app
+
+
+def _castles(query):
+    return [{'type': 'node', 'id': i, 'lat': 34.6 + i * 0.01, 'lon': 135.5,
+             'tags': {'historic': 'castle', 'name': f'城{i}'}} for i in range(1, 8)]
+
+
+def test_cursor_round_trip():
+    cursor = app.encode_spot_cursor('search_combined', 'abc', 40)
+    assert app.decode_spot_cursor(cursor, 'search_combined') == ('abc', 40)
+    assert app.decode_spot_cursor(cursor, 'get_overpass_spots') is None
+    assert app.decode_spot_cursor('not a cursor', 'search_combined') is None
+
+
+def test_tampered_cursor_is_rejected():
+    signed = base64.urlsafe_b64decode(app.encode_spot_cursor('search_combined', 'abc', 40) + '==')
+    forged = signed[:12] + signed[12:].replace(b'"o":40', b'"o":99')
+    cursor = base64.urlsafe_b64encode(forged).decode('ascii').rstrip('=')
+    assert app.decode_spot_cursor(cursor, 'search_combined') is None
+
+
+def test_paging_through_snapshot(fake_overpass):
+    fake_overpass.handler = _castles
+    client = app.app.test_client()
+    first = client.get('/api/search-combined?category=castle&prefecture=osaka&limit=3').get_json()
+    assert first['total'] == 7 and first['count'] == 3
+    queries = len(fake_overpass.queries)
+
+    names = [s['name'] for s in first['spots']]
+    cursor = first['next_cursor']
+    while cursor:
+        page = client.get(f'/api/search-combined?cursor={cursor}&limit=3').get_json()
+        names += [s['name'] for s in page['spots']]
+        cursor = page['next_cursor']
+    assert sorted(names) == sorted(f'城{i}' for i in range(1, 8))
+    assert len(fake_overpass.queries) == queries
+
+    # 別のエンドポイントでは使えない
+    response = client.get(f"/api/overpass-spots?cursor={first['next_cursor']}&limit=3")
+    assert response.status_code == 400
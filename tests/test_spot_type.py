@@ -0,0 +1,26 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'apps'))
+
+import app  # noqa: E402
+
+
+def test_spa_with_attraction_stays_relax():
+    element = {'type': 'node', 'id': 1, 'tags': {'leisure': 'spa', 'tourism': 'attraction'}}
+    spot_type = app.requested_spot_type(element, ['relax', 'culture'])
+    assert spot_type == '温泉'
+    assert app.determine_category_key(spot_type) == 'relax'
+
+
+def test_park_with_heritage_stays_nature():
+    element = {'type': 'way', 'id': 2, 'tags': {'leisure': 'park', 'heritage': '1'}}
+    spot_type = app.requested_spot_type(element, ['nature'])
+    assert spot_type == '公園'
+    assert app.determine_category_key(spot_type) == 'nature'
+
+
+def test_heritage_and_attraction_are_not_other():
+    assert app.determine_category_key('世界遺産') == 'culture'
+    assert app.determine_category_key('観光地') == 'culture'
+    assert app.determine_category_key(app.classify_spot_type({'tourism': 'attraction'})) != 'other'
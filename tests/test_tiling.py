@@ -0,0 +1,55 @@
+import re
+
+import app
+
+QUERY = '[out:json];node["historic"="castle"]({bbox});out center;'
+
+
+def _query(bbox):
+    return QUERY.format(bbox=','.join(str(v) for v in bbox))
+
+
+def _tile_of(query):
+    return tuple(float(v) for v in re.search(r'\(([\d.,]+)\)', query).group(1).split(','))
+
+
+def test_tiles_cover_bbox_on_fixed_grid():
+    bbox = (34.7, 135.0, 35.8, 136.0)
+    tiles = app.overpass_bbox_tiles(bbox)
+    assert len(tiles) == 24
+    assert min(t[0] for t in tiles) <= bbox[0] and max(t[2] for t in tiles) >= bbox[2]
+    assert min(t[1] for t in tiles) <= bbox[1] and max(t[3] for t in tiles) >= bbox[3]
+    # 重なる地域は同じタイルになる
+    assert set(tiles) & set(app.overpass_bbox_tiles((34.8, 135.7, 35.7, 136.5)))
+
+
+def test_wide_bbox_is_not_split():
+    kansai = (33.5, 134.5, 35.8, 136.8)
+    assert len(app.overpass_bbox_tiles(kansai)) > app.OVERPASS_MAX_TILES
+    assert app.overpass_tile_queries(_query(kansai), kansai) is None
+
+
+def test_overlapping_searches_reuse_cached_tiles(fake_overpass):
+    kyoto = (34.7, 135.0, 35.8, 136.0)
+    shiga = (34.8, 135.7, 35.7, 136.5)
+    app.run_tiled_overpass_query(_query(kyoto), kyoto)
+    assert len(fake_overpass.queries) == 24
+    app.run_tiled_overpass_query(_query(shiga), shiga)
+    shiga_tiles = set(app.overpass_bbox_tiles(shiga))
+    new_tiles = shiga_tiles - set(app.overpass_bbox_tiles(kyoto))
+    assert len(fake_overpass.queries) == 24 + len(new_tiles)
+    assert {_tile_of(q) for q in fake_overpass.queries[24:]} == new_tiles
+
+
+def test_duplicates_across_tiles_prefer_tagged_copy(fake_overpass):
+    bbox = (34.6, 135.4, 34.9, 135.6)
+    tagged = {'type': 'node', 'id': 1, 'lat': 34.75, 'lon': 135.5, 'tags': {'name': '城'}}
+    skeleton = {'type': 'node', 'id': 1, 'lat': 34.75, 'lon': 135.5}
+
+    def handler(query):
+        # 最初のタイルには再帰取得のタグなしのコピーだけが入っている
+        return [skeleton] if _tile_of(query) == app.overpass_bbox_tiles(bbox)[0] else [tagged]
+
+    fake_overpass.handler = handler
+    data = app.run_tiled_overpass_query(_query(bbox), bbox)
+    assert data == {'elements': [tagged]}